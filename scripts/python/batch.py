@@ -0,0 +1,449 @@
+import os
+import time
+from collections import namedtuple
+
+from ndvi import DEFAULT_PROJECT, DIRECT_FLOAT_NODATA, MAX_CONCURRENT_TASKS, MAX_PIXELS, TILE_PIXEL_BUDGET
+from tiling import bbox_intersecting_tiles, grid_for_bounds
+
+# ---------------------------------------------------------------------
+# Multi-region batch mode
+#
+# ndvi_annual_US_sentinel.py does one STATE_NAME per run: its own scene
+# collection, its own median composite and its own export. For all 50
+# states (or every county) that is 50 collections and composites over
+# overlapping scene sets. Here regions -- a TIGER layer from
+# zonal_stats.ZONE_LAYERS or a GeoJSON FeatureCollection -- are put in
+# Morton (Z-order) order of their centres and packed greedily into
+# spatially coherent batches, each at most `max_pixels` over its
+# bounding box and `max_regions` regions.
+# Each batch gets one collection, filtered to its regions' boxes, and
+# one composite. Per-region outputs are subsets of that composite:
+#   * direct transport: the batch composite is fetched once over the
+#     tiles touching its regions, and each region is cut out and
+#     masked locally, so shared scenes and pixels are fetched once;
+#   * export transport: every region gets tile exports of the shared
+#     composite clipped to its boundary, all through one scheduler.
+# Everything runs on the globally snapped grids of tiling.grid_for_bounds,
+# so region outputs align whichever batch produced them. Each region
+# is a state_store unit and, on either transport, ends as one masked
+# GeoTIFF under the output directory; verified regions are skipped on
+# re-runs. Throughput is reported as regions per hour, per batch and
+# overall, counting only regions produced by the run.
+# ---------------------------------------------------------------------
+BATCH_MAX_PIXELS = 2e9     # pixels over a batch's bounding box at the output scale
+BATCH_MAX_REGIONS = 12
+MORTON_BITS = 16
+
+Region = namedtuple('Region', ['id', 'name', 'geometry', 'bounds'])
+Batch = namedtuple('Batch', ['id', 'regions', 'bounds'])
+
+
+def load_regions(layer, cache_dir, tolerance=None, only=None, id_field='id', name_field='name'):
+    """Regions of a zone layer (see zonal_stats.ZoneIndex), optionally only those whose id or name is in `only`."""
+    from rasterio.features import bounds
+    from zonal_stats import ZoneIndex
+
+    features = ZoneIndex(layer, cache_dir, tolerance, id_field=id_field, name_field=name_field).features()
+    regions = [Region(str(f['properties']['id']), f['properties'].get('name'), f['geometry'],
+                      tuple(bounds(f['geometry']))) for f in features]
+    if only:
+        wanted = {str(o).lower() for o in only}
+        regions = [r for r in regions if r.id.lower() in wanted or (r.name or '').lower() in wanted]
+        found = {r.id.lower() for r in regions} | {(r.name or '').lower() for r in regions}
+        missing = wanted - found
+        if missing:
+            raise ValueError(f"No region in '{layer}' matches {sorted(missing)}")
+    return regions
+
+
+def _layer_cached(layer, cache_dir, tolerance):
+    from zonal_stats import ZoneIndex
+    return os.path.exists(os.path.join(cache_dir, f"{ZoneIndex(layer, cache_dir, tolerance).name}.geojson"))
+
+
+def _union(boxes):
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def _pixels(bounds, scale):
+    grid = grid_for_bounds(bounds, scale)
+    return grid.width * grid.height
+
+
+def _morton(x, y):
+    key = 0
+    for bit in range(MORTON_BITS):
+        key |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+def plan_batches(regions, scale, max_pixels=BATCH_MAX_PIXELS, max_regions=BATCH_MAX_REGIONS):
+    """Group regions into spatially coherent batches.
+
+    Regions are visited in Z-order of their bounding-box centres, so
+    neighbours come in runs, and a batch is closed when the next region
+    would push its bounding box past `max_pixels` or its size past
+    `max_regions`. A region bigger than `max_pixels` gets a batch of
+    its own.
+    """
+    if not regions:
+        return []
+    west, south, east, north = _union([r.bounds for r in regions])
+    span = (1 << MORTON_BITS) - 1
+
+    def key(region):
+        cx = (region.bounds[0] + region.bounds[2]) / 2
+        cy = (region.bounds[1] + region.bounds[3]) / 2
+        return _morton(int((cx - west) / max(east - west, 1e-9) * span),
+                       int((cy - south) / max(north - south, 1e-9) * span))
+
+    batches, current = [], []
+    for region in sorted(regions, key=key):
+        if current:
+            bounds = _union([r.bounds for r in current] + [region.bounds])
+            if len(current) >= max_regions or _pixels(bounds, scale) > max_pixels:
+                batches.append(current)
+                current = []
+        current.append(region)
+    batches.append(current)
+    return [Batch(i, members, _union([r.bounds for r in members])) for i, members in enumerate(batches)]
+
+
+def print_batches(batches, scale):
+    regions = sum(len(b.regions) for b in batches)
+    print(f"📦 {regions} region(s) in {len(batches)} batch(es): {len(batches)} composite(s) instead of {regions}")
+    for batch in batches:
+        names = ', '.join(r.name or r.id for r in batch.regions)
+        print(f"  batch {batch.id:03d}  {len(batch.regions):>3} region(s)  "
+              f"{_pixels(batch.bounds, scale) / 1e6:>9,.1f} Mpx  {names}")
+
+
+def regions_per_hour(count, seconds):
+    return count * 3600.0 / seconds if seconds > 0 else float('inf')
+
+
+def region_prefix(prefix, region, year):
+    return f"{prefix}_{region.id.lower().replace(' ', '_')}_{year}"
+
+
+def cut_region(mosaic_path, region, out_path):
+    """Write the part of a batch mosaic inside `region` (masked to its boundary) to `out_path`."""
+    import math
+    import rasterio
+    from rasterio import features, windows
+    from rasterio.warp import transform_geom
+
+    with rasterio.open(mosaic_path) as src:
+        w = windows.from_bounds(*region.bounds, transform=src.transform)
+        r0, c0 = max(int(math.floor(w.row_off)), 0), max(int(math.floor(w.col_off)), 0)
+        r1 = min(int(math.ceil(w.row_off + w.height)), src.height)
+        c1 = min(int(math.ceil(w.col_off + w.width)), src.width)
+        window = windows.Window(c0, r0, c1 - c0, r1 - r0)
+        transform = windows.transform(window, src.transform)
+        geometry = region.geometry
+        if src.crs is not None and str(src.crs) not in ('EPSG:4326', 'OGC:CRS84'):
+            geometry = transform_geom('EPSG:4326', src.crs, geometry)
+        outside = features.geometry_mask([geometry], out_shape=(window.height, window.width), transform=transform)
+        data = src.read(window=window)
+        data[:, outside] = src.nodata
+        profile = dict(src.profile, width=window.width, height=window.height, transform=transform)
+        scales, offsets = src.scales, src.offsets
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    with rasterio.open(out_path, 'w', **profile) as dst:
+        dst.write(data)
+        dst.scales, dst.offsets = scales, offsets
+    return out_path
+
+
+def region_unit(sensor, region, year, season, index):
+    """The state_store.Unit of one region's product, e.g. (sentinel, 25, 2020-JJA, NDVI)."""
+    from state_store import Unit
+    return Unit(sensor, region.id, str(year) if season == 'annual' else f"{year}-{season.upper()}", index)
+
+
+def run_batches(batches, out_dir, year, sensor='sentinel', season='annual', index='NDVI', scale=None,
+                dtype='int16', transport='auto', drive_folder=None, prefix=None, tile_budget=TILE_PIXEL_BUDGET,
+                max_tasks=MAX_CONCURRENT_TASKS, max_pixels=MAX_PIXELS, max_cloud_cover=None, metrics=None,
+                state=None, drive_source=None):
+    """Build one composite per batch and produce every region's output from it.
+
+    Earth Engine must already be initialized. With a
+    state_store.StateStore each region is tracked as a unit and regions
+    already verified are skipped; without one, regions whose output
+    file exists are. Export batches are downloaded from Drive through
+    `drive_source` (default: a pydrive2 login on first use) and each
+    region's tiles are mosaicked into its output. A batch whose direct
+    fetch fails is exported instead, as is every later batch. Returns
+    {'completed': [region ids], 'failed': [region ids], 'skipped': [region ids already done],
+    'seconds', 'regions_per_hour'}; the rate counts only regions produced by this run.
+    """
+    import ee
+    from cog import NODATA, export_options, to_scaled_int16, write_cog
+    from direct_fetch import FetchError, choose_transport, ee_url_maker, fetch_tiles, fetch_to_mosaic
+    from scheduler import tile_jobs
+    from sensors import SENSORS, composite
+    from state_store import WHOLE_UNIT, verify_output
+    from tiling import plan_tiles, tile_pixel_budget
+
+    scale = scale or SENSORS[sensor]['scale']
+    prefix = prefix or f"{index.lower()}_{sensor}_{season}"
+    drive_folder = drive_folder or f"{prefix}_{year}".upper()
+    started = time.time()
+    completed, failed, skipped = [], [], []
+    exports = []   # (region, [ExportJob]) for batches going through Drive
+    fetch_failed = False   # once a direct fetch has failed, later batches are exported too
+
+    def out_path_for(region):
+        return os.path.join(out_dir, f"{region_prefix(prefix, region, year)}.tif")
+
+    def unit_of(region):
+        return region_unit(sensor, region, year, season, index)
+
+    def done(region):
+        if state is None:
+            return os.path.exists(out_path_for(region))
+        return state.is_done(unit_of(region), 'verified')
+
+    def finished(region, path):
+        # Output is in place: record it and count the region.
+        if state is not None:
+            state.advance(unit_of(region), 'verified', path=verify_output(path))
+        completed.append(region.id)
+
+    def given_up(region, error):
+        if state is not None:
+            state.fail(unit_of(region), error)
+        failed.append(region.id)
+
+    def plan_exports(batch, regions, image, planned_whole=False):
+        # Tile exports of the shared composite, clipped per region; submitted below through one scheduler
+        for region in regions:
+            region_grid = grid_for_bounds(region.bounds, scale)
+            tiles = plan_tiles(region_grid, tile_pixel_budget(dtype, tile_budget),
+                               intersects=bbox_intersecting_tiles([region.bounds]))
+            jobs = tile_jobs(image.clip(ee.Geometry(region.geometry)), region_grid, tiles,
+                             f"{prefix}_{region.id}_{year}".replace(' ', '_'),
+                             region_prefix(prefix, region, year),
+                             dict(folder=drive_folder, maxPixels=max_pixels, **export_options(dtype)),
+                             priority=-batch.id)
+            if state is not None:
+                if planned_whole:
+                    # Planned for a direct fetch as a single part; track its tiles instead
+                    state.split(unit_of(region), WHOLE_UNIT, [job.label for job in jobs])
+                state.plan(unit_of(region), [job.label for job in jobs])
+            exports.append((region, jobs))
+
+    if state is not None:
+        state.reconcile()
+    for batch in batches:
+        todo = [r for r in batch.regions if not done(r)]
+        skipped += [r.id for r in batch.regions if r not in todo]
+        if not todo:
+            print(f"⏭️ Batch {batch.id:03d}: all {len(batch.regions)} region(s) already done")
+            continue
+        batch_start = time.time()
+
+        # One collection and composite for the whole batch, filtered to its regions' boxes
+        footprint = ee.Geometry.MultiPolygon([[[[w, s], [e, s], [e, n], [w, n], [w, s]]]
+                                              for w, s, e, n in (r.bounds for r in todo)])
+        image = composite(sensor, footprint, year, season, (index,), max_cloud_cover).select(index)
+        if dtype == 'int16':
+            image = to_scaled_int16(image)
+
+        grid = grid_for_bounds(_union([r.bounds for r in todo]), scale)
+        fetch_plan = fetch_tiles(grid, bbox_intersecting_tiles([r.bounds for r in todo]))
+        mode = choose_transport(fetch_plan) if transport == 'auto' else transport
+        if mode == 'direct' and fetch_failed:
+            mode = 'export'
+        print(f"🧩 Batch {batch.id:03d}: {len(todo)} region(s), one composite, {mode} transport")
+
+        if mode == 'direct':
+            # Fetch the batch once, then cut each region out locally
+            mosaic_path = os.path.join(out_dir, "batches", f"{prefix}_batch{batch.id:03d}_{year}.tif")
+            nodata = NODATA if dtype == 'int16' else DIRECT_FLOAT_NODATA
+            if state is not None:
+                for region in todo:
+                    state.plan(unit_of(region))
+            try:
+                fetch_to_mosaic(ee_url_maker(image, grid, nodata), grid, fetch_plan, mosaic_path, nodata=nodata,
+                                metrics=metrics)
+            except FetchError as e:
+                # Requests still failing after their retries (e.g. compute limits): export instead
+                print(f"⚠️ Batch {batch.id:03d}: direct fetch failed ({e}); exporting its regions instead")
+                fetch_failed = True
+                plan_exports(batch, todo, image, planned_whole=True)
+                continue
+            except Exception as e:
+                print(f"❌ Batch {batch.id:03d}: {e}")
+                for region in todo:
+                    given_up(region, e)
+                continue
+            produced = 0
+            for region in todo:
+                region_start = time.time()
+                try:
+                    if state is not None:
+                        state.advance(unit_of(region), 'downloaded')
+                    path = cut_region(mosaic_path, region, out_path_for(region) + '.part')
+                    if dtype == 'int16':
+                        write_cog(path)
+                    os.replace(path, out_path_for(region))
+                    finished(region, out_path_for(region))
+                    produced += 1
+                except Exception as e:
+                    print(f"❌ {region.name or region.id}: {e}")
+                    given_up(region, e)
+                if metrics is not None:
+                    metrics.record('region', region.id, time.time() - region_start, batch=batch.id)
+            os.remove(mosaic_path)
+            seconds = time.time() - batch_start
+            if metrics is not None:
+                metrics.record('batch', f"batch{batch.id:03d}", seconds, regions=produced)
+            print(f"📦 Batch {batch.id:03d}: {produced} region(s) in {seconds / 60:.1f} min "
+                  f"({regions_per_hour(produced, seconds):.0f} regions/h)")
+        else:
+            plan_exports(batch, todo, image)
+
+    if exports:
+        _run_exports(exports, out_dir, drive_folder, dtype, max_tasks, metrics, state, drive_source,
+                     out_path_for, unit_of, finished, given_up)
+
+    seconds = time.time() - started
+    done_count = len(completed)
+    rate = regions_per_hour(done_count, seconds)
+    if metrics is not None:
+        metrics.record('batch_run', prefix, seconds, regions=done_count, failed=len(failed),
+                       regions_per_hour=round(rate, 1))
+    print(f"🏁 {done_count} region(s) done, {len(failed)} failed, {len(skipped)} skipped, "
+          f"in {seconds / 3600:.2f} h ({rate:.1f} regions/h)")
+    return {'completed': completed, 'failed': failed, 'skipped': skipped, 'seconds': seconds,
+            'regions_per_hour': rate}
+
+
+def _run_exports(exports, out_dir, drive_folder, dtype, max_tasks, metrics, state, drive_source,
+                 out_path_for, unit_of, finished, given_up):
+    """Export, download and mosaic every region's tiles, as ndvi.run does for one region."""
+    from cog import write_cog
+    from drive_download import DriveDownloader, PyDriveSource
+    from export_cache import MANIFEST_NAME, ExportManifest
+    from mosaic import OVERVIEW_LEVELS, TileAssembler
+    from pipeline import ExportPipeline
+    from scheduler import ExportScheduler
+
+    if drive_source is None:
+        from pydrive2.auth import GoogleAuth
+        from pydrive2.drive import GoogleDrive
+        gauth = GoogleAuth()
+        gauth.LocalWebserverAuth()
+        drive_source = PyDriveSource(GoogleDrive(gauth))
+
+    # Tile labels are "<region prefix>/tileNNNN", so the assembler's products are region prefixes
+    regions = {jobs[0].label.split('/')[0]: region for region, jobs in exports}
+    mosaics = {out_path_for(region) + '.part': region for region in regions.values()}
+
+    def mosaic_path_for(product):
+        return out_path_for(regions[product]) + '.part'
+
+    def finish_mosaic(path):
+        # Mosaics are built under .part and moved into place once they are COGs,
+        # so an output file on disk is always a finished one.
+        region = mosaics[path]
+        if dtype == 'int16':
+            write_cog(path)
+        os.replace(path, out_path_for(region))
+        finished(region, out_path_for(region))
+        return out_path_for(region)
+
+    def region_of(label):
+        return regions[label.split('/')[0]]
+
+    def advance(label, event):
+        if state is not None:
+            state.advance(unit_of(region_of(label)), event, part=label)
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = ExportManifest(os.path.join(out_dir, MANIFEST_NAME))
+    assembler = TileAssembler({product: len(jobs) for product, (_, jobs) in zip(regions, exports)},
+                              mosaic_path_for, manifest=manifest, on_mosaic=finish_mosaic,
+                              overviews=None if dtype == 'int16' else OVERVIEW_LEVELS)
+    pipeline = ExportPipeline(DriveDownloader(drive_source, metrics=metrics), drive_folder,
+                              lambda title: os.path.join(out_dir, "tiles", title), on_complete=assembler,
+                              manifest=manifest, metrics=metrics, on_event=advance)
+
+    def watch(job, task, key):
+        if task is None:
+            advance(job.label, 'downloaded')
+            assembler.add_cached(job.label, manifest.outputs(key))
+        else:
+            advance(job.label, 'submitted')
+            pipeline.add(task, job.label, job.file_prefix, key)
+
+    def replanned(job, children):
+        if state is not None:
+            state.split(unit_of(region_of(job.label)), job.label, [child.label for child in children])
+        assembler.split(job.label, [child.label for child in children])
+        pipeline.discard(job.label)
+
+    def failed(job, status):
+        if state is not None:
+            state.fail(unit_of(region_of(job.label)), status.get('error_message', status['state']), part=job.label)
+
+    scheduler = ExportScheduler(pipeline.monitor, max_tasks, manifest=manifest,
+                                on_submit=watch, on_split=replanned, on_failed=failed)
+    for _, jobs in exports:
+        for job in jobs:
+            scheduler.add(job)
+
+    print(f"📤 Submitting tile exports for {len(exports)} region(s); each is mosaicked once its tiles arrive...")
+    pipeline.run(wait=scheduler.run)
+    for product, (received, expected) in assembler.incomplete().items():
+        region = regions[product]
+        given_up(region, f"{received}/{expected} tiles received")
+
+
+if __name__ == '__main__':
+    import argparse
+    from monthly_store import SEASONS
+    from sensors import SENSORS
+
+    parser = argparse.ArgumentParser(description="Composite and export NDVI for many regions, sharing work per batch.")
+    parser.add_argument('layer', help="states, counties, tracts or a GeoJSON FeatureCollection path")
+    parser.add_argument('--year', type=int, required=True)
+    parser.add_argument('--out', required=True, help="local output directory")
+    parser.add_argument('--regions', nargs='+', help="region ids or names (default: every region in the layer)")
+    parser.add_argument('--sensor', choices=sorted(SENSORS), default='sentinel')
+    parser.add_argument('--season', choices=sorted(SEASONS), default='annual')
+    parser.add_argument('--index', default='NDVI')
+    parser.add_argument('--scale', type=float, help="meters (default: the sensor's native resolution)")
+    parser.add_argument('--dtype', choices=['int16', 'float32'], default='int16')
+    parser.add_argument('--transport', choices=['auto', 'direct', 'export'], default='auto')
+    parser.add_argument('--max-batch-pixels', type=float, default=BATCH_MAX_PIXELS)
+    parser.add_argument('--max-batch-regions', type=int, default=BATCH_MAX_REGIONS)
+    parser.add_argument('--cache-dir', default='geometry_cache', help="zone layer cache directory")
+    parser.add_argument('--tolerance', type=float, help="boundary simplification in meters (default: the scale)")
+    parser.add_argument('--id-field', default='id', help="region id property of a GeoJSON layer")
+    parser.add_argument('--name-field', default='name', help="region name property of a GeoJSON layer")
+    parser.add_argument('--drive-folder')
+    parser.add_argument('--project', default=DEFAULT_PROJECT, help="Earth Engine cloud project")
+    parser.add_argument('--dry-run', action='store_true', help="print the batches and exit")
+    args = parser.parse_args()
+
+    scale = args.scale or SENSORS[args.sensor]['scale']
+    tolerance = args.tolerance or scale
+    if not args.dry_run or not (os.path.exists(args.layer) or _layer_cached(args.layer, args.cache_dir, tolerance)):
+        import ee
+        ee.Initialize(project=args.project)   # TIGER layers are fetched once, then cached
+    regions = load_regions(args.layer, args.cache_dir, tolerance, args.regions, args.id_field, args.name_field)
+    batches = plan_batches(regions, scale, args.max_batch_pixels, args.max_batch_regions)
+    print_batches(batches, scale)
+    if not args.dry_run:
+        from metrics import RunMetrics
+        from state_store import STATE_DB_NAME, StateStore
+        metrics = RunMetrics(os.path.join(args.out, "metrics", "run_metrics.jsonl"))
+        state = StateStore(os.path.join(args.out, STATE_DB_NAME))
+        result = run_batches(batches, args.out, args.year, args.sensor, args.season, args.index.upper(), scale,
+                             args.dtype, args.transport, args.drive_folder, metrics=metrics, state=state)
+        state.report(args.sensor)
+        metrics.write_prometheus(os.path.join(args.out, "metrics", "ndvi_batch.prom"))
+        metrics.report()
+        raise SystemExit(1 if result['failed'] else 0)
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from direct_fetch import MAX_CONNECTIONS, choose_transport, fetch_tiles
+from drive_download import CHUNK_SIZE, DriveDownloader
+from fake_services import FakeDrive, FakeGoogleDrive, FakeTaskService, ScaledClock
+from metrics import RunMetrics
+from ndvi import MAX_CONCURRENT_TASKS
+from pipeline import ExportPipeline
+from scheduler import ExportJob, ExportScheduler, tile_jobs
+from task_monitor import TERMINAL_STATES, TaskMonitor
+from tiling import METERS_PER_DEGREE, TILE_PIXEL_BUDGET, grid_for_bounds, plan_tiles
+
+# ---------------------------------------------------------------------
+# Offline end-to-end benchmark
+#
+# Replays each workflow against the simulated Earth Engine and Drive in
+# fake_services, twice: once the way the original scripts ran (submit
+# everything, poll each task every 30 s, then download serially with
+# GetContentFile) and once the way the current scripts run: transport
+# chosen by direct_fetch.choose_transport, exports planned with the
+# scripts' tile budget and submitted through scheduler.ExportScheduler,
+# downloads pipelined through the task monitor and downloader. Reports
+# wall-clock time, API calls and bytes moved, so scheduling and I/O
+# changes get regression numbers without quota. Keep replay_current in
+# step with the scripts whenever their export path changes.
+#
+# Direct pixel fetches are modelled rather than served: each request
+# costs `direct_latency` plus its compute and transfer time, over
+# MAX_CONNECTIONS parallel connections.
+#
+# Times are simulated seconds. The run really sleeps, compressed by
+# --scale, so concurrent stages overlap as they would live.
+# ---------------------------------------------------------------------
+
+# Service model; override with --model '{"max_running": 2}'
+MODEL = {
+    'max_running': 4,             # concurrent batch tasks per project
+    'startup_delay': 60,          # queue -> RUNNING, seconds
+    'task_overhead': 120,         # fixed seconds per export task
+    'pixels_per_second': 2e6,     # server compute per task
+    'api_latency': 0.3,           # seconds per Earth Engine API call
+    'failure_rate': 0.0,          # fraction of export tasks that fail
+    'drive_latency': 0.2,         # seconds per Drive request
+    'drive_bandwidth': 25e6,      # bytes/second per download stream
+    'read_failure_rate': 0.0,     # fraction of Drive reads that fail
+    'bytes_per_pixel_band': 2.4,  # float32 after GeoTIFF compression
+    'int16_bytes_per_pixel_band': 1.2,  # scaled int16 (cog.export_options)
+    'direct_latency': 1.0,        # seconds per getDownloadURL request
+    'direct_pixels_per_second': 2e6,  # server compute per direct request
+    'local_bytes_per_second': 100e6,  # post-processing rate
+}
+BYTE_SCALE = 100000   # each stored fake byte stands for this many bytes
+
+CONUS_BOUNDS = (-125.0, 24.0, -66.0, 50.0)
+MA_BOUNDS = (-73.5, 41.2, -69.9, 42.9)
+YEARS = range(2020, 2024)
+ANNUAL = {'bands': 1, 'compute': 1.0}
+JJA = {'bands': 1, 'compute': 0.25}
+INT16 = {'dtype': 'int16'}   # the scripts' default OUTPUT_DTYPE
+
+# Each workflow: exports as the original script made them, and as the
+# current script makes them. An export is (description, prefix, image,
+# bounds, scale, tiled) where image gives the output band count, the
+# server compute relative to one full-year composite and the dtype
+# (float32 unless given). `transport` is the current script's
+# TRANSPORT: 'auto' lets choose_transport fetch small regions directly.
+WORKFLOWS = {
+    'modis': {
+        'download': True,
+        'legacy': [(f"MODIS_NDVI_{s}_{y}", f"modis_ndvi_{s.lower()}_{y}_us",
+                    {'bands': 1, 'compute': c}, CONUS_BOUNDS, 250, False)
+                   for y in YEARS for s, c in (('Annual', 1.0), ('JJA', 0.25))],
+        'current': [(f"MODIS_NDVI_Monthly_{y}", f"modis_monthly_{y}",
+                     dict(INT16, bands=24, compute=1.0), CONUS_BOUNDS, 250, False)
+                    for y in YEARS],
+    },
+    'landsat_annual': {
+        'download': True,
+        'legacy': [(f"{m}_{y}_US", f"{m.lower()}_{y}_us", ANNUAL, CONUS_BOUNDS, 30, False)
+                   for y in YEARS for m in ('NDVI', 'NDBI')],
+        'current': [(f"{m}_{y}_US", f"{m.lower()}_{y}_us", dict(ANNUAL, **INT16), CONUS_BOUNDS, 30, True)
+                    for y in YEARS for m in ('NDVI', 'NDBI')],
+    },
+    'landsat_jja': {
+        'download': True,
+        'legacy': [(f"NDVI_JJA_{y}_US", f"ndvi_jja_{y}_us", JJA, CONUS_BOUNDS, 30, False) for y in YEARS],
+        'current': [(f"NDVI_JJA_{y}_US", f"ndvi_jja_{y}_us", dict(JJA, **INT16), CONUS_BOUNDS, 30, True)
+                    for y in YEARS],
+    },
+    'sentinel_state': {
+        'download': False,
+        'transport': 'auto',
+        'legacy': [("NDVI_Massachusetts_2020", "ndvi_s2_massachusetts_2020", ANNUAL, MA_BOUNDS, 10, False)],
+        'current': [("NDVI_Massachusetts_2020", "ndvi_s2_massachusetts_2020", dict(ANNUAL, **INT16),
+                     MA_BOUNDS, 10, True)],
+    },
+}
+
+
+def export_pixels(config):
+    """Pixel count of a fake export from its region bounds and scale or crsTransform."""
+    west, south, east, north = config['region']
+    if 'crsTransform' in config:
+        res = config['crsTransform'][0]
+    else:
+        res = config['scale'] / METERS_PER_DEGREE
+    return int(round((east - west) / res)) * int(round((north - south) / res))
+
+
+def pixel_bytes(image, model):
+    """Modelled bytes per pixel and band of an export of `image`."""
+    if image.get('dtype') == 'int16':
+        return model['int16_bytes_per_pixel_band']
+    return model['bytes_per_pixel_band']
+
+
+def make_services(model, clock):
+    drive = FakeDrive(clock=clock, latency=model['drive_latency'], bandwidth=model['drive_bandwidth'],
+                      byte_scale=BYTE_SCALE, read_failure_rate=model['read_failure_rate'])
+
+    def duration(config):
+        pixels = export_pixels(config) * config['image']['compute']
+        return model['task_overhead'] + pixels / model['pixels_per_second']
+
+    def output_bytes(config):
+        modeled = export_pixels(config) * config['image']['bands'] * pixel_bytes(config['image'], model)
+        return max(1, int(modeled / BYTE_SCALE))
+
+    tasks = FakeTaskService(clock=clock, durations=duration, drive=drive, output_bytes=output_bytes,
+                            max_running=model['max_running'], startup_delay=model['startup_delay'],
+                            api_latency=model['api_latency'], failure_rate=model['failure_rate'])
+    return tasks, drive
+
+
+def replay_legacy(workflow, tasks, drive, clock, workdir, folder):
+    """The original scripts: submit all, poll every task every 30 s, then download serially."""
+    submitted = []
+    for description, prefix, image, bounds, scale, _ in workflow['legacy']:
+        task = tasks.export_image_to_drive(image=image, description=description, folder=folder,
+                                           fileNamePrefix=prefix, region=list(bounds), scale=scale)
+        task.start()
+        submitted.append(task)
+
+    while True:
+        states = [task.status()['state'] for task in submitted]
+        if all(s in TERMINAL_STATES for s in states):
+            break
+        clock.sleep(30)
+
+    if workflow['download']:
+        gdrive = FakeGoogleDrive(drive)
+        folder_list = gdrive.ListFile({
+            'q': f"title='{folder}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
+        }).GetList()
+        if folder_list:
+            for file in gdrive.ListFile({'q': f"'{folder_list[0]['id']}' in parents and trashed=false"}).GetList():
+                file.GetContentFile(os.path.join(workdir, file['title']))
+                file.Delete()
+    return states
+
+
+def replay_direct(image, tiles, clock, model):
+    """Modelled direct_fetch.fetch_to_mosaic: one request per tile over MAX_CONNECTIONS connections."""
+    def fetch(tile):
+        pixels = tile.width * tile.height
+        size = pixels * image['bands'] * pixel_bytes(image, model)
+        clock.sleep(model['direct_latency'] + pixels * image['compute'] / model['direct_pixels_per_second']
+                    + size / model['drive_bandwidth'])
+        return size
+
+    with ThreadPoolExecutor(max_workers=MAX_CONNECTIONS) as pool:
+        return sum(pool.map(fetch, tiles))
+
+
+def replay_current(workflow, tasks, drive, clock, workdir, folder, model, metrics=None):
+    """The current scripts: transport choice, scheduled (tiled) exports, pipelined downloads.
+
+    Returns (states, bytes fetched directly, direct requests).
+    """
+    monitor = TaskMonitor(list_tasks=tasks.list_tasks, sleep=clock.sleep, verbose=False, metrics=metrics)
+
+    def postprocess(label, path):
+        clock.sleep(os.path.getsize(path) * BYTE_SCALE / model['local_bytes_per_second'])
+
+    downloader = DriveDownloader(drive, chunk_size=max(1, CHUNK_SIZE // BYTE_SCALE),
+                                 sleep=clock.sleep, verbose=False, metrics=metrics)
+    pipeline = ExportPipeline(downloader, folder, lambda title: os.path.join(workdir, title),
+                              postprocess=postprocess, monitor=monitor, sleep=clock.sleep,
+                              metrics=metrics)
+
+    def watch(job, task, key):
+        # Submit-only workflows just watch their tasks, as the Sentinel script does.
+        if task is not None and workflow['download']:
+            pipeline.add(task, job.label, job.file_prefix, key)
+
+    scheduler = ExportScheduler(monitor, MAX_CONCURRENT_TASKS, export=tasks.export_image_to_drive,
+                                task_state=tasks.task_state, on_submit=watch,
+                                on_split=lambda job, children: pipeline.discard(job.label),
+                                clock=clock.time, sleep=clock.sleep)
+    states, direct_bytes, requests = [], 0, 0
+    for description, prefix, image, bounds, scale, tiled in workflow['current']:
+        grid = grid_for_bounds(bounds, scale)
+        if workflow.get('transport') == 'auto' and choose_transport(fetch_tiles(grid)) == 'direct':
+            fetch_plan = fetch_tiles(grid)
+            direct_bytes += replay_direct(image, fetch_plan, clock, model)
+            requests += len(fetch_plan)
+            states.append('COMPLETED')
+            continue
+        params = dict(folder=folder)
+        if tiled:
+            for job in tile_jobs(image, grid, plan_tiles(grid, TILE_PIXEL_BUDGET), description, prefix, params):
+                scheduler.add(job)
+        else:
+            scheduler.add(ExportJob(image, prefix, prefix,
+                                    dict(params, description=description, region=list(bounds), scale=scale)))
+
+    if workflow['download']:
+        results = pipeline.run(wait=scheduler.run)
+        states += [r['export'] for r in results.values()]
+    else:
+        outcome = scheduler.run()
+        states += ['COMPLETED'] * len(outcome['completed']) + [status['state'] for _, status in outcome['failed']]
+    return states, direct_bytes, requests
+
+
+def run_benchmark(name, mode, model=MODEL, scale=1e-3, metrics_dir=None):
+    clock = ScaledClock(scale)
+    metrics = None
+    if metrics_dir and mode == 'current':
+        metrics = RunMetrics(os.path.join(metrics_dir, f"{name}.jsonl"), clock=clock.time, run_id=name)
+    tasks, drive = make_services(model, clock)
+    workflow = WORKFLOWS[name]
+    folder = f"bench_{name}"
+    drive.folders[folder] = 'folder1'
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    real_start = time.monotonic()
+    try:
+        if mode == 'legacy':
+            states, direct_bytes, requests = replay_legacy(workflow, tasks, drive, clock, workdir, folder), 0, 0
+        else:
+            states, direct_bytes, requests = replay_current(workflow, tasks, drive, clock, workdir, folder,
+                                                            model, metrics)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if metrics is not None:
+        metrics.write_prometheus(os.path.join(metrics_dir, f"{name}.prom"))
+        metrics.report()
+    return {
+        'workflow': name,
+        'mode': mode,
+        'wall_clock_s': round(clock.time()),
+        'real_s': round(time.monotonic() - real_start, 2),
+        'exports': len(states),
+        'failed': sum(1 for s in states if s != 'COMPLETED'),
+        'ee_calls': dict(tasks.calls, download_url=requests),
+        'drive_calls': dict(drive.calls),
+        'bytes_moved': drive.bytes_served * BYTE_SCALE + direct_bytes,
+    }
+
+
+def print_report(rows):
+    print(f"{'workflow':<16}{'mode':<9}{'wall clock':>12}{'exports':>9}{'EE calls':>10}"
+          f"{'Drive calls':>13}{'GB moved':>10}")
+    for r in rows:
+        hours = r['wall_clock_s'] / 3600
+        print(f"{r['workflow']:<16}{r['mode']:<9}{hours:>10.2f} h{r['exports']:>9}"
+              f"{sum(r['ee_calls'].values()):>10}{sum(r['drive_calls'].values()):>13}"
+              f"{r['bytes_moved'] / 1e9:>10.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the NDVI export workflows.")
+    parser.add_argument('--workflow', choices=sorted(WORKFLOWS), action='append',
+                        help="workflow(s) to run; default all")
+    parser.add_argument('--mode', choices=['legacy', 'current'], action='append',
+                        help="replay mode(s); default both")
+    parser.add_argument('--scale', type=float, default=1e-3,
+                        help="real seconds per simulated second (default 1e-3)")
+    parser.add_argument('--model', type=json.loads, default={},
+                        help="JSON overrides for the service model")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--metrics', help="write per-stage metrics of the current replays to this directory")
+    args = parser.parse_args(argv)
+
+    model = dict(MODEL, **args.model)
+    rows = [run_benchmark(name, mode, model, args.scale, args.metrics)
+            for name in (args.workflow or sorted(WORKFLOWS))
+            for mode in (args.mode or ['legacy', 'current'])]
+    print_report(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=1)
+    return rows
+
+
+if __name__ == '__main__':
+    main()
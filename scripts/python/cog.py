@@ -0,0 +1,177 @@
+import os
+
+# ---------------------------------------------------------------------
+# Scaled-int16 Cloud-Optimized GeoTIFF output
+#
+# NDVI and NDBI lie in [-1, 1], so storing them as float32 spends twice
+# the bytes they need. Stored as int16 with a 0.0001 scale (the MODIS
+# convention) they keep four decimal places, and an explicit nodata
+# value replaces NaN. Earth Engine can write that directly
+# (to_scaled_int16 + export_options); files built locally are converted
+# with write_cog, which also records the scale/offset in the GeoTIFF so
+# readers that honour it (GDAL, rasterio, QGIS) see the original values.
+# The COG layout -- internal tiles, compression, overviews after the
+# full-resolution data -- keeps windowed and zoomed-out reads cheap.
+# ---------------------------------------------------------------------
+SCALE = 0.0001
+OFFSET = 0.0
+NODATA = -32768
+INT16_MAX = 32767
+COG_OPTIONS = {
+    'compress': 'deflate',
+    'predictor': 'yes',
+    'blocksize': 512,
+    'overview_resampling': 'average',
+    'bigtiff': 'if_safer',
+}
+BLOCK_SIZE = 1024
+
+
+def export_options(dtype='int16', nodata=True):
+    """Extra Export.image.toDrive arguments for an output dtype ('int16' or 'float32').
+
+    Exports are written as COGs; int16 ones also mark masked pixels with
+    NODATA unless `nodata` is False (e.g. for sum/count stacks).
+    """
+    options = {'fileFormat': 'GeoTIFF', 'formatOptions': {'cloudOptimized': True}}
+    if dtype == 'int16' and nodata:
+        options['formatOptions']['noData'] = NODATA
+    return options
+
+
+def to_scaled_int16(image, scale=SCALE, offset=OFFSET):
+    """Server-side: store round((value - offset) / scale) as int16; masked pixels stay masked."""
+    return image.subtract(offset).divide(scale).round() \
+        .clamp(-INT16_MAX, INT16_MAX).toInt16()
+
+
+def quantize(data, scale=SCALE, offset=OFFSET, nodata=NODATA):
+    """Local counterpart of to_scaled_int16 for a (masked) float array; NaN becomes nodata."""
+    import numpy as np
+
+    values = np.ma.masked_invalid(np.ma.asarray(data, dtype='float64'))
+    scaled = np.clip(np.rint((values.filled(0) - offset) / scale), -INT16_MAX, INT16_MAX)
+    out = scaled.astype('int16')
+    out[np.ma.getmaskarray(values)] = nodata
+    return out
+
+
+def _to_cog(src_path, out_path):
+    from rasterio.shutil import copy as rio_copy
+
+    tmp_path = out_path + '.cog.tmp'
+    rio_copy(src_path, tmp_path, driver='COG', **COG_OPTIONS)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def write_cog(src_path, out_path=None, scale=SCALE, offset=OFFSET, nodata=NODATA, block_size=BLOCK_SIZE):
+    """Rewrite a single-band index raster as a scaled-int16 COG (in place if `out_path` is None).
+
+    Float input is quantized block by block. Integer input is taken to be
+    in stored units already (e.g. an int16 Earth Engine export) and only
+    gains the scale/offset tags and the COG layout.
+    """
+    import numpy as np
+    import rasterio
+    from local_composite import block_windows
+
+    out_path = out_path or src_path
+    with rasterio.open(src_path) as src:
+        is_float = np.issubdtype(np.dtype(src.dtypes[0]), np.floating)
+        profile = src.profile.copy()
+    profile.update(driver='GTiff', dtype='int16', nodata=nodata, tiled=True,
+                   blockxsize=256, blockysize=256, compress='deflate', predictor=2)
+    profile.pop('photometric', None)
+
+    staged = out_path + '.int16.tmp'
+    with rasterio.open(src_path) as src, rasterio.open(staged, 'w', **profile) as dst:
+        for window in block_windows(src.width, src.height, block_size):
+            data = src.read(window=window, masked=True)
+            if is_float:
+                data = quantize(data, scale, offset, nodata)
+            else:
+                data = data.astype('int16').filled(nodata)
+            dst.write(data, window=window)
+        dst.scales = [scale] * src.count
+        dst.offsets = [offset] * src.count
+    try:
+        return _to_cog(staged, out_path)
+    finally:
+        if os.path.exists(staged):
+            os.remove(staged)
+
+
+def read_scaled(src, band=1, window=None):
+    """Read a band as float32 with scale/offset applied and nodata masked."""
+    data = src.read(band, window=window, masked=True).astype('float32')
+    return data * src.scales[band - 1] + src.offsets[band - 1]
+
+
+# ---------------------------------------------------------------------
+# Validation
+# ---------------------------------------------------------------------
+def cog_info(path):
+    """Layout facts about a GeoTIFF: dtype, nodata, scale/offset, block shape, overviews."""
+    import rasterio
+
+    with rasterio.open(path) as src:
+        return {
+            'dtype': src.dtypes[0],
+            'nodata': src.nodata,
+            'scale': src.scales[0],
+            'offset': src.offsets[0],
+            'block_shape': src.block_shapes[0],
+            'overviews': src.overviews(1),
+            'layout': src.tags(ns='IMAGE_STRUCTURE').get('LAYOUT'),
+            'compression': src.compression.value if src.compression else None,
+        }
+
+
+def validate_roundtrip(reference_path, cog_path, tolerance=None, block_size=BLOCK_SIZE):
+    """Compare a scaled-int16 COG against the float raster it was made from.
+
+    Checks that every valid reference pixel decodes to within
+    `tolerance` (default half a quantization step), that nodata falls on
+    exactly the same pixels, and that the file has the COG layout (with
+    overviews, when it is larger than one block). Returns a dict of the findings with an overall 'ok'.
+    """
+    import numpy as np
+    import rasterio
+    from local_composite import block_windows
+
+    info = cog_info(cog_path)
+    tolerance = info['scale'] / 2 + 1e-6 if tolerance is None else tolerance
+    max_error = 0.0
+    mask_mismatches = 0
+    pixels = 0
+    with rasterio.open(reference_path) as ref, rasterio.open(cog_path) as cog:
+        if (ref.width, ref.height) != (cog.width, cog.height) or ref.transform != cog.transform:
+            raise ValueError(f"{cog_path} is not on the same grid as {reference_path}")
+        for window in block_windows(ref.width, ref.height, block_size):
+            expected = np.ma.masked_invalid(ref.read(1, window=window, masked=True).astype('float64'))
+            decoded = read_scaled(cog, 1, window)
+            expected_mask = np.ma.getmaskarray(expected)
+            decoded_mask = np.ma.getmaskarray(decoded)
+            mask_mismatches += int((expected_mask != decoded_mask).sum())
+            both = ~expected_mask & ~decoded_mask
+            pixels += int(both.sum())
+            if both.any():
+                error = np.abs(expected.data[both] - decoded.data[both].astype('float64'))
+                max_error = max(max_error, float(error.max()))
+        # GDAL builds no overviews for a raster that fits in one block.
+        needs_overviews = max(cog.width, cog.height) > max(info['block_shape'])
+    ok = (max_error <= tolerance and mask_mismatches == 0 and info['dtype'] == 'int16'
+          and info['layout'] == 'COG' and (bool(info['overviews']) or not needs_overviews))
+    return dict(info, ok=ok, max_error=max_error, tolerance=tolerance,
+                mask_mismatches=mask_mismatches, pixels=pixels)
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        sys.exit("usage: python cog.py <reference float raster> <scaled-int16 COG>")
+    result = validate_roundtrip(sys.argv[1], sys.argv[2])
+    for k, v in result.items():
+        print(f"{k}: {v}")
+    sys.exit(0 if result['ok'] else 1)
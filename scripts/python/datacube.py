@@ -0,0 +1,181 @@
+import threading
+
+# ---------------------------------------------------------------------
+# Chunked NDVI time-series datacube
+#
+# Each downloaded annual/seasonal raster is a separate GeoTIFF, so a
+# per-pixel time-series question opens and decodes every file. The cube
+# appends each raster as one time step of a compressed Zarr array per
+# product (e.g. "landsat/ndvi_annual"), shaped (time, y, x). Chunks span
+# TIME_CHUNK steps by a 256 x 256 pixel tile, so a pixel's full history
+# is one or two chunk reads and a regional slab touches only the tiles
+# it covers. Values are kept as scaled int16 (see cog.py); reads are
+# lazy and return floats with nodata masked.
+# ---------------------------------------------------------------------
+TIME_CHUNK = 8
+SPATIAL_CHUNK = 256
+BLOCK_SIZE = 1024   # pixels per side read from a raster per append step
+
+
+def _compressor():
+    from zarr.codecs import BloscCodec
+    return BloscCodec(cname='zstd', clevel=5, shuffle='bitshuffle')
+
+
+class Datacube:
+    """Zarr store at `root` holding one (time, y, x) int16 array per product.
+
+    Every raster appended to a product must share its grid (CRS,
+    transform and shape). Time steps are labelled ("2020", "2021-JJA",
+    ...) and returned in label order; re-appending a label overwrites
+    that step, so ingest can be re-run safely.
+    """
+
+    def __init__(self, root):
+        import zarr
+        self.root = root
+        self.group = zarr.open_group(root, mode='a')
+        self._lock = threading.Lock()
+
+    def products(self):
+        names = []
+
+        def walk(group, prefix):
+            for name, _ in group.arrays():
+                names.append(prefix + name)
+            for name, sub in group.groups():
+                walk(sub, f"{prefix}{name}/")
+        walk(self.group, '')
+        return sorted(names)
+
+    def array(self, product):
+        """The underlying zarr array: indexing it reads only the chunks touched."""
+        return self.group[product]
+
+    def times(self, product):
+        return list(self.array(product).attrs['times']) if product in self.group else []
+
+    def _create(self, product, src):
+        from cog import NODATA, OFFSET, SCALE
+
+        scale = src.scales[0] if src.dtypes[0] == 'int16' else SCALE
+        offset = src.offsets[0] if src.dtypes[0] == 'int16' else OFFSET
+        return self.group.create_array(
+            product, shape=(0, src.height, src.width), dtype='int16',
+            chunks=(TIME_CHUNK, SPATIAL_CHUNK, SPATIAL_CHUNK),
+            compressors=_compressor(), fill_value=NODATA,
+            dimension_names=('time', 'y', 'x'),
+            attributes={'times': [], 'crs': src.crs.to_wkt(), 'transform': list(src.transform)[:6],
+                        'scale': scale, 'offset': offset, 'nodata': NODATA})
+
+    def append(self, product, label, raster_path, block_size=BLOCK_SIZE):
+        """Add (or replace) time step `label` of `product` from a single-band raster."""
+        import numpy as np
+        import rasterio
+        from cog import NODATA, quantize
+        from local_composite import block_windows
+
+        with rasterio.open(raster_path) as src:
+            with self._lock:
+                arr = self.group[product] if product in self.group else self._create(product, src)
+                attrs = arr.attrs.asdict()
+                if (arr.shape[1:] != (src.height, src.width)
+                        or not np.allclose(attrs['transform'], list(src.transform)[:6])):
+                    raise ValueError(f"{raster_path} is not on the grid of datacube product '{product}'")
+                times = list(attrs['times'])
+                if label in times:
+                    t = times.index(label)
+                else:
+                    t = len(times)
+                    arr.resize((t + 1,) + arr.shape[1:])
+                    times.append(label)
+                # Align reads to whole chunks so each chunk is written once.
+                block = max(SPATIAL_CHUNK, block_size // SPATIAL_CHUNK * SPATIAL_CHUNK)
+                is_int = src.dtypes[0] == 'int16'
+                for window in block_windows(src.width, src.height, block):
+                    data = src.read(1, window=window, masked=True)
+                    if is_int:
+                        data = data.filled(NODATA)
+                    else:
+                        data = quantize(data, attrs['scale'], attrs['offset'], NODATA)
+                    r, c = int(window.row_off), int(window.col_off)
+                    arr[t, r:r + data.shape[0], c:c + data.shape[1]] = data
+                arr.attrs['times'] = times
+        print(f"🧊 {product}: added {label} from {raster_path}")
+        return t
+
+    # -----------------------------------------------------------------
+    # Reads
+    # -----------------------------------------------------------------
+    def _decode(self, arr, data):
+        import numpy as np
+        masked = np.ma.masked_equal(data, arr.attrs['nodata'])
+        return masked.astype('float32') * arr.attrs['scale'] + arr.attrs['offset']
+
+    def _order(self, product, times=None):
+        labels = self.times(product)
+        wanted = sorted(labels) if times is None else list(times)
+        return wanted, [labels.index(t) for t in wanted]
+
+    def rowcol(self, product, x, y):
+        """Row/column of map coordinates (x, y) in the product's grid; ValueError outside it."""
+        import math
+        from affine import Affine
+        arr = self.array(product)
+        col, row = ~Affine(*arr.attrs['transform']) * (x, y)
+        row, col = math.floor(row), math.floor(col)
+        height, width = arr.shape[1:]
+        if not (0 <= row < height and 0 <= col < width):
+            raise ValueError(f"({x}, {y}) is outside the {product} grid")
+        return row, col
+
+    def pixel_series(self, product, x, y, times=None):
+        """(labels, masked float values) of one pixel through time, by map coordinates."""
+        row, col = self.rowcol(product, x, y)
+        arr = self.array(product)
+        labels, idx = self._order(product, times)
+        column = arr[:, row, col]
+        return labels, self._decode(arr, column[idx])
+
+    def slab(self, product, window, times=None):
+        """(labels, masked float array (time, rows, cols)) for a rasterio-style window."""
+        arr = self.array(product)
+        labels, idx = self._order(product, times)
+        r, c = int(window.row_off), int(window.col_off)
+        h, w = int(window.height), int(window.width)
+        data = arr.get_orthogonal_selection((idx, slice(r, r + h), slice(c, c + w)))
+        return labels, self._decode(arr, data)
+
+    def slab_bounds(self, product, bounds, times=None):
+        """Like slab, for (west, south, east, north) map bounds; edges are pixel-exclusive."""
+        import math
+        from affine import Affine
+        from rasterio import windows
+        arr = self.array(product)
+        w = windows.from_bounds(*bounds, transform=Affine(*arr.attrs['transform']))
+        height, width = arr.shape[1:]
+        # Tolerate float noise so bounds on pixel edges don't pick up an extra row/column.
+        r0 = max(math.floor(w.row_off + 1e-6), 0)
+        c0 = max(math.floor(w.col_off + 1e-6), 0)
+        r1 = min(math.ceil(w.row_off + w.height - 1e-6), height)
+        c1 = min(math.ceil(w.col_off + w.width - 1e-6), width)
+        return self.slab(product, windows.Window(c0, r0, max(c1 - c0, 0), max(r1 - r0, 0)), times)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect an NDVI datacube.")
+    parser.add_argument('root')
+    parser.add_argument('product', nargs='?')
+    parser.add_argument('--point', nargs=2, type=float, metavar=('X', 'Y'),
+                        help="print the time series at these map coordinates")
+    args = parser.parse_args()
+    cube = Datacube(args.root)
+    if args.product is None:
+        for product in cube.products():
+            print(f"{product}: {cube.array(product).shape} {cube.times(product)}")
+    elif args.point:
+        for label, value in zip(*cube.pixel_series(args.product, *args.point)):
+            print(f"{label}\t{value}")
+    else:
+        print(cube.array(args.product).info)
@@ -0,0 +1,226 @@
+import http.client
+import math
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from tiling import plan_tiles
+
+# ---------------------------------------------------------------------
+# Direct pixel fetch for small regions
+#
+# For a state-sized job most of the wall time is the batch-export queue
+# and the Drive round-trip, not compute. Earth Engine also serves pixels
+# synchronously: image.getDownloadURL returns a GeoTIFF URL for a small
+# grid-aligned request. This transport cuts the region into
+# FETCH_TILE_SIZE tiles on the shared grid, fetches them in parallel
+# over a bounded pool of keep-alive connections, and writes each one
+# straight into its window of a local mosaic -- no task, no Drive.
+# Requests are limited in size (tens of MB) and count against the
+# interactive quota, and each one computes its composite (e.g. a year
+# of Sentinel-2 scenes) under the interactive compute and time limits.
+# choose_transport therefore only picks this path up to
+# DIRECT_MAX_PIXELS -- about 24 requests, a county at 10 m or a small
+# state at 30 m; Massachusetts at 10 m (~7.6e8 pixels) is exported.
+# Callers fall back to batch export when requests still fail after
+# their retries (fetch_to_mosaic raises FetchError).
+#
+# Anything that maps a tile to a GeoTIFF URL works as `url_for`, e.g.
+# fake_services.FakePixelServer for offline runs.
+# ---------------------------------------------------------------------
+DIRECT_MAX_PIXELS = 1e8     # ~24 FETCH_TILE_SIZE requests
+FETCH_TILE_SIZE = 2048      # pixels per side; a float32 tile is 16 MB
+MAX_CONNECTIONS = 8
+MAX_RETRIES = 4
+RETRY_DELAY = 2
+RETRY_STATUS = (429, 500, 502, 503, 504)
+TIMEOUT = 300
+
+
+class FetchError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class ConnectionPool:
+    """At most `max_connections` HTTP(S) connections, kept alive and reused across requests."""
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, timeout=TIMEOUT):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._idle = {}   # (scheme, netloc) -> queue of open connections
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def _idle_queue(self, origin):
+        with self._lock:
+            return self._idle.setdefault(origin, queue.LifoQueue())
+
+    def _connect(self, scheme, netloc):
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        with self._lock:
+            self.opened += 1
+        return cls(netloc, timeout=self.timeout)
+
+    def get(self, url):
+        """GET `url` and return the body; raises FetchError on a non-200 response."""
+        parts = urlsplit(url)
+        origin = (parts.scheme, parts.netloc)
+        path = parts.path + (f"?{parts.query}" if parts.query else '')
+        idle = self._idle_queue(origin)
+        with self._slots:
+            try:
+                conn = idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect(*origin)
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                body = response.read()
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                idle.put(conn)
+        if response.status != 200:
+            raise FetchError(f"HTTP {response.status}: {body[:200]!r}", response.status)
+        return body
+
+    def close(self):
+        with self._lock:
+            queues = list(self._idle.values())
+        for idle in queues:
+            while not idle.empty():
+                idle.get_nowait().close()
+
+
+def choose_transport(tiles, max_pixels=DIRECT_MAX_PIXELS):
+    """'direct' when the tiles add up to at most `max_pixels`, else 'export'."""
+    return 'direct' if sum(t.width * t.height for t in tiles) <= max_pixels else 'export'
+
+
+def fetch_tiles(grid, intersects=None, tile_size=FETCH_TILE_SIZE):
+    """Request-sized tiles on `grid` (see tiling.plan_tiles)."""
+    return plan_tiles(grid, tile_size * tile_size, intersects=intersects)
+
+
+def ee_url_maker(image, grid, nodata=None):
+    """Build `url_for(tile)` returning a getDownloadURL GeoTIFF URL pinned to the tile's pixels.
+
+    Masked pixels are filled with `nodata` server-side, since downloaded
+    GeoTIFFs carry no mask.
+    """
+    if nodata is not None:
+        image = image.unmask(nodata, False)
+
+    def url_for(tile):
+        west, _, _, north = tile.bounds
+        return image.getDownloadURL({
+            'crs': grid.crs,
+            'crs_transform': [grid.res, 0, west, 0, -grid.res, north],
+            'dimensions': f"{tile.width}x{tile.height}",
+            'format': 'GEO_TIFF',
+            'filePerBand': False,
+        })
+
+    return url_for
+
+
+def fetch_to_mosaic(url_for, grid, tiles, out_path, nodata=None, max_connections=MAX_CONNECTIONS,
+                    max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY, sleep=time.sleep, metrics=None,
+                    pool=None):
+    """Fetch every tile and write it into one GeoTIFF covering them; returns (out_path, stats).
+
+    The mosaic spans the tiles' union on `grid` and takes its dtype and
+    band count from the first tile to arrive; pixels of tiles not
+    fetched (e.g. outside the region) are `nodata`. Failed requests are
+    retried with exponential backoff for throttling and server errors.
+    """
+    import rasterio
+    from rasterio.io import MemoryFile
+    from rasterio.windows import Window
+    from cog import NODATA
+
+    col0 = min(t.col_off for t in tiles)
+    row0 = min(t.row_off for t in tiles)
+    width = max(t.col_off + t.width for t in tiles) - col0
+    height = max(t.row_off + t.height for t in tiles) - row0
+    transform = rasterio.Affine(grid.res, 0, grid.x0 + col0 * grid.res,
+                                0, -grid.res, grid.y0 - row0 * grid.res)
+    pool = pool or ConnectionPool(max_connections)
+    lock = threading.Lock()
+    state = {'dst': None}
+    stats = {'tiles': 0, 'bytes': 0, 'retries': 0, 'failed': []}
+    tmp_path = out_path + '.part'
+
+    def open_output(src):
+        fill = nodata
+        if fill is None:
+            fill = src.nodata if src.nodata is not None else (
+                NODATA if src.dtypes[0] == 'int16' else math.nan)
+        profile = dict(driver='GTiff', width=width, height=height, count=src.count, dtype=src.dtypes[0],
+                       crs=src.crs or grid.crs, transform=transform, nodata=fill, tiled=True,
+                       blockxsize=256, blockysize=256, compress='deflate', BIGTIFF='IF_SAFER')
+        os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+        # Blocks no tile reaches are filled with nodata when the file is closed.
+        return rasterio.open(tmp_path, 'w', **profile)
+
+    def get(tile, label):
+        for attempt in range(max_retries + 1):
+            try:
+                return pool.get(url_for(tile))
+            except Exception as e:
+                status = getattr(e, 'status', None)
+                transient = status is None or status in RETRY_STATUS
+                if not transient or attempt == max_retries:
+                    raise
+                delay = retry_delay * 2 ** attempt
+                with lock:
+                    stats['retries'] += 1
+                print(f"🔁 {label}: {e} -- retrying in {delay:.0f} s")
+                sleep(delay)
+
+    def fetch(tile):
+        label = f"{os.path.basename(out_path)}/tile{tile.id:04d}"
+        try:
+            if metrics is None:
+                body = get(tile, label)
+            else:
+                with metrics.timer('fetch', label) as fields:
+                    body = get(tile, label)
+                    fields.update(bytes=len(body))
+            with MemoryFile(body) as mem, mem.open() as src:
+                if (src.width, src.height) != (tile.width, tile.height):
+                    raise FetchError(f"got {src.width}x{src.height} pixels, expected {tile.width}x{tile.height}")
+                data = src.read()
+                with lock:
+                    if state['dst'] is None:
+                        state['dst'] = open_output(src)
+                    state['dst'].write(data, window=Window(tile.col_off - col0, tile.row_off - row0,
+                                                           tile.width, tile.height))
+                    stats['tiles'] += 1
+                    stats['bytes'] += len(body)
+        except Exception as e:
+            print(f"❌ {label}: {e}")
+            with lock:
+                stats['failed'].append(tile.id)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_connections) as executor:
+            list(executor.map(fetch, tiles))
+    finally:
+        pool.close()
+        if state['dst'] is not None:
+            state['dst'].close()
+    if stats['failed'] or state['dst'] is None:
+        raise FetchError(f"{len(stats['failed'])} of {len(tiles)} tile(s) failed for {out_path}")
+    os.replace(tmp_path, out_path)
+    print(f"📥 Fetched {stats['tiles']} tile(s), {stats['bytes'] / 1e6:.1f} MB, into {out_path}")
+    return out_path, stats
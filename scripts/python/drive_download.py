@@ -0,0 +1,179 @@
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# ---------------------------------------------------------------------
+# Parallel, resumable Drive downloader
+#
+# Files are fetched through a bounded thread pool in byte-range chunks
+# into a `.part` file, so an interrupted run picks up where it stopped.
+# Each file is checked against Drive's md5Checksum/fileSize before it
+# is moved into place, and the Drive copy is only deleted after that
+# check passes (and after the caller has recorded the local file, so a
+# crash in between never leaves an export with neither copy on record).
+# Files already on disk with a matching checksum are skipped.
+# ---------------------------------------------------------------------
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_WORKERS = 4
+MAX_RETRIES = 5
+
+DownloadResult = namedtuple('DownloadResult', ['title', 'path', 'status', 'bytes', 'md5'])
+
+
+class PyDriveSource:
+    """Adapts a pydrive2 GoogleDrive to the calls the downloader needs."""
+
+    MEDIA_URL = "https://www.googleapis.com/drive/v2/files/{id}?alt=media"
+
+    def __init__(self, drive):
+        self.drive = drive
+        self._local = threading.local()
+
+    def find_folder(self, name):
+        folder_list = self.drive.ListFile({
+            'q': f"title='{name}' and mimeType='{FOLDER_MIME_TYPE}' and trashed=false"
+        }).GetList()
+        if not folder_list:
+            raise Exception(f"Folder '{name}' not found in Google Drive.")
+        return folder_list[0]['id']
+
+    def list_files(self, folder_id):
+        return self.drive.ListFile({
+            'q': f"'{folder_id}' in parents and trashed=false"
+        }).GetList()
+
+    def read_range(self, file, start, end):
+        # httplib2 objects are not thread-safe, so each worker gets its own.
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = self.drive.auth.Get_Http_Object()
+        resp, content = http.request(
+            self.MEDIA_URL.format(id=file['id']),
+            headers={'Range': f"bytes={start}-{end}"})
+        if resp.status not in (200, 206):
+            raise IOError(f"Drive returned HTTP {resp.status} for {file['title']}")
+        if resp.status == 200:
+            # Server ignored the range and sent the whole file.
+            content = content[start:end + 1]
+        return content
+
+    def delete(self, file):
+        file.Delete()
+
+
+def file_md5(path, chunk_size=CHUNK_SIZE):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class DriveDownloader:
+    def __init__(self, source, max_workers=MAX_WORKERS, chunk_size=CHUNK_SIZE,
+                 max_retries=MAX_RETRIES, delete_remote=True, sleep=time.sleep, verbose=True,
+                 metrics=None):
+        self.source = source
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.delete_remote = delete_remote
+        self.sleep = sleep
+        self.verbose = verbose
+        self.metrics = metrics
+
+    def download_folder(self, folder_name, local_path_for, suffix='.tif'):
+        """Download every `suffix` file in a Drive folder; `local_path_for(title)` picks the destination."""
+        folder_id = self.source.find_folder(folder_name)
+        files = [f for f in self.source.list_files(folder_id) if f['title'].endswith(suffix)]
+        return self.download_all(files, local_path_for)
+
+    def download_all(self, files, local_path_for):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(self.download, f, local_path_for(f['title'])) for f in files]
+            return [fut.result() for fut in futures]
+
+    def download(self, file, local_path, on_local=None):
+        """Fetch one file; `on_local(path, md5)` runs once it is verified on disk, before the Drive copy is deleted."""
+        if self.metrics is None:
+            return self._download(file, local_path, on_local)
+        with self.metrics.timer('download', file['title']) as fields:
+            result = self._download(file, local_path, on_local)
+            fields.update(bytes=result.bytes, status=result.status)
+        return result
+
+    def _download(self, file, local_path, on_local=None):
+        title = file['title']
+        size = int(file.get('fileSize', 0))
+        expected_md5 = file.get('md5Checksum')
+        os.makedirs(os.path.dirname(local_path) or '.', exist_ok=True)
+
+        if self._matches(local_path, size, expected_md5):
+            if self.verbose:
+                print(f"✔️ Already downloaded: {title}")
+            if on_local is not None:
+                on_local(local_path, expected_md5)
+            self._delete_remote(file)
+            return DownloadResult(title, local_path, 'skipped', 0, expected_md5)
+
+        part_path = local_path + '.part'
+        for attempt in range(2):
+            try:
+                received = self._fetch(file, part_path, size)
+            except Exception as e:
+                print(f"❌ Download failed: {title} ({e})")
+                return DownloadResult(title, local_path, 'failed', 0, None)
+            if self._matches(part_path, size, expected_md5):
+                os.replace(part_path, local_path)
+                if on_local is not None:
+                    on_local(local_path, expected_md5)
+                self._delete_remote(file)
+                return DownloadResult(title, local_path, 'downloaded', received, expected_md5)
+            # Corrupt partial data: start over from byte zero once.
+            print(f"⚠️ Checksum mismatch for {title}, restarting download...")
+            os.remove(part_path)
+        return DownloadResult(title, local_path, 'failed', 0, None)
+
+    def _fetch(self, file, part_path, size):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > size:
+            offset = 0
+            os.remove(part_path)
+        if self.verbose:
+            resumed = f" (resuming at {offset} bytes)" if offset else ""
+            print(f"⬇️ Downloading: {file['title']}{resumed}")
+        received = 0
+        retries = 0
+        with open(part_path, 'ab') as out:
+            while offset < size:
+                end = min(offset + self.chunk_size, size) - 1
+                try:
+                    data = self.source.read_range(file, offset, end)
+                except Exception:
+                    retries += 1
+                    if retries > self.max_retries:
+                        raise
+                    self.sleep(min(2 ** retries, 60))
+                    continue
+                if not data:
+                    raise IOError(f"Empty read at byte {offset} of {file['title']}")
+                out.write(data)
+                offset += len(data)
+                received += len(data)
+                retries = 0
+        return received
+
+    def _matches(self, path, size, expected_md5):
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            return False
+        return expected_md5 is None or file_md5(path) == expected_md5
+
+    def _delete_remote(self, file):
+        if self.delete_remote:
+            if self.verbose:
+                print(f"🗑️ Deleting from Drive: {file['title']}")
+            self.source.delete(file)
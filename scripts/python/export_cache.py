@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+# ---------------------------------------------------------------------
+# Content-addressed export cache and run manifest
+#
+# Every export is keyed by a hash of a canonical description of what it
+# computes and where it goes: the serialized Earth Engine expression
+# graph (collection, dates, mask, reducer, clip) plus region, scale,
+# CRS, folder and file prefix. The manifest -- a JSON file next to the
+# downloads -- records each key's task id as soon as it is submitted,
+# its final state, and the local files it produced. A re-run then
+#   * skips exports whose outputs are already on disk,
+#   * re-attaches to tasks still running from an interrupted run,
+#   * resubmits only what failed or was never started.
+# ---------------------------------------------------------------------
+MANIFEST_NAME = "export_manifest.json"
+RESUBMIT_STATES = ('FAILED', 'CANCELLED', 'UNKNOWN')
+IGNORED_PARAMS = ('description',)   # cosmetic; does not change the output
+
+
+def _canonical(value):
+    if hasattr(value, 'serialize'):
+        # ee.Image / ee.Geometry / ee.FeatureCollection expression graphs
+        return json.loads(value.serialize())
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def export_key(image, **params):
+    """Stable hex key for an export of `image` with Export.image.toDrive keyword `params`."""
+    description = {k: _canonical(v) for k, v in params.items() if k not in IGNORED_PARAMS}
+    description['image'] = _canonical(image)
+    blob = json.dumps(description, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def ee_task_state(task_id):
+    import ee
+    return ee.data.getTaskStatus(task_id)[0]['state']
+
+
+class ExportManifest:
+    """Persistent record of export keys, task ids and downloaded outputs."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def record_submitted(self, key, task_id, description, file_prefix):
+        with self._lock:
+            self.entries[key] = {
+                'task_id': task_id,
+                'description': description,
+                'file_prefix': file_prefix,
+                'state': 'SUBMITTED',
+                'submitted_at': time.time(),
+                'outputs': [],
+            }
+            self._save()
+
+    def record_state(self, key, state):
+        with self._lock:
+            self.entries[key]['state'] = state
+            self._save()
+
+    def record_file_count(self, key, count):
+        """How many Drive files the export produced, so a half-downloaded one is not complete."""
+        with self._lock:
+            self.entries[key]['file_count'] = count
+            self._save()
+
+    def missing_outputs(self, key):
+        """Whether fewer outputs are recorded than the export produced."""
+        entry = self.entries[key]
+        return len(entry['outputs']) < entry.get('file_count', 1)
+
+    def record_output(self, key, path, md5=None, size=None):
+        with self._lock:
+            outputs = self.entries[key]['outputs']
+            outputs[:] = [o for o in outputs if o['path'] != path]
+            outputs.append({'path': path, 'md5': md5,
+                            'size': os.path.getsize(path) if size is None else size})
+            self._save()
+
+    def record_replaced(self, paths, new_path):
+        """Mark outputs as consumed into `new_path` (e.g. tiles merged into a mosaic)."""
+        paths = set(paths)
+        with self._lock:
+            for entry in self.entries.values():
+                for output in entry['outputs']:
+                    if output['path'] in paths:
+                        output['replaced_by'] = new_path
+            self._save()
+
+    def outputs(self, key):
+        entry = self.entries.get(key)
+        return list(entry['outputs']) if entry else []
+
+    def is_complete(self, key):
+        """True if the export completed and every output (or what replaced it) is on disk."""
+        entry = self.entries.get(key)
+        if not entry or entry['state'] != 'COMPLETED' or self.missing_outputs(key):
+            return False
+        for output in entry['outputs']:
+            if 'replaced_by' in output:
+                if not os.path.exists(output['replaced_by']):
+                    return False
+            elif not os.path.exists(output['path']) or os.path.getsize(output['path']) != output['size']:
+                return False
+        return True
+
+    def in_flight(self):
+        return {k: e for k, e in self.entries.items() if e['state'] == 'SUBMITTED'}
+
+
+def start_export(image, manifest=None, export=None, task_state=None, **params):
+    """Start an export unless the manifest already covers it.
+
+    Returns (task, key) where task is
+      * None when the outputs are already on disk (nothing to do),
+      * a task id string when re-attaching to an earlier submission,
+      * a newly started task otherwise.
+    `export` defaults to ee.batch.Export.image.toDrive and `task_state`
+    to an ee.data.getTaskStatus lookup.
+    """
+    if export is None:
+        import ee
+        export = ee.batch.Export.image.toDrive
+    task_state = task_state or ee_task_state
+    key = export_key(image, **params)
+
+    if manifest is not None:
+        entry = manifest.get(key)
+        if manifest.is_complete(key):
+            print(f"♻️ Cached: {params.get('description', key[:12])}")
+            return None, key
+        # Only re-attach while some files are still to be downloaded: each
+        # output is recorded before its Drive copy is deleted, so once all
+        # are recorded, missing files need a resubmit.
+        if entry is not None and entry['state'] not in RESUBMIT_STATES and manifest.missing_outputs(key):
+            state = task_state(entry['task_id'])
+            if state not in RESUBMIT_STATES:
+                print(f"🔗 Re-attaching to {entry['task_id']} ({params.get('description', key[:12])}: {state})")
+                return entry['task_id'], key
+
+    task = export(image=image, **params)
+    task.start()
+    if manifest is not None:
+        manifest.record_submitted(key, task.id, params.get('description'), params.get('fileNamePrefix'))
+    return task, key
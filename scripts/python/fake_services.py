@@ -0,0 +1,457 @@
+import hashlib
+import heapq
+import itertools
+import random
+import threading
+import time
+
+# ---------------------------------------------------------------------
+# Local stand-ins for the remote services used by the workflow scripts
+#
+# These let the export/download machinery run offline so poll counts,
+# API calls and end-to-end latency can be measured without live
+# Earth Engine or Drive quotas. VirtualClock makes `sleep` advance a
+# counter instead of blocking, so a six-hour run replays instantly in a
+# single thread; ScaledClock really sleeps, but compressed, so worker
+# threads overlap the way they would against the live services.
+# ---------------------------------------------------------------------
+
+
+class VirtualClock:
+    def __init__(self, start=0.0):
+        self.now = start
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += seconds
+
+
+class ScaledClock:
+    """Real time compressed by `scale`: sleep(60) blocks for 60 * scale seconds."""
+
+    def __init__(self, scale=0.001):
+        self.scale = scale
+        self.start = time.monotonic()
+
+    def time(self):
+        return (time.monotonic() - self.start) / self.scale
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0) * self.scale)
+
+
+# ---------------------------------------------------------------------
+# Earth Engine task service
+# ---------------------------------------------------------------------
+class FakeTask:
+    """Mimics ee.batch.Task: start() submits, status() returns a status dict."""
+
+    def __init__(self, service, config, duration, final_state='COMPLETED', error_message=None):
+        self.service = service
+        self.config = config
+        self.duration = duration
+        self.final_state = final_state
+        self.error_message = error_message
+        self.id = None
+        self.submitted_at = None
+        self.written = False
+
+    def start(self):
+        self.service.submit(self)
+
+    def status(self):
+        self.service.calls['status'] += 1
+        self.service.sleep(self.service.api_latency)
+        return self.service.task_status(self)
+
+
+class FakeTaskService:
+    """A task queue that runs each task for `duration` seconds.
+
+    `durations` maps a task description to its run time, or is a callable
+    taking the export config (anything not listed gets
+    `default_duration`). `failures` maps a description to
+    (state, error_message) for tasks that should not complete -- or to a
+    list of outcomes (None to succeed) used by successive exports with
+    that description -- or is a callable taking the config and returning
+    an outcome. `failure_rate` fails that fraction of tasks at random.
+    At most `max_running` tasks run at once; the rest wait in READY, like
+    the per-project concurrency limit, and starting a task while
+    `max_queued` are unfinished raises, like a full task queue. Each API
+    call costs `api_latency`.
+
+    If a FakeDrive is given, each completed task writes `output_bytes`
+    (an int or a callable taking the config) into it as
+    `<folder>/<fileNamePrefix>.tif`, like a Drive export.
+    """
+
+    def __init__(self, clock=None, durations=None, default_duration=300,
+                 failures=None, startup_delay=10, drive=None, output_bytes=1024,
+                 max_running=None, api_latency=0, failure_rate=0, seed=0, max_queued=None):
+        self.clock = clock or VirtualClock()
+        self.durations = durations or {}
+        self.default_duration = default_duration
+        self.failures = failures or {}
+        self.startup_delay = startup_delay
+        self.drive = drive
+        self.output_bytes = output_bytes
+        self.max_running = max_running
+        self.api_latency = api_latency
+        self.failure_rate = failure_rate
+        self.max_queued = max_queued
+        self.random = random.Random(seed)
+        self.tasks = {}
+        self.calls = {'submit': 0, 'status': 0, 'list': 0}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def sleep(self, seconds):
+        if seconds:
+            self.clock.sleep(seconds)
+
+    def export_image_to_drive(self, image=None, description='task', **kwargs):
+        """Same keyword interface as ee.batch.Export.image.toDrive."""
+        config = dict(kwargs, image=image, description=description)
+        if callable(self.durations):
+            duration = self.durations(config)
+        else:
+            duration = self.durations.get(description, self.default_duration)
+        final_state, error_message = self._outcome(config) or ('COMPLETED', None)
+        if final_state == 'COMPLETED' and self.failure_rate:
+            with self._lock:
+                if self.random.random() < self.failure_rate:
+                    final_state, error_message = 'FAILED', 'Internal error.'
+        return FakeTask(self, config, duration, final_state, error_message)
+
+    def _outcome(self, config):
+        if callable(self.failures):
+            return self.failures(config)
+        outcome = self.failures.get(config['description'])
+        if isinstance(outcome, list):
+            with self._lock:
+                return outcome.pop(0) if outcome else None
+        return outcome
+
+    def submit(self, task):
+        self.sleep(self.api_latency)
+        with self._lock:
+            self.calls['submit'] += 1
+            if self.max_queued is not None:
+                starts = self._start_times()
+                now = self.clock.time()
+                unfinished = sum(1 for t in self.tasks.values() if now < starts[t.id] + t.duration)
+                if unfinished >= self.max_queued:
+                    raise Exception(f"Too many tasks already in the queue ({self.max_queued}). "
+                                    "Please wait for some of them to complete.")
+            task.id = f"FAKE{next(self._ids):06d}"
+            task.submitted_at = self.clock.time()
+            self.tasks[task.id] = task
+
+    def _start_times(self):
+        # Replay the queue: a task starts once it is past startup and a
+        # slot is free under max_running.
+        ending = []
+        starts = {}
+        for task in sorted(self.tasks.values(), key=lambda t: (t.submitted_at, t.id)):
+            start = task.submitted_at + self.startup_delay
+            if self.max_running:
+                while ending and ending[0] <= start:
+                    heapq.heappop(ending)
+                if len(ending) >= self.max_running:
+                    start = max(start, heapq.heappop(ending))
+            starts[task.id] = start
+            heapq.heappush(ending, start + task.duration)
+        return starts
+
+    def task_status(self, task, starts=None):
+        if task.id is None:
+            return {'id': None, 'state': 'UNSUBMITTED',
+                    'description': task.config['description']}
+        if starts is None:
+            with self._lock:
+                starts = self._start_times()
+        now = self.clock.time()
+        started = starts[task.id]
+        if now < started:
+            state = 'READY'
+        elif now < started + task.duration:
+            state = 'RUNNING'
+        else:
+            state = task.final_state
+            if state == 'COMPLETED':
+                self._write_output(task)
+        status = {
+            'id': task.id,
+            'state': state,
+            'description': task.config['description'],
+            'creation_timestamp_ms': int(task.submitted_at * 1000),
+            'update_timestamp_ms': int(now * 1000),
+        }
+        if state != 'READY':
+            status['start_timestamp_ms'] = int(started * 1000)
+        if state in ('COMPLETED', 'FAILED'):
+            status['batch_eecu_usage_seconds'] = task.duration * 4.0
+        if state == 'FAILED':
+            status['error_message'] = task.error_message or 'Internal error.'
+        return status
+
+    def _write_output(self, task):
+        with self._lock:
+            if self.drive is None or task.written:
+                return
+            task.written = True
+        size = self.output_bytes(task.config) if callable(self.output_bytes) else self.output_bytes
+        prefix = task.config.get('fileNamePrefix', task.config['description'])
+        data = (task.id.encode() * (size // len(task.id) + 1))[:size]
+        self.drive.add_file(task.config.get('folder', ''), f"{prefix}.tif", data)
+
+    def task_state(self, task_id):
+        """Stand-in for ee.data.getTaskStatus(task_id)[0]['state']."""
+        self.calls['status'] += 1
+        self.sleep(self.api_latency)
+        task = self.tasks.get(task_id)
+        return self.task_status(task)['state'] if task else 'UNKNOWN'
+
+    def list_tasks(self):
+        """Batched listing, the stand-in for ee.data.getTaskList()."""
+        self.calls['list'] += 1
+        self.sleep(self.api_latency)
+        with self._lock:
+            tasks = list(self.tasks.values())
+            starts = self._start_times()
+        return {task.id: self.task_status(task, starts) for task in tasks}
+
+
+# ---------------------------------------------------------------------
+# Google Drive
+# ---------------------------------------------------------------------
+class FakeDrive:
+    """In-memory Drive serving the same calls as drive_download.PyDriveSource.
+
+    `interrupt_at` maps a file title to a byte offset; the first read that
+    crosses it raises, which simulates a connection dropped mid-file.
+    `read_failure_rate` fails that fraction of reads at random. Each call
+    costs `latency` seconds on `clock`, and reads also cost their size
+    over `bandwidth` bytes/second. Stored files can be kept small with
+    `byte_scale`: each stored byte then stands for `byte_scale` bytes
+    when charging transfer time.
+    """
+
+    def __init__(self, interrupt_at=None, clock=None, latency=0, bandwidth=None,
+                 byte_scale=1, read_failure_rate=0, seed=0):
+        self.folders = {}   # folder name -> folder id
+        self.files = {}     # file id -> metadata dict
+        self.content = {}   # file id -> bytes
+        self.interrupt_at = dict(interrupt_at or {})
+        self.clock = clock or VirtualClock()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.byte_scale = byte_scale
+        self.read_failure_rate = read_failure_rate
+        self.random = random.Random(seed)
+        self.calls = {'find_folder': 0, 'list': 0, 'read': 0, 'delete': 0}
+        self.bytes_served = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _cost(self, nbytes=0):
+        seconds = self.latency
+        if self.bandwidth:
+            seconds += nbytes * self.byte_scale / self.bandwidth
+        if seconds:
+            self.clock.sleep(seconds)
+
+    def add_file(self, folder, title, data):
+        with self._lock:
+            folder_id = self.folders.setdefault(folder, f"folder{len(self.folders) + 1}")
+            file_id = f"file{next(self._ids):06d}"
+            self.files[file_id] = {
+                'id': file_id,
+                'title': title,
+                'parents': [folder_id],
+                'fileSize': str(len(data)),
+                'md5Checksum': hashlib.md5(data).hexdigest(),
+            }
+            self.content[file_id] = data
+        return self.files[file_id]
+
+    def find_folder(self, name):
+        self.calls['find_folder'] += 1
+        self._cost()
+        if name not in self.folders:
+            raise Exception(f"Folder '{name}' not found in Google Drive.")
+        return self.folders[name]
+
+    def list_files(self, folder_id):
+        self.calls['list'] += 1
+        self._cost()
+        with self._lock:
+            return [dict(f) for f in self.files.values() if folder_id in f['parents']]
+
+    def read_range(self, file, start, end):
+        with self._lock:
+            self.calls['read'] += 1
+            cut = self.interrupt_at.get(file['title'])
+            if cut is not None and start <= cut <= end:
+                del self.interrupt_at[file['title']]
+                raise IOError(f"Connection reset while reading {file['title']}")
+            if self.read_failure_rate and self.random.random() < self.read_failure_rate:
+                raise IOError(f"Injected read failure for {file['title']}")
+            data = self.content[file['id']][start:end + 1]
+            self.bytes_served += len(data)
+        self._cost(len(data))
+        return data
+
+    def delete(self, file):
+        self._cost()
+        with self._lock:
+            self.calls['delete'] += 1
+            self.files.pop(file['id'], None)
+            self.content.pop(file['id'], None)
+
+
+class FakeDriveFile(dict):
+    """pydrive2 GoogleDriveFile stand-in: metadata dict plus GetContentFile/Delete."""
+
+    def __init__(self, drive, metadata):
+        super().__init__(metadata)
+        self.drive = drive
+
+    def GetContentFile(self, filename):
+        size = int(self['fileSize'])
+        data = self.drive.read_range(self, 0, size - 1) if size else b''
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def Delete(self):
+        self.drive.delete(self)
+
+
+class _FakeFileList:
+    def __init__(self, items):
+        self.items = items
+
+    def GetList(self):
+        return self.items
+
+
+class FakeGoogleDrive:
+    """pydrive2 GoogleDrive stand-in over a FakeDrive, for replaying the original scripts.
+
+    Understands the two ListFile queries the scripts make: a folder
+    lookup by title and a listing of a folder's children.
+    """
+
+    def __init__(self, drive):
+        self.drive = drive
+
+    def ListFile(self, param):
+        q = param['q']
+        if q.startswith("title='"):
+            name = q.split("'")[1]
+            folder_id = self.drive.folders.get(name)
+            self.drive.calls['find_folder'] += 1
+            self.drive._cost()
+            return _FakeFileList([] if folder_id is None else [{'id': folder_id, 'title': name}])
+        folder_id = q.split("'")[1]
+        return _FakeFileList([FakeDriveFile(self.drive, f) for f in self.drive.list_files(folder_id)])
+
+
+# ---------------------------------------------------------------------
+# Earth Engine pixel download URLs
+# ---------------------------------------------------------------------
+class FakePixelServer:
+    """Local HTTP server handing out GeoTIFF windows of `source_path`, like getDownloadURL URLs.
+
+    `url_for(tile)` is a direct_fetch url maker for tiles planned on
+    `grid`, whose origin must be the source raster's top-left corner.
+    The first requests are answered with the HTTP statuses in `errors`
+    (e.g. [503, 429]) instead of pixels, and every request waits
+    `latency` real seconds. Use as a context manager.
+    """
+
+    def __init__(self, source_path, grid=None, errors=None, latency=0):
+        self.source_path = source_path
+        self.grid = grid
+        self.errors = list(errors or [])
+        self.latency = latency
+        self.requests = 0
+        self.connections = set()
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qs, urlsplit
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'   # keep-alive, so client connection reuse shows up
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                    server.connections.add(self.client_address)
+                    status = server.errors.pop(0) if server.errors else 200
+                if server.latency:
+                    time.sleep(server.latency)
+                if status == 200:
+                    q = {k: int(v[0]) for k, v in parse_qs(urlsplit(self.path).query).items()}
+                    body = server.window_tiff(q['col'], q['row'], q['width'], q['height'])
+                else:
+                    body = b'simulated error'
+                self.send_response(status)
+                self.send_header('Content-Type', 'image/tiff' if status == 200 else 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with server._lock:
+                    server.bytes_served += len(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def url_for(self, tile):
+        host, port = self._server.server_address
+        return (f"http://{host}:{port}/download?col={tile.col_off}&row={tile.row_off}"
+                f"&width={tile.width}&height={tile.height}")
+
+    def window_tiff(self, col, row, width, height):
+        import rasterio
+        from rasterio.io import MemoryFile
+        from rasterio.windows import Window, transform as window_transform
+
+        window = Window(col, row, width, height)
+        with rasterio.open(self.source_path) as src:
+            # Pixels beyond the source come back as nodata, as Earth Engine pads a request.
+            data = src.read(window=window, boundless=True, fill_value=src.nodata or 0)
+            profile = dict(driver='GTiff', width=width, height=height, count=src.count,
+                           dtype=src.dtypes[0], crs=src.crs, nodata=src.nodata,
+                           transform=window_transform(window, src.transform))
+        with MemoryFile() as mem:
+            with mem.open(**profile) as dst:
+                dst.write(data)
+            return mem.read()
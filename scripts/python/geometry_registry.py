@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+
+# ---------------------------------------------------------------------
+# Cached boundary geometries and rasterized masks
+#
+# Every script used to rebuild its boundary from USDOS/LSIB_SIMPLE/2017
+# or TIGER/2018/States, clip every composite to it server-side, and (for
+# Sentinel) make a blocking .bounds().getInfo() call. The registry
+# fetches each boundary once, keeps it as GeoJSON on disk, and hands
+# back tolerance-simplified copies for server-side use. Bounds come
+# from the local copy. Clipping can instead be done after download with
+# a boolean mask rasterized once per output grid and cached block by
+# block.
+# ---------------------------------------------------------------------
+BLOCK_SIZE = 1024
+NON_CONUS = ['AK', 'HI', 'PR', 'VI', 'GU', 'MP', 'AS']
+
+
+def _fetch_boundary(name, tolerance):
+    import ee
+
+    if name == 'US':
+        geom = ee.FeatureCollection("USDOS/LSIB_SIMPLE/2017") \
+            .filter(ee.Filter.eq("country_na", "United States")) \
+            .geometry()
+    elif name == 'CONUS':
+        geom = ee.FeatureCollection("TIGER/2018/States") \
+            .filter(ee.Filter.inList('STUSPS', NON_CONUS).Not()) \
+            .geometry()
+    else:
+        geom = ee.FeatureCollection("TIGER/2018/States") \
+            .filter(ee.Filter.eq('NAME', name)) \
+            .geometry()
+    if tolerance:
+        geom = geom.simplify(maxError=tolerance)
+    return geom.getInfo()
+
+
+def unwrap_boxes(boxes):
+    """Part boxes with eastern-hemisphere parts moved 360 degrees west when that makes the extent narrower.
+
+    A boundary crossing the antimeridian (the US: the western Aleutians
+    sit at 172..180 E) otherwise spans the whole globe; moved, it spans
+    one contiguous stretch with longitudes below -180.
+    """
+    boxes = list(boxes)
+    moved = [(w - 360, s, e - 360, n) if w >= 0 else (w, s, e, n) for w, s, e, n in boxes]
+
+    def span(bs):
+        return max(b[2] for b in bs) - min(b[0] for b in bs)
+
+    return moved if boxes and span(moved) < span(boxes) else boxes
+
+
+def _shifted(geojson, dx):
+    """Copy of a GeoJSON geometry moved `dx` degrees in longitude."""
+    if geojson['type'] == 'GeometryCollection':
+        return dict(geojson, geometries=[_shifted(g, dx) for g in geojson['geometries']])
+
+    def walk(c):
+        if isinstance(c[0], (int, float)):
+            return [c[0] + dx, *c[1:]]
+        return [walk(x) for x in c]
+    return dict(geojson, coordinates=walk(geojson['coordinates']))
+
+
+def _coordinates(geojson):
+    if geojson['type'] == 'GeometryCollection':
+        for g in geojson['geometries']:
+            yield from _coordinates(g)
+        return
+
+    def walk(c):
+        if isinstance(c[0], (int, float)):
+            yield c
+        else:
+            for x in c:
+                yield from walk(x)
+    yield from walk(geojson['coordinates'])
+
+
+class GeometryRegistry:
+    """Boundaries ('US', 'CONUS' or a TIGER state name) cached as GeoJSON under `cache_dir`.
+
+    `tolerance` is the simplification error in meters; None keeps the
+    full-detail geometry.
+    """
+
+    def __init__(self, cache_dir, fetch=None):
+        self.cache_dir = cache_dir
+        self.fetch = fetch or _fetch_boundary
+        self._memory = {}
+
+    def _path(self, name, tolerance):
+        suffix = f"_simplify{int(tolerance)}m" if tolerance else ""
+        return os.path.join(self.cache_dir, f"{name.lower().replace(' ', '_')}{suffix}.geojson")
+
+    def has(self, name, tolerance=None):
+        """Whether the boundary is already cached (so using it needs no Earth Engine)."""
+        return os.path.exists(self._path(name, tolerance))
+
+    def geojson(self, name, tolerance=None):
+        path = self._path(name, tolerance)
+        if path not in self._memory:
+            if os.path.exists(path):
+                with open(path) as f:
+                    self._memory[path] = json.load(f)
+            else:
+                print(f"🗺️ Fetching boundary '{name}' (tolerance {tolerance} m)...")
+                geojson = self.fetch(name, tolerance)
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(geojson, f)
+                os.replace(path + '.tmp', path)
+                self._memory[path] = geojson
+        return self._memory[path]
+
+    def ee_geometry(self, name, tolerance=None):
+        """The cached boundary as an ee.Geometry, built without a server-side query."""
+        import ee
+        geojson = dict(self.geojson(name, tolerance))
+        geojson.pop('geodesic', None)
+        return ee.Geometry(geojson, None, False)
+
+    def bounds(self, name):
+        """(west, south, east, north) from the local copy -- no getInfo round-trip.
+
+        Like part_bounds, west is below -180 for a boundary crossing the antimeridian.
+        """
+        boxes = self.part_bounds(name)
+        if not boxes:
+            coords = list(_coordinates(self.geojson(name)))
+            boxes = [(min(c[0] for c in coords), min(c[1] for c in coords),
+                      max(c[0] for c in coords), max(c[1] for c in coords))]
+        return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+    def part_bounds(self, name, tolerance=None):
+        """[(west, south, east, north)] of each polygon of the boundary (see unwrap_boxes)."""
+        geojson = self.geojson(name, tolerance)
+        parts = geojson.get('geometries', [geojson])
+        polygons = []
+        for part in parts:
+            if part['type'] == 'Polygon':
+                polygons.append(part['coordinates'])
+            elif part['type'] == 'MultiPolygon':
+                polygons.extend(part['coordinates'])
+        boxes = []
+        for polygon in polygons:
+            xs = [c[0] for c in polygon[0]]
+            ys = [c[1] for c in polygon[0]]
+            boxes.append((min(xs), min(ys), max(xs), max(ys)))
+        return unwrap_boxes(boxes)
+
+    # -----------------------------------------------------------------
+    # Raster masks
+    # -----------------------------------------------------------------
+    def _mask_dir(self, name, tolerance, crs, transform, shape):
+        key = json.dumps([name, tolerance, str(crs), list(transform)[:6], list(shape)])
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, 'masks', digest)
+
+    def mask(self, name, crs, transform, shape, window, tolerance=None):
+        """Boolean inside-boundary mask for one window of a grid, cached on disk as packed bits."""
+        import numpy as np
+        from rasterio import features, windows
+        from rasterio.warp import transform_geom
+
+        mask_dir = self._mask_dir(name, tolerance, crs, transform, shape)
+        height, width = int(window.height), int(window.width)
+        path = os.path.join(mask_dir, f"{int(window.row_off)}_{int(window.col_off)}_{height}_{width}.npy")
+        if os.path.exists(path):
+            return np.unpackbits(np.load(path), count=height * width).reshape(height, width).astype(bool)
+
+        geom = self.geojson(name, tolerance)
+        if str(crs) not in ('EPSG:4326', 'OGC:CRS84'):
+            shapes = [transform_geom('EPSG:4326', crs, geom)]
+        elif transform.c < -180:
+            # A grid west of the antimeridian (see unwrap_boxes) also holds the parts moved there.
+            shapes = [geom, _shifted(geom, -360)]
+        else:
+            shapes = [geom]
+        inside = features.geometry_mask(shapes, out_shape=(height, width),
+                                        transform=windows.transform(window, transform),
+                                        invert=True, all_touched=False)
+        os.makedirs(mask_dir, exist_ok=True)
+        np.save(path, np.packbits(inside))
+        return inside
+
+    def apply_mask(self, name, raster_path, tolerance=None, block_size=BLOCK_SIZE):
+        """Set pixels outside the boundary to nodata in place -- the local stand-in for .clip()."""
+        import numpy as np
+        import rasterio
+        from cog import NODATA
+        from local_composite import block_windows
+
+        with rasterio.open(raster_path, 'r+') as dst:
+            nodata = dst.nodata
+            if nodata is None:
+                # 0 would be a valid index value, so mark outside pixels explicitly.
+                nodata = float('nan') if np.issubdtype(np.dtype(dst.dtypes[0]), np.floating) else NODATA
+                dst.nodata = nodata
+            for window in block_windows(dst.width, dst.height, block_size):
+                inside = self.mask(name, dst.crs, dst.transform, (dst.height, dst.width),
+                                   window, tolerance)
+                if inside.all():
+                    continue
+                data = dst.read(window=window)
+                data[:, ~inside] = nodata
+                dst.write(data, window=window)
+            if dst.overviews(1):
+                # Overviews were built from the unclipped data.
+                from rasterio.enums import Resampling
+                dst.build_overviews(dst.overviews(1), Resampling.average)
+        return raster_path
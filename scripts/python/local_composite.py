@@ -0,0 +1,264 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# ---------------------------------------------------------------------
+# Local NDVI / NDBI compositing
+#
+# Reproduces the server-side math of add_indices / add_ndvi and the
+# QA_PIXEL bit-3 cloud mask over downloaded band rasters, so changing a
+# parameter no longer needs a new Earth Engine export. Scenes are read
+# in windowed blocks; each block keeps only a running sum and count per
+# index, so memory depends on the block size rather than the number of
+# scenes. Blocks are spread across a process pool.
+#
+# All scenes must be on the same pixel grid (same CRS, transform and
+# size) -- e.g. one path/row stack, or scenes warped with a common
+# target grid first. `python local_composite.py` runs self_check, which
+# compares the means and medians with the Earth Engine formulas on
+# synthetic rasters.
+# ---------------------------------------------------------------------
+BLOCK_SIZE = 1024
+NODATA = float('nan')
+
+# Band names per sensor, and (numerator, denominator) band roles per
+# index, matching normalizedDifference([first, second]) in the scripts.
+SENSORS = {
+    'landsat': {
+        'bands': {'red': 'SR_B4', 'nir': 'SR_B5', 'swir': 'SR_B6'},
+        'qa_band': 'QA_PIXEL',
+        'cloud_bit': 3,
+    },
+    'sentinel': {
+        'bands': {'red': 'B4', 'nir': 'B8'},
+        'qa_band': None,
+        'cloud_bit': None,
+    },
+}
+INDICES = {
+    'NDVI': ('nir', 'red'),
+    'NDBI': ('swir', 'nir'),
+}
+
+
+def normalized_difference(first, second):
+    """(first - second) / (first + second), 0 where the sum is 0, as Earth Engine does.
+
+    Inputs may be masked arrays; a pixel masked in either input is masked
+    in the result.
+    """
+    import numpy as np
+    first = np.ma.asarray(first, dtype='float64')
+    second = np.ma.asarray(second, dtype='float64')
+    total = first + second
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nd = np.ma.where(total == 0, 0.0, (first - second) / total)
+    return np.ma.array(nd, mask=np.ma.getmaskarray(first) | np.ma.getmaskarray(second),
+                       dtype='float32')
+
+
+def clear_mask(qa, bit=3):
+    """True where the QA bit is unset, i.e. bitwiseAnd(1 << bit).eq(0)."""
+    import numpy as np
+    return (np.asarray(qa).astype('uint32') & (1 << bit)) == 0
+
+
+def scene_indices(scene, window, sensor='landsat', indices=('NDVI',)):
+    """Compute the requested indices for one scene over one window.
+
+    `scene` maps band names (e.g. 'SR_B4', 'QA_PIXEL') to file paths.
+    Returns {index: masked float32 array}.
+    """
+    import numpy as np
+    import rasterio
+
+    spec = SENSORS[sensor]
+    roles = {role for name in indices for role in INDICES[name]}
+    data = {}
+    for role in roles:
+        with rasterio.open(scene[spec['bands'][role]]) as src:
+            data[role] = src.read(1, window=window, masked=True)
+    if spec['qa_band'] is not None:
+        with rasterio.open(scene[spec['qa_band']]) as src:
+            qa = src.read(1, window=window, masked=True)
+        cloudy = ~clear_mask(qa.filled(0), spec['cloud_bit']) | np.ma.getmaskarray(qa)
+        for role in roles:
+            data[role] = np.ma.array(data[role], mask=np.ma.getmaskarray(data[role]) | cloudy)
+    return {name: normalized_difference(data[INDICES[name][0]], data[INDICES[name][1]])
+            for name in indices}
+
+
+def composite_block(scenes, window, sensor='landsat', indices=('NDVI',)):
+    """Mean of each index over all scenes for one window, from running sums and counts."""
+    import numpy as np
+
+    shape = (int(window.height), int(window.width))
+    sums = {name: np.zeros(shape, dtype='float64') for name in indices}
+    counts = {name: np.zeros(shape, dtype='uint32') for name in indices}
+    for scene in scenes:
+        for name, nd in scene_indices(scene, window, sensor, indices).items():
+            valid = ~np.ma.getmaskarray(nd)
+            sums[name][valid] += nd.data[valid]
+            counts[name] += valid
+    means = {}
+    for name in indices:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = sums[name] / counts[name]
+        mean[counts[name] == 0] = NODATA
+        means[name] = mean.astype('float32')
+    return window, means, counts
+
+
+def _composite_block_job(args):
+    scenes, window, sensor, indices = args
+    window, means, _ = composite_block(scenes, window, sensor, indices)
+    return window, means
+
+
+def block_windows(width, height, block_size=BLOCK_SIZE):
+    from rasterio.windows import Window
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield Window(col_off, row_off, min(block_size, width - col_off),
+                         min(block_size, height - row_off))
+
+
+def composite_scenes(scenes, out_paths, sensor='landsat', block_size=BLOCK_SIZE, max_workers=None):
+    """Write a mean composite GeoTIFF per index; `out_paths` maps index name to output path.
+
+    Equivalent to collection.map(mask).map(add_indices).select(indices).mean()
+    on the scripts' collections, computed locally.
+    """
+    import rasterio
+
+    indices = tuple(out_paths)
+    spec = SENSORS[sensor]
+    with rasterio.open(scenes[0][spec['bands']['red']]) as ref:
+        profile = ref.profile.copy()
+    profile.update(driver='GTiff', count=1, dtype='float32', nodata=NODATA, tiled=True,
+                   blockxsize=256, blockysize=256, compress='deflate', predictor=3)
+
+    outputs = {}
+    for name, path in out_paths.items():
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        outputs[name] = rasterio.open(path, 'w', **profile)
+    try:
+        jobs = [(scenes, w, sensor, indices)
+                for w in block_windows(profile['width'], profile['height'], block_size)]
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            for window, means in pool.map(_composite_block_job, jobs):
+                for name, mean in means.items():
+                    outputs[name].write(mean, 1, window=window)
+    finally:
+        for dst in outputs.values():
+            dst.close()
+    return out_paths
+
+
+# ---------------------------------------------------------------------
+# Self-check against the Earth Engine formulas
+# ---------------------------------------------------------------------
+def _reference(values, qa, nodata, first, second, bit):
+    """Per-pixel, per-scene evaluation of the server-side math in plain Python: (means, medians)."""
+    import statistics
+
+    scenes, height, width = qa.shape
+    means, medians = {}, {}
+    for row in range(height):
+        for col in range(width):
+            observed = []
+            for s in range(scenes):
+                a, b = float(values[first][s, row, col]), float(values[second][s, row, col])
+                # updateMask(qa.bitwiseAnd(1 << bit).eq(0)); masked inputs mask the index
+                if int(qa[s, row, col]) & (1 << bit) or nodata in (a, b):
+                    continue
+                # normalizedDifference: 0 where both bands are 0
+                observed.append(0.0 if a + b == 0 else (a - b) / (a + b))
+            means[row, col] = sum(observed) / len(observed) if observed else NODATA
+            medians[row, col] = statistics.median(observed) if observed else NODATA
+    return means, medians
+
+
+def self_check(scenes=6, size=37, seed=0, block_size=16, workdir=None):
+    """Compare composite_scenes and median_composite with the Earth Engine formulas on synthetic rasters.
+
+    Writes `scenes` random Landsat-like scenes (SR bands with nodata and
+    zero-sum pixels, QA_PIXEL with the cloud bit set at random), then
+    checks the NDVI/NDBI means and the exact and histogram medians
+    against _reference pixel by pixel. Raises AssertionError on a
+    mismatch; returns {check: largest absolute difference}.
+    """
+    import math
+    import shutil
+    import tempfile
+    import numpy as np
+    import rasterio
+    from median_composite import error_bound, median_composite
+
+    spec = SENSORS['landsat']
+    nodata = 65535
+    rng = np.random.default_rng(seed)
+    shape = (scenes, size, size)
+    values = {role: rng.integers(0, 20000, shape) for role in spec['bands']}
+    values['red'][rng.random(shape) < 0.05] = 0
+    values['nir'][values['red'] == 0] = 0          # zero-sum pixels
+    for role in spec['bands']:
+        values[role][rng.random(shape) < 0.05] = nodata
+    qa = rng.integers(0, 1 << 16, shape)
+    qa[rng.random(shape) < 0.6] &= ~(1 << spec['cloud_bit'])
+    qa[0, 0, 0] |= 1 << spec['cloud_bit']
+    qa[:, 1, 1] |= 1 << spec['cloud_bit']          # never clear
+
+    tmp = workdir or tempfile.mkdtemp(prefix='local_composite_check_')
+    try:
+        profile = dict(driver='GTiff', width=size, height=size, count=1, dtype='uint16', crs='EPSG:32618',
+                       transform=rasterio.Affine(30, 0, 300000, 0, -30, 4500000))
+        scene_paths = []
+        for s in range(scenes):
+            scene = {}
+            for role, band in list(spec['bands'].items()) + [(None, spec['qa_band'])]:
+                path = os.path.join(tmp, f"scene{s}_{band}.tif")
+                with rasterio.open(path, 'w', nodata=None if role is None else nodata, **profile) as dst:
+                    dst.write((qa if role is None else values[role])[s].astype('uint16'), 1)
+                scene[band] = path
+            scene_paths.append(scene)
+
+        def compare(check, path, expected, tolerance):
+            with rasterio.open(path) as src:
+                got = src.read(1)
+            worst = 0.0
+            for (row, col), want in expected.items():
+                value = float(got[row, col])
+                if math.isnan(want) or math.isnan(value):
+                    assert math.isnan(want) and math.isnan(value), f"{check} at {row},{col}: {value} vs {want}"
+                    continue
+                worst = max(worst, abs(value - want))
+                assert abs(value - want) <= tolerance, f"{check} at {row},{col}: {value} vs {want}"
+            return worst
+
+        out = {name: os.path.join(tmp, f"{name.lower()}_mean.tif") for name in INDICES}
+        composite_scenes(scene_paths, out, 'landsat', block_size=block_size, max_workers=2)
+        worst = {}
+        for name, (first, second) in INDICES.items():
+            means, medians = _reference(values, qa, nodata, first, second, spec['cloud_bit'])
+            worst[f"{name} mean"] = compare(f"{name} mean", out[name], means, 1e-6)
+            for mode, tolerance in [('exact', 1e-6), ('approx', error_bound() + 1e-6)]:
+                path = median_composite(scene_paths, os.path.join(tmp, f"{name.lower()}_{mode}.tif"), 'landsat',
+                                        name, mode=mode, block_size=block_size, max_workers=2)
+                worst[f"{name} {mode} median"] = compare(f"{name} {mode} median", path, medians, tolerance)
+    finally:
+        if workdir is None:
+            shutil.rmtree(tmp, ignore_errors=True)
+    for check, difference in worst.items():
+        print(f"✅ {check}: max |local - EE formula| = {difference:.2e}")
+    return worst
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Check local composites against the Earth Engine formulas "
+                                                 "on synthetic rasters.")
+    parser.add_argument('--scenes', type=int, default=6)
+    parser.add_argument('--size', type=int, default=37, help="raster width and height in pixels")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    self_check(args.scenes, args.size, args.seed)
@@ -0,0 +1,111 @@
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+from local_composite import NODATA, SENSORS, block_windows, scene_indices
+
+# ---------------------------------------------------------------------
+# Streaming median compositing
+#
+# ndvi_annual_US_sentinel.py takes a .median() over a year of scenes.
+# An exact local median needs every observation of every pixel at once;
+# here each block instead keeps a per-pixel histogram of NDVI over
+# [-1, 1] and the scene stack is read once. Peak memory is
+# bins x block pixels, independent of the number of scenes.
+#
+# Approximate mode returns the centre of the histogram bin holding each
+# middle-ranked observation (the mean of the two for an even count), so
+# the result is within half a bin width -- 1 / bins -- of the exact
+# median. With the default 200 bins that is 0.005 NDVI. Exact mode
+# holds the whole stack for a block and is meant for small windows;
+# 'auto' only picks it while that stack stays under a fixed 16 MB,
+# below the default histogram of a 256 x 256 block (26 MB), so memory
+# stays independent of the number of scenes.
+# ---------------------------------------------------------------------
+DEFAULT_BINS = 200
+BLOCK_SIZE = 256
+EXACT_LIMIT = 4e6   # observations per block below which 'auto' goes exact (16 MB of float32)
+
+
+def error_bound(bins=DEFAULT_BINS):
+    """Largest possible |approximate - exact| median, in index units."""
+    return 1.0 / bins
+
+
+def _rank_bin(cumulative, rank):
+    # First bin whose cumulative count exceeds the 0-based rank.
+    import numpy as np
+    return np.argmax(cumulative > rank[None, :], axis=0)
+
+
+def histogram_median(histogram, bins=DEFAULT_BINS):
+    """Approximate per-pixel median from a (bins, pixels) count array."""
+    import numpy as np
+
+    cumulative = np.cumsum(histogram, axis=0, dtype='uint32')
+    count = cumulative[-1].astype('int64')
+    lower = _rank_bin(cumulative, np.maximum(count - 1, 0) // 2)
+    upper = _rank_bin(cumulative, count // 2)
+    width = 2.0 / bins
+    median = -1.0 + width * ((lower + upper) / 2.0 + 0.5)
+    median = median.astype('float32')
+    median[count == 0] = NODATA
+    return median
+
+
+def median_block(scenes, window, sensor='sentinel', index='NDVI', bins=DEFAULT_BINS, mode='auto'):
+    """Median of `index` over all scenes for one window; returns (window, float32 array)."""
+    import numpy as np
+
+    shape = (int(window.height), int(window.width))
+    npix = shape[0] * shape[1]
+    if mode == 'auto':
+        mode = 'exact' if npix * len(scenes) <= EXACT_LIMIT else 'approx'
+
+    if mode == 'exact':
+        stack = np.full((len(scenes), npix), np.nan, dtype='float32')
+        for i, scene in enumerate(scenes):
+            nd = scene_indices(scene, window, sensor, (index,))[index]
+            stack[i] = nd.filled(np.nan).ravel()
+        with warnings.catch_warnings():
+            # All-NaN columns (no clear observation) are expected.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(stack, axis=0).astype('float32')
+        return window, median.reshape(shape)
+
+    histogram = np.zeros((bins, npix), dtype='uint16')
+    pixels = np.arange(npix)
+    for scene in scenes:
+        nd = scene_indices(scene, window, sensor, (index,))[index].ravel()
+        valid = ~np.ma.getmaskarray(nd)
+        b = np.clip(((nd.data[valid] + 1.0) * (bins / 2.0)).astype('int64'), 0, bins - 1)
+        histogram[b, pixels[valid]] += 1
+    return window, histogram_median(histogram, bins).reshape(shape)
+
+
+def _median_block_job(args):
+    return median_block(*args)
+
+
+def median_composite(scenes, out_path, sensor='sentinel', index='NDVI', bins=DEFAULT_BINS,
+                     mode='auto', block_size=BLOCK_SIZE, max_workers=None):
+    """Write the per-pixel median of `index` over all scenes to a GeoTIFF.
+
+    The local counterpart of collection.select(index).median(); `mode` is
+    'exact', 'approx' (error <= 1 / bins) or 'auto'.
+    """
+    import rasterio
+
+    with rasterio.open(scenes[0][SENSORS[sensor]['bands']['red']]) as ref:
+        profile = ref.profile.copy()
+    profile.update(driver='GTiff', count=1, dtype='float32', nodata=NODATA, tiled=True,
+                   blockxsize=256, blockysize=256, compress='deflate', predictor=3)
+
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    jobs = [(scenes, w, sensor, index, bins, mode)
+            for w in block_windows(profile['width'], profile['height'], block_size)]
+    with rasterio.open(out_path, 'w', **profile) as dst:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            for window, median in pool.map(_median_block_job, jobs):
+                dst.write(median, 1, window=window)
+    return out_path
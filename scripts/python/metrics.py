@@ -0,0 +1,144 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# ---------------------------------------------------------------------
+# Per-stage run metrics
+#
+# Records where a run's time goes: queue wait and server-side run time
+# for each export task (from the timestamps and EECU usage in its
+# status), Drive listing and download time with bytes moved, and local
+# post-processing time per file. Every record is appended to a JSON
+# lines file as it happens; at the end of a run the totals can be
+# written as a Prometheus textfile (for node_exporter's textfile
+# collector) and printed as a report ranking the slowest stages and
+# items.
+# ---------------------------------------------------------------------
+PROMETHEUS_PREFIX = 'ndvi'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RunMetrics:
+    """Collects stage timings for one run.
+
+    `jsonl_path`, if given, receives one JSON object per record. `clock`
+    supplies wall-clock seconds; point it at a fake_services clock for
+    offline runs.
+    """
+
+    def __init__(self, jsonl_path=None, clock=time.time, run_id=None):
+        self.jsonl_path = jsonl_path
+        self.clock = clock
+        self.run_id = run_id or time.strftime('%Y%m%dT%H%M%S')
+        self.started = clock()
+        self.records = []
+        self._lock = threading.Lock()
+        if jsonl_path:
+            os.makedirs(os.path.dirname(jsonl_path) or '.', exist_ok=True)
+
+    def record(self, stage, label, seconds, **fields):
+        """Add one timing record for `label` in `stage`."""
+        rec = dict(run=self.run_id, ts=round(self.clock(), 3), stage=stage, label=label,
+                   seconds=round(seconds, 3), **fields)
+        with self._lock:
+            self.records.append(rec)
+            if self.jsonl_path:
+                with open(self.jsonl_path, 'a') as f:
+                    f.write(json.dumps(rec) + '\n')
+        return rec
+
+    @contextmanager
+    def timer(self, stage, label, **fields):
+        """Time the body as one `stage` record; the yielded dict can add fields such as bytes."""
+        start = self.clock()
+        extra = dict(fields)
+        try:
+            yield extra
+        finally:
+            self.record(stage, label, self.clock() - start, **extra)
+
+    def task(self, label, status):
+        """Record queue wait and run time of a finished export task from its status dict."""
+        created = status.get('creation_timestamp_ms')
+        started = status.get('start_timestamp_ms')
+        finished = status.get('update_timestamp_ms')
+        common = {'task_id': status.get('id'), 'state': status.get('state')}
+        if created is not None and started is not None:
+            self.record('export_queue', label, (started - created) / 1000, **common)
+        if started is not None and finished is not None:
+            eecu = status.get('batch_eecu_usage_seconds')
+            self.record('export_run', label, (finished - started) / 1000,
+                        eecu_seconds=eecu, **common)
+
+    # -----------------------------------------------------------------
+    # Summaries
+    # -----------------------------------------------------------------
+    def stage_totals(self):
+        """{stage: {'count', 'seconds', 'bytes', 'eecu_seconds'}} over all records."""
+        totals = defaultdict(lambda: {'count': 0, 'seconds': 0.0, 'bytes': 0, 'eecu_seconds': 0.0})
+        with self._lock:
+            records = list(self.records)
+        for rec in records:
+            t = totals[rec['stage']]
+            t['count'] += 1
+            t['seconds'] += rec['seconds']
+            t['bytes'] += rec.get('bytes') or 0
+            t['eecu_seconds'] += rec.get('eecu_seconds') or 0
+        return dict(totals)
+
+    def slowest(self, n=10, stage=None):
+        with self._lock:
+            records = [r for r in self.records if stage is None or r['stage'] == stage]
+        return sorted(records, key=lambda r: r['seconds'], reverse=True)[:n]
+
+    def write_prometheus(self, path):
+        """Write the stage totals in Prometheus text format, replacing the file atomically."""
+        p = PROMETHEUS_PREFIX
+        totals = self.stage_totals()
+        lines = [f"# HELP {p}_stage_seconds_total Seconds spent per pipeline stage.",
+                 f"# TYPE {p}_stage_seconds_total counter"]
+        lines += [f'{p}_stage_seconds_total{{stage="{_escape(s)}"}} {t["seconds"]:.3f}'
+                  for s, t in sorted(totals.items())]
+        lines += [f"# HELP {p}_stage_items_total Items (tasks, files) handled per stage.",
+                  f"# TYPE {p}_stage_items_total counter"]
+        lines += [f'{p}_stage_items_total{{stage="{_escape(s)}"}} {t["count"]}'
+                  for s, t in sorted(totals.items())]
+        lines += [f"# HELP {p}_stage_bytes_total Bytes moved per stage.",
+                  f"# TYPE {p}_stage_bytes_total counter"]
+        lines += [f'{p}_stage_bytes_total{{stage="{_escape(s)}"}} {t["bytes"]}'
+                  for s, t in sorted(totals.items()) if t['bytes']]
+        lines += [f"# HELP {p}_export_eecu_seconds_total Earth Engine compute units used by exports.",
+                  f"# TYPE {p}_export_eecu_seconds_total counter",
+                  f"{p}_export_eecu_seconds_total {sum(t['eecu_seconds'] for t in totals.values()):.3f}",
+                  f"# HELP {p}_run_seconds Wall-clock seconds since the run started.",
+                  f"# TYPE {p}_run_seconds gauge",
+                  f"{p}_run_seconds {self.clock() - self.started:.3f}"]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+        return path
+
+    def report(self, top=10):
+        """Print stages ranked by total time, then the `top` slowest individual items."""
+        totals = self.stage_totals()
+        elapsed = self.clock() - self.started
+        print(f"📊 Run {self.run_id}: {elapsed / 60:.1f} min wall clock")
+        print(f"{'stage':<14}{'items':>7}{'total':>12}{'mean':>10}{'throughput':>14}")
+        for stage, t in sorted(totals.items(), key=lambda kv: kv[1]['seconds'], reverse=True):
+            mean = t['seconds'] / t['count'] if t['count'] else 0
+            rate = f"{t['bytes'] / t['seconds'] / 1e6:.1f} MB/s" if t['bytes'] and t['seconds'] else ''
+            print(f"{stage:<14}{t['count']:>7}{t['seconds'] / 60:>10.1f} m{mean:>8.1f} s{rate:>14}")
+        eecu = sum(t['eecu_seconds'] for t in totals.values())
+        if eecu:
+            print(f"EECU usage: {eecu / 3600:.2f} EECU-hours")
+        print(f"Slowest {top}:")
+        for rec in self.slowest(top):
+            print(f"  {rec['seconds']:>9.1f} s  {rec['stage']:<14}{rec['label']}")
+        return totals
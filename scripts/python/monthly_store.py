@@ -0,0 +1,130 @@
+import os
+
+# ---------------------------------------------------------------------
+# Monthly sum / count aggregate store
+#
+# Rather than exporting an annual and a JJA composite over overlapping
+# date ranges, each (sensor, year) is exported once as a 24-band image:
+# the per-pixel NDVI sum and valid-observation count for every month.
+# Any seasonal mean -- annual, JJA, growing season or a custom set of
+# months, even across years -- is then sum(sums) / sum(counts),
+# computed locally with cheap array arithmetic.
+#
+# Months run from the 1st to the 1st of the next month, so a season
+# includes its last calendar day (the scripts' filterDate ranges stop
+# one day short). MOD13Q1 has no composites starting on those days.
+#
+# With dtype='int16' the stack is exported in the collection's stored
+# units (MOD13Q1 NDVI is int16 scaled by 0.0001) instead of float32,
+# halving the transfer; MonthlyStore(sum_scale=...) undoes the scale.
+# A 16-day composite starts at most twice a month, so a monthly sum is
+# at most 2 * 10000 and fits.
+# ---------------------------------------------------------------------
+BLOCK_SIZE = 1024
+MONTHS = range(1, 13)
+SEASONS = {
+    'annual': tuple(MONTHS),
+    'jja': (6, 7, 8),
+    'growing': (4, 5, 6, 7, 8, 9, 10),
+}
+
+
+def sum_band(month):
+    return f"sum_{month:02d}"
+
+
+def count_band(month):
+    return f"count_{month:02d}"
+
+
+def band_names():
+    return [sum_band(m) for m in MONTHS] + [count_band(m) for m in MONTHS]
+
+
+def season_months(year, season):
+    """[(year, month), ...] for a named season or an iterable of months."""
+    months = SEASONS[season] if isinstance(season, str) else season
+    return [(year, m) for m in months]
+
+
+# ---------------------------------------------------------------------
+# Earth Engine side
+# ---------------------------------------------------------------------
+def monthly_sum_count(collection, year, band='NDVI', dtype='float32'):
+    """24-band image of per-month sum and count of `band` for one year.
+
+    `collection` should already be masked and carry `band`; masked
+    pixels contribute to neither the sum nor the count. For
+    dtype='int16' it should carry `band` unscaled.
+    """
+    import ee
+
+    col = collection.select(band)
+    sums, counts = [], []
+    for m in MONTHS:
+        start = ee.Date.fromYMD(year, m, 1)
+        month = col.filterDate(start, start.advance(1, 'month'))
+        sums.append(month.sum().unmask(0).toFloat().rename(sum_band(m)))
+        counts.append(month.count().unmask(0).toUint16().rename(count_band(m)))
+    # Both halves need a common type to live in one GeoTIFF.
+    stack = ee.Image.cat(sums + counts)
+    return stack.toInt16() if dtype == 'int16' else stack.toFloat()
+
+
+# ---------------------------------------------------------------------
+# Local side
+# ---------------------------------------------------------------------
+class MonthlyStore:
+    """Per-(sensor, year) monthly sum/count rasters under `root`.
+
+    `sum_scale` converts stored sums to index units (0.0001 for int16
+    MODIS stacks).
+    """
+
+    def __init__(self, root, sum_scale=1.0):
+        self.root = root
+        self.sum_scale = sum_scale
+
+    def file_prefix(self, sensor, year):
+        return f"{sensor}_monthly_{year}"
+
+    def path(self, sensor, year):
+        return os.path.join(self.root, sensor, f"{self.file_prefix(sensor, year)}.tif")
+
+    def has(self, sensor, year):
+        return os.path.exists(self.path(sensor, year))
+
+    def season_mean(self, sensor, periods, out_path, block_size=BLOCK_SIZE):
+        """Write the mean over `periods` ([(year, month), ...]) to a float32 GeoTIFF."""
+        import numpy as np
+        import rasterio
+        from local_composite import NODATA, block_windows
+
+        by_year = {}
+        for year, month in periods:
+            by_year.setdefault(year, []).append(month)
+        sources = {year: rasterio.open(self.path(sensor, year)) for year in by_year}
+        try:
+            ref = next(iter(sources.values()))
+            profile = ref.profile.copy()
+            profile.update(driver='GTiff', count=1, dtype='float32', nodata=NODATA, tiled=True,
+                           blockxsize=256, blockysize=256, compress='deflate', predictor=3)
+            names = band_names()
+            os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+            with rasterio.open(out_path, 'w', **profile) as dst:
+                for window in block_windows(ref.width, ref.height, block_size):
+                    total = np.zeros((int(window.height), int(window.width)), dtype='float64')
+                    count = np.zeros_like(total)
+                    for year, months in by_year.items():
+                        sum_idx = [names.index(sum_band(m)) + 1 for m in months]
+                        count_idx = [names.index(count_band(m)) + 1 for m in months]
+                        total += sources[year].read(sum_idx, window=window).sum(axis=0, dtype='float64')
+                        count += sources[year].read(count_idx, window=window).sum(axis=0)
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        mean = (total * self.sum_scale / count).astype('float32')
+                    mean[count == 0] = NODATA
+                    dst.write(mean, 1, window=window)
+        finally:
+            for src in sources.values():
+                src.close()
+        return out_path
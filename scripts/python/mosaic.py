@@ -0,0 +1,192 @@
+import os
+import threading
+from xml.sax.saxutils import escape
+
+# ---------------------------------------------------------------------
+# Local mosaicking of tiled exports
+#
+# Stitches the per-tile GeoTIFFs from tiling.export_tiles into one
+# tiled, compressed GeoTIFF with overviews, copying block by block so
+# the full raster is never held in memory. build_vrt writes a virtual
+# mosaic instead when a copy is not needed.
+# ---------------------------------------------------------------------
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32]
+MOSAIC_PROFILE = {
+    'driver': 'GTiff',
+    'tiled': True,
+    'blockxsize': 256,
+    'blockysize': 256,
+    'compress': 'deflate',
+    'predictor': 2,
+    'BIGTIFF': 'IF_SAFER',
+}
+
+
+def _union_grid(sources):
+    res_x, res_y = sources[0].res
+    west = min(s.bounds.left for s in sources)
+    north = max(s.bounds.top for s in sources)
+    east = max(s.bounds.right for s in sources)
+    south = min(s.bounds.bottom for s in sources)
+    width = int(round((east - west) / res_x))
+    height = int(round((north - south) / res_y))
+    return west, north, res_x, res_y, width, height
+
+
+def mosaic_tiles(paths, out_path, overviews=OVERVIEW_LEVELS, remove_tiles=False):
+    """Stitch aligned tile rasters into a single tiled GeoTIFF with overviews."""
+    import numpy as np
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+
+    sources = [rasterio.open(p) for p in sorted(paths)]
+    try:
+        first = sources[0]
+        west, north, res_x, res_y, width, height = _union_grid(sources)
+        nodata = first.nodata
+        profile = dict(MOSAIC_PROFILE,
+                       width=width, height=height, count=first.count,
+                       dtype=first.dtypes[0], crs=first.crs, nodata=nodata,
+                       transform=from_origin(west, north, res_x, res_y))
+        if np.issubdtype(np.dtype(first.dtypes[0]), np.floating):
+            profile['predictor'] = 3
+
+        os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+        # w+ so blocks with masked edges can be merged with what is already written
+        with rasterio.open(out_path, 'w+', **profile) as dst:
+            dst.scales, dst.offsets = first.scales, first.offsets
+            for src in sources:
+                col_off = int(round((src.bounds.left - west) / res_x))
+                row_off = int(round((north - src.bounds.top) / res_y))
+                for _, window in src.block_windows(1):
+                    data = src.read(window=window, masked=True)
+                    target = Window(window.col_off + col_off, window.row_off + row_off,
+                                    window.width, window.height)
+                    if data.mask.any():
+                        # Neighbouring tiles can share an edge pixel; only
+                        # overwrite what this tile actually has data for.
+                        existing = dst.read(window=target)
+                        data = np.where(data.mask, existing, data.filled(0))
+                    else:
+                        data = data.data
+                    dst.write(data, window=target)
+            if overviews:
+                dst.build_overviews(overviews, Resampling.average)
+                dst.update_tags(ns='rio_overview', resampling='average')
+    finally:
+        for src in sources:
+            src.close()
+
+    if remove_tiles:
+        for p in paths:
+            os.remove(p)
+    return out_path
+
+
+def build_vrt(paths, out_path):
+    """Write a GDAL VRT that presents the tiles as one raster without copying them."""
+    import rasterio
+
+    sources = [rasterio.open(p) for p in sorted(paths)]
+    try:
+        first = sources[0]
+        west, north, res_x, res_y, width, height = _union_grid(sources)
+        dtype = {'uint8': 'Byte', 'int16': 'Int16', 'uint16': 'UInt16', 'int32': 'Int32',
+                 'uint32': 'UInt32', 'float32': 'Float32', 'float64': 'Float64'}[first.dtypes[0]]
+        out_dir = os.path.dirname(os.path.abspath(out_path))
+        lines = [f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">',
+                 f'  <SRS>{escape(first.crs.to_wkt())}</SRS>',
+                 f'  <GeoTransform>{west!r}, {res_x!r}, 0, {north!r}, 0, {-res_y!r}</GeoTransform>']
+        for band in range(1, first.count + 1):
+            lines.append(f'  <VRTRasterBand dataType="{dtype}" band="{band}">')
+            if first.nodata is not None:
+                lines.append(f'    <NoDataValue>{first.nodata!r}</NoDataValue>')
+            for src in sources:
+                col_off = int(round((src.bounds.left - west) / res_x))
+                row_off = int(round((north - src.bounds.top) / res_y))
+                rel = os.path.relpath(os.path.abspath(src.name), out_dir)
+                tag = 'ComplexSource' if src.nodata is not None else 'SimpleSource'
+                lines += [f'    <{tag}>',
+                          f'      <SourceFilename relativeToVRT="1">{escape(rel)}</SourceFilename>',
+                          f'      <SourceBand>{band}</SourceBand>',
+                          f'      <SrcRect xOff="0" yOff="0" xSize="{src.width}" ySize="{src.height}"/>',
+                          f'      <DstRect xOff="{col_off}" yOff="{row_off}" xSize="{src.width}" ySize="{src.height}"/>']
+                if src.nodata is not None:
+                    lines.append(f'      <NODATA>{src.nodata!r}</NODATA>')
+                lines.append(f'    </{tag}>')
+            lines.append('  </VRTRasterBand>')
+        lines.append('</VRTDataset>')
+    finally:
+        for src in sources:
+            src.close()
+
+    with open(out_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return out_path
+
+
+class TileAssembler:
+    """Pipeline completion step that mosaics a product once all its tiles have arrived.
+
+    Pass it as `on_complete` and use labels of the form "<product>/tile<id>"
+    when adding tile exports to an ExportPipeline; it is called with each
+    tile's files (Earth Engine may split one tile export into several).
+    `expected` maps each product to its tile count and
+    `out_path_for(product)` names the mosaic and `on_mosaic(path)`, if
+    given, runs on each finished mosaic (e.g. a local boundary mask); it
+    may return the path it moved the mosaic to. With
+    an ExportManifest the tiles are recorded as replaced by the mosaic
+    before they are removed. Pass `overviews=None` when `on_mosaic`
+    rewrites the file anyway (e.g. cog.write_cog builds its own).
+    """
+
+    def __init__(self, expected, out_path_for, remove_tiles=True, manifest=None, on_mosaic=None,
+                 overviews=OVERVIEW_LEVELS):
+        self.expected = dict(expected)
+        self.out_path_for = out_path_for
+        self.on_mosaic = on_mosaic
+        self.overviews = overviews
+        self.remove_tiles = remove_tiles
+        self.manifest = manifest
+        self.received = {product: {} for product in expected}   # product -> {tile label: [paths]}
+        self.mosaics = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, label, paths):
+        product = label.split('/')[0]
+        with self._lock:
+            self.received[product][label] = list(paths)
+            ready = len(self.received[product]) == self.expected[product]
+        if ready:
+            files = [p for tile in self.received[product].values() for p in tile]
+            print(f"🧩 Mosaicking {self.expected[product]} tile(s), {len(files)} file(s), into {product}...")
+            out_path = mosaic_tiles(files, self.out_path_for(product), self.overviews)
+            if self.on_mosaic is not None:
+                out_path = self.on_mosaic(out_path) or out_path
+            if self.manifest is not None:
+                self.manifest.record_replaced(files, out_path)
+            if self.remove_tiles:
+                for p in files:
+                    os.remove(p)
+            self.mosaics[product] = out_path
+
+    def add_cached(self, label, outputs):
+        """Account for a tile the export cache skipped, given its manifest outputs."""
+        product = label.split('/')[0]
+        replaced = [output['replaced_by'] for output in outputs if 'replaced_by' in output]
+        if replaced:
+            # Already part of a finished mosaic.
+            self.mosaics[product] = replaced[0]
+        else:
+            self(label, [output['path'] for output in outputs])
+
+    def split(self, label, child_labels):
+        """A tile was re-planned as smaller tiles: wait for those instead."""
+        product = label.split('/')[0]
+        with self._lock:
+            self.expected[product] += len(child_labels) - 1
+
+    def incomplete(self):
+        return {p: (len(self.received[p]), n) for p, n in self.expected.items() if p not in self.mosaics}
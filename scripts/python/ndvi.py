@@ -0,0 +1,351 @@
+import argparse
+import os
+import sys
+
+# ---------------------------------------------------------------------
+# `ndvi` command line
+#
+# One entry point for the export scripts, which are copies of each
+# other with different constants. The sensor (sensors.py), region,
+# years, seasons, indices, scale, Drive folder and output directory
+# are arguments:
+#
+#   python ndvi.py plan landsat --years 2020-2023 --seasons annual jja
+#   python ndvi.py run  landsat --years 2020-2023 --out E:\EE_ndvi_ndbi
+#
+# `plan` submits nothing. From the region bounds and scale it lays out
+# the same tile grid `run` would and reports pixels per export, tiles
+# and tasks, and the uncompressed output size per dtype. It needs no
+# Earth Engine login: bounds come from the cached boundary if there is
+# one, from --bounds, or from a rough built-in box. Heavy libraries are
+# only imported by `run`, so `plan` starts instantly.
+# ---------------------------------------------------------------------
+DEFAULT_PROJECT = "ee-testing-458522"
+DEFAULT_REGION = 'US'
+DEFAULT_SEASONS = ('annual',)
+GEOMETRY_CACHE_DIR = "geometry_cache"
+MAX_PIXELS = 1e13
+TILE_PIXEL_BUDGET = 1e9
+MAX_CONCURRENT_TASKS = 4
+EE_QUEUE_LIMIT = 3000   # tasks Earth Engine will hold queued per user
+DTYPE_BYTES = {'int16': 2, 'float32': 4}
+DIRECT_FLOAT_NODATA = -9999.0   # fill for masked pixels in directly fetched float32 tiles
+
+# Rough (west, south, east, north) boxes per polygon group, for planning
+# before a boundary has been fetched. Planning with the cached boundary
+# is tighter.
+APPROX_PARTS = {
+    'CONUS': [(-124.85, 24.40, -66.88, 49.39)],
+    'US': [(-124.85, 24.40, -66.88, 49.39),    # lower 48
+           (-179.15, 51.20, -129.98, 71.39),   # Alaska
+           (172.40, 52.30, 180.00, 53.10),     # western Aleutians
+           (-160.25, 18.90, -154.80, 22.24),   # Hawaii
+           (-67.95, 17.88, -65.22, 18.52)],    # Puerto Rico
+}
+
+
+def parse_years(values):
+    """['2020-2023', '2025'] -> [2020, 2021, 2022, 2023, 2025]."""
+    years = []
+    for value in values:
+        first, _, last = value.partition('-')
+        years.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(years))
+
+
+def product_prefix(sensor, index, season, year, region):
+    return f"{sensor}_{index.lower()}_{season}_{year}_{region.lower().replace(' ', '_')}"
+
+
+def products(sensor, years, seasons, indices, region):
+    """[(file prefix, year, season, index)] for every export product of a run, newest year first."""
+    return [(product_prefix(sensor, index, season, year, region), year, season, index)
+            for year in sorted(years, reverse=True) for season in seasons for index in indices]
+
+
+def region_parts(region, cache_dir, bounds=None):
+    """(bounds, [polygon boxes] or None, source) for planning, without contacting Earth Engine."""
+    from geometry_registry import GeometryRegistry, unwrap_boxes
+
+    if bounds is not None:
+        return tuple(bounds), None, 'command line'
+    registry = GeometryRegistry(cache_dir)
+    if registry.has(region):
+        return registry.bounds(region), registry.part_bounds(region), 'cached boundary'
+    if region in APPROX_PARTS:
+        parts = unwrap_boxes(APPROX_PARTS[region])
+        return (min(p[0] for p in parts), min(p[1] for p in parts),
+                max(p[2] for p in parts), max(p[3] for p in parts)), parts, 'built-in approximation'
+    raise SystemExit(f"No cached boundary for '{region}' in {cache_dir}; pass --bounds W S E N")
+
+
+# ---------------------------------------------------------------------
+# plan
+# ---------------------------------------------------------------------
+def plan(sensor, region, years, seasons, indices, scale=None, tile_budget=TILE_PIXEL_BUDGET,
+         cache_dir=GEOMETRY_CACHE_DIR, bounds=None):
+    """Size up a run without submitting anything; returns a dict of the estimates.
+
+    A `tile_budget` of 0 plans one untiled export per product.
+    """
+    from direct_fetch import choose_transport
+    from sensors import SENSORS
+    from tiling import bbox_intersecting_tiles, grid_for_bounds, plan_tiles, whole_grid_tile
+
+    scale = scale or SENSORS[sensor]['scale']
+    bounds, parts, source = region_parts(region, cache_dir, bounds)
+    grid = grid_for_bounds(bounds, scale)
+    if tile_budget:
+        tiles = plan_tiles(grid, tile_budget, intersects=bbox_intersecting_tiles(parts) if parts else None,
+                           parts=parts)
+    else:
+        tiles = [whole_grid_tile(grid)]
+    pixels = [t.width * t.height for t in tiles]
+    n_products = len(products(sensor, years, seasons, indices, region))
+    return {
+        'sensor': sensor,
+        'region': region,
+        'bounds': bounds,
+        'bounds_source': source,
+        'scale': scale,
+        'grid': (grid.width, grid.height),
+        'products': n_products,
+        'tiles_per_product': len(tiles),
+        'tasks': n_products * len(tiles),
+        'transport': choose_transport(tiles),
+        'pixels_per_product': sum(pixels),
+        'largest_export_pixels': max(pixels) if pixels else 0,
+        'bytes_per_product': {dtype: sum(pixels) * size for dtype, size in DTYPE_BYTES.items()},
+        'total_bytes': {dtype: n_products * sum(pixels) * size for dtype, size in DTYPE_BYTES.items()},
+    }
+
+
+def _size(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return f"{n:.1f} {unit}"
+        n /= 1024.0
+    return f"{n:.1f} TB"
+
+
+def print_plan(estimate, max_pixels=MAX_PIXELS):
+    from direct_fetch import DIRECT_MAX_PIXELS
+
+    e = estimate
+    print(f"📐 {e['sensor']} over {e['region']} at {e['scale']} m "
+          f"(bounds from {e['bounds_source']}: {', '.join(f'{b:.2f}' for b in e['bounds'])})")
+    print(f"   grid: {e['grid'][0]} x {e['grid'][1]} pixels")
+    print(f"   products: {e['products']}, tiles per product: {e['tiles_per_product']}, "
+          f"export tasks: {e['tasks']}")
+    print(f"   transport: {e['transport']} (direct fetch up to {DIRECT_MAX_PIXELS:.0e} pixels)")
+    print(f"   pixels per product: {e['pixels_per_product']:.3e} "
+          f"(largest export {e['largest_export_pixels']:.3e})")
+    for dtype in DTYPE_BYTES:
+        print(f"   {dtype:>8}: {_size(e['bytes_per_product'][dtype])} per product, "
+              f"{_size(e['total_bytes'][dtype])} in total (uncompressed)")
+    if e['largest_export_pixels'] > max_pixels:
+        print(f"⚠️ An export exceeds maxPixels ({max_pixels:.0e}); lower --tile-budget")
+    if e['tasks'] > EE_QUEUE_LIMIT:
+        print(f"⚠️ {e['tasks']} tasks is more than Earth Engine queues at once ({EE_QUEUE_LIMIT}); "
+              f"the scheduler will feed them in batches")
+
+
+# ---------------------------------------------------------------------
+# run
+# ---------------------------------------------------------------------
+def run(sensor, region, years, seasons, indices, out_dir, drive_folder, project=DEFAULT_PROJECT,
+        scale=None, tile_budget=TILE_PIXEL_BUDGET, cache_dir=GEOMETRY_CACHE_DIR, dtype='int16',
+        max_tasks=MAX_CONCURRENT_TASKS, max_pixels=MAX_PIXELS, transport='auto', crs=None):
+    """Export, download, mosaic, mask and ingest every product, as the per-sensor scripts do.
+
+    With transport 'direct' (or 'auto' and a region of at most
+    direct_fetch.DIRECT_MAX_PIXELS) products are fetched straight into
+    their mosaics instead of being exported through Drive; once a fetch
+    fails, that product and the rest are exported. With `crs`
+    (e.g. 'EPSG:5070') each masked mosaic is reprojected onto an
+    equal-area grid in that CRS before it is written out and ingested.
+    """
+    import ee
+    from cog import NODATA, export_options, to_scaled_int16, write_cog
+    from datacube import Datacube
+    from direct_fetch import FetchError, choose_transport, ee_url_maker, fetch_tiles, fetch_to_mosaic
+    from drive_download import DriveDownloader, PyDriveSource
+    from export_cache import MANIFEST_NAME, ExportManifest
+    from geometry_registry import GeometryRegistry
+    from metrics import RunMetrics
+    from mosaic import OVERVIEW_LEVELS, TileAssembler
+    from pipeline import ExportPipeline, summarize
+    from reproject import Reprojector
+    from scheduler import ExportScheduler, tile_jobs
+    from sensors import SENSORS, composite
+    from tiling import ee_intersecting_tiles, grid_for_bounds, plan_tiles, tile_pixel_budget, whole_grid_tile
+
+    ee.Initialize(project=project)
+    scale = scale or SENSORS[sensor]['scale']
+
+    # Fetched once and cached locally; composites are clipped after download
+    registry = GeometryRegistry(cache_dir)
+    geom = registry.ee_geometry(region, scale)
+    grid = grid_for_bounds(registry.bounds(region), scale)
+    if tile_budget:
+        tiles = plan_tiles(grid, tile_pixel_budget(dtype, tile_budget), intersects=ee_intersecting_tiles(geom),
+                           parts=registry.part_bounds(region))
+    else:
+        tiles = [whole_grid_tile(grid)]
+    planned = {prefix: (year, season, index)
+               for prefix, year, season, index in products(sensor, years, seasons, indices, region)}
+    transport = choose_transport(tiles) if transport == 'auto' else transport
+    print(f"🧱 {len(planned)} product(s) x {len(tiles)} tile(s) for {SENSORS[sensor]['label']} "
+          f"({transport} transport)")
+
+    composites = {}
+
+    def image_for(year, season, index):
+        if (year, season) not in composites:
+            image = composite(sensor, geom, year, season, indices)
+            composites[year, season] = to_scaled_int16(image) if dtype == 'int16' else image
+        return composites[year, season].select(index)
+
+    def mosaic_path_for(file_prefix):
+        year, season, _ = planned[file_prefix]
+        return os.path.join(out_dir, sensor, f"{season}_{year}", f"{file_prefix}.tif")
+
+    def local_path_for(title):
+        return os.path.join(out_dir, sensor, "tiles", title)
+
+    cube = Datacube(os.path.join(out_dir, "datacube.zarr"))
+    reproject = Reprojector(crs, cache_dir=os.path.join(out_dir, "warp_cache")) if crs else None
+
+    def finish_mosaic(path):
+        year, season, index = planned[os.path.splitext(os.path.basename(path))[0]]
+        registry.apply_mask(region, path)
+        if reproject is not None:
+            reproject(path)
+        if dtype == 'int16':
+            write_cog(path)
+        cube.append(f"{sensor}/{index.lower()}_{season}", str(year), path)
+
+    metrics = RunMetrics(os.path.join(out_dir, "metrics", "run_metrics.jsonl"))
+
+    if transport == 'direct':
+        fetch_plan = fetch_tiles(grid, ee_intersecting_tiles(geom))
+        nodata = NODATA if dtype == 'int16' else DIRECT_FLOAT_NODATA
+        for prefix, (year, season, index) in list(planned.items()):
+            try:
+                path, _ = fetch_to_mosaic(ee_url_maker(image_for(year, season, index), grid, nodata),
+                                          grid, fetch_plan, mosaic_path_for(prefix), nodata=nodata,
+                                          metrics=metrics)
+            except FetchError as e:
+                # Retries are spent (e.g. interactive compute limits): export the rest instead.
+                print(f"⚠️ Direct fetch failed for {prefix} ({e}); exporting the remaining "
+                      f"{len(planned)} product(s) instead")
+                break
+            finish_mosaic(path)
+            del planned[prefix]
+        if not planned:
+            metrics.write_prometheus(os.path.join(out_dir, "metrics", "ndvi_export.prom"))
+            metrics.report()
+            print("🎉 All products fetched.")
+            return 0
+
+    from pydrive2.auth import GoogleAuth
+    from pydrive2.drive import GoogleDrive
+
+    gauth = GoogleAuth()
+    gauth.LocalWebserverAuth()
+    drive = GoogleDrive(gauth)
+
+    manifest = ExportManifest(os.path.join(out_dir, MANIFEST_NAME))
+    assembler = TileAssembler({prefix: len(tiles) for prefix in planned}, mosaic_path_for,
+                              manifest=manifest, on_mosaic=finish_mosaic,
+                              overviews=None if dtype == 'int16' else OVERVIEW_LEVELS)
+    pipeline = ExportPipeline(DriveDownloader(PyDriveSource(drive), metrics=metrics), drive_folder,
+                              local_path_for, on_complete=assembler, manifest=manifest, metrics=metrics)
+
+    def watch(job, task, key):
+        if task is None:
+            assembler.add_cached(job.label, manifest.outputs(key))
+        else:
+            pipeline.add(task, job.label, job.file_prefix, key)
+
+    def replanned(job, children):
+        assembler.split(job.label, [child.label for child in children])
+        pipeline.discard(job.label)
+
+    scheduler = ExportScheduler(pipeline.monitor, max_tasks, manifest=manifest,
+                                on_submit=watch, on_split=replanned)
+
+    params = dict(folder=drive_folder, maxPixels=max_pixels, **export_options(dtype))
+    for prefix, (year, season, index) in planned.items():
+        for job in tile_jobs(image_for(year, season, index), grid, tiles,
+                             f"{sensor}_{index}_{season}_{year}", prefix, params, priority=year):
+            scheduler.add(job)
+
+    print("📤 Submitting exports. Files are downloaded as each export finishes...")
+    results = pipeline.run(wait=scheduler.run)
+    metrics.write_prometheus(os.path.join(out_dir, "metrics", "ndvi_export.prom"))
+    metrics.report()
+
+    if summarize(results) or assembler.incomplete():
+        print(f"⚠️ Some exports or downloads did not complete; tiles received: {assembler.incomplete()}")
+        return 1
+    print("🎉 All files downloaded and cleaned up.")
+    return 0
+
+
+def main(argv=None):
+    from sensors import SENSORS, SEASONS, sensor_indices
+
+    parser = argparse.ArgumentParser(prog='ndvi', description="Plan or run NDVI/NDBI exports from Earth Engine.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in [('plan', "estimate pixels, tasks and output size; submits nothing"),
+                            ('run', "export, download, mosaic and ingest")]:
+        p = commands.add_parser(name, help=help_text)
+        p.add_argument('sensor', choices=sorted(SENSORS))
+        p.add_argument('--years', nargs='+', required=True, help="e.g. 2020-2023 or 2019 2021")
+        p.add_argument('--seasons', nargs='+', default=list(DEFAULT_SEASONS), choices=sorted(SEASONS))
+        p.add_argument('--indices', nargs='+', default=['NDVI'], help="NDVI and/or NDBI")
+        p.add_argument('--region', default=DEFAULT_REGION, help="US, CONUS or a state name")
+        p.add_argument('--scale', type=float, help="meters (default: the sensor's native resolution)")
+        p.add_argument('--tile-budget', type=float, default=TILE_PIXEL_BUDGET,
+                       help="max pixels per tile export; 0 for one export per product")
+        p.add_argument('--cache-dir', default=GEOMETRY_CACHE_DIR, help="boundary cache directory")
+        p.add_argument('--max-pixels', type=float, default=MAX_PIXELS)
+        if name == 'plan':
+            p.add_argument('--bounds', nargs=4, type=float, metavar=('W', 'S', 'E', 'N'))
+            p.add_argument('--json', action='store_true', help="print the estimate as JSON")
+        else:
+            p.add_argument('--out', required=True, help="local output directory")
+            p.add_argument('--drive-folder', help="default: <SENSOR>_<REGION>_NDVI")
+            p.add_argument('--project', default=DEFAULT_PROJECT, help="Earth Engine cloud project")
+            p.add_argument('--dtype', choices=sorted(DTYPE_BYTES), default='int16')
+            p.add_argument('--max-tasks', type=int, default=MAX_CONCURRENT_TASKS,
+                           help="export tasks queued or running at once")
+            p.add_argument('--transport', choices=['auto', 'direct', 'export'], default='auto',
+                           help="direct pixel fetch or Drive export (auto: by region size)")
+            p.add_argument('--crs', help="reproject mosaics onto an equal-area grid, e.g. EPSG:5070")
+    args = parser.parse_args(argv)
+
+    indices = [i.upper() for i in args.indices]
+    unsupported = set(indices) - set(sensor_indices(args.sensor))
+    if unsupported:
+        parser.error(f"{args.sensor} cannot produce {', '.join(sorted(unsupported))}")
+    years = parse_years(args.years)
+
+    if args.command == 'plan':
+        estimate = plan(args.sensor, args.region, years, args.seasons, indices, args.scale,
+                        args.tile_budget, args.cache_dir, args.bounds)
+        if args.json:
+            import json
+            print(json.dumps(estimate, indent=2))
+        else:
+            print_plan(estimate, args.max_pixels)
+        return 0
+    drive_folder = args.drive_folder or f"{args.sensor}_{args.region}_NDVI".upper().replace(' ', '_')
+    return run(args.sensor, args.region, years, args.seasons, indices, args.out, drive_folder,
+               args.project, args.scale, args.tile_budget, args.cache_dir, args.dtype,
+               args.max_tasks, args.max_pixels, args.transport, args.crs)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
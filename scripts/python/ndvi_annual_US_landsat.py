@@ -1,8 +1,20 @@
 import ee
 import os
-import time
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
+from cog import export_options, to_scaled_int16, write_cog
+from datacube import Datacube
+from drive_download import DriveDownloader, PyDriveSource
+from export_cache import MANIFEST_NAME, ExportManifest
+from geometry_registry import GeometryRegistry
+from metrics import RunMetrics
+from mosaic import OVERVIEW_LEVELS, TileAssembler
+from pipeline import ExportPipeline, summarize
+from reproject import Reprojector
+from scheduler import ExportScheduler, tile_jobs
+from sensors import sensor_query
+from state_store import STATE_DB_NAME, StateStore, Unit, verify_output
+from tiling import ee_intersecting_tiles, grid_for_bounds, plan_tiles, tile_pixel_budget
 
 # ---------------------------------------------------------------------
 # Step 1: Initialize Earth Engine
@@ -18,105 +30,165 @@ DRIVE_FOLDER_NAME = "US_NDVI_NDBI_Annual"
 LOCAL_ROOT_DIR = r"E:\EE_ndvi_ndbi"
 SCALE = 30
 MAX_PIXELS = 1e13
+TILE_PIXEL_BUDGET = 1e9  # max pixels per tile export
+MAX_CONCURRENT_TASKS = 4  # export tasks queued or running at once
+SIMPLIFY_TOLERANCE = SCALE  # meters; server-side boundary simplification
+OUTPUT_DTYPE = 'int16'  # scaled-int16 COGs (0.0001 steps); 'float32' for full-precision floats
+MAX_CLOUD_COVER = None  # e.g. 80 to drop mostly cloudy scenes (CLOUD_COVER) before any pixel work
+REPROJECT_CRS = None  # e.g. 'EPSG:5070' to warp mosaics onto a CONUS Albers grid before ingest
 
 # ---------------------------------------------------------------------
 # Define US Geometry
 # ---------------------------------------------------------------------
-us_geom = ee.FeatureCollection("USDOS/LSIB_SIMPLE/2017") \
-    .filter(ee.Filter.eq("country_na", "United States")) \
-    .geometry()
+# Fetched once and cached locally; the simplified copy is used server-side
+# and composites are clipped after download with a cached raster mask.
+registry = GeometryRegistry(os.path.join(LOCAL_ROOT_DIR, "geometry"))
+us_geom = registry.ee_geometry("US", SIMPLIFY_TOLERANCE)
 
 # ---------------------------------------------------------------------
-# NDVI and NDBI Calculation
+# Work out what is left to do
 # ---------------------------------------------------------------------
-def add_indices(image):
-    ndvi = image.normalizedDifference(['SR_B5', 'SR_B4']).rename('NDVI')  # NIR, Red
-    ndbi = image.normalizedDifference(['SR_B6', 'SR_B5']).rename('NDBI')  # SWIR, NIR
-    return image.addBands([ndvi, ndbi])
+# Each (year, metric) product is tracked from submission to datacube
+# ingest; finished ones are skipped, so extending the years or re-running
+# after a failed login or download only does the missing products.
+state = StateStore(os.path.join(LOCAL_ROOT_DIR, STATE_DB_NAME))
+state.reconcile()
+units = {f"{metric.lower()}_{year}_us": Unit('landsat', 'US', str(year), metric)
+         for year in range(START_YEAR, END_YEAR + 1) for metric in ['NDVI', 'NDBI']}
+todo = {product: unit for product, unit in units.items() if not state.is_done(unit)}
+state.report('landsat', 'US')
+if not todo:
+    print("✅ Every product is already downloaded and ingested.")
+    raise SystemExit(0)
 
-# ---------------------------------------------------------------------
-# Step 2: Export Earth Engine Data
-# ---------------------------------------------------------------------
-export_tasks = []
-
-for year in range(START_YEAR, END_YEAR + 1):
-    print(f"🌎 Starting processing for {year}...")
-
-    collection = ee.ImageCollection("LANDSAT/LC08/C02/T1_L2") \
-        .filterDate(f"{year}-01-01", f"{year}-12-31") \
-        .filterBounds(us_geom) \
-        .map(lambda img: img.updateMask(img.select("QA_PIXEL").bitwiseAnd(1 << 3).eq(0))) \
-        .map(add_indices)
-
-    composite = collection.select(['NDVI', 'NDBI']).mean().clip(us_geom)
-
-    for metric in ['NDVI', 'NDBI']:
-        task = ee.batch.Export.image.toDrive(
-            image=composite.select(metric),
-            description=f"{metric}_{year}_US",
-            folder=DRIVE_FOLDER_NAME,
-            fileNamePrefix=f"{metric.lower()}_{year}_us",
-            region=us_geom,
-            scale=SCALE,
-            maxPixels=MAX_PIXELS
-        )
-        task.start()
-        export_tasks.append((task, metric, year))
-
-print("📤 Export tasks submitted. Waiting for them to complete...")
+def unit_of(label):
+    return units[label.split('/')[0]]
 
 # ---------------------------------------------------------------------
-# Step 3: Wait for All Exports to Finish
+# Plan export tiles (one grid shared by every year and metric)
 # ---------------------------------------------------------------------
-all_done = False
-while not all_done:
-    all_done = True
-    for task, metric, year in export_tasks:
-        status = task.status()['state']
-        print(f"{metric}_{year}: {status}")
-        if status not in ['COMPLETED', 'FAILED', 'CANCELLED']:
-            all_done = False
-    if not all_done:
-        print("⏳ Waiting 30 seconds before next check...\n")
-        time.sleep(30)
-
-print("✅ All Earth Engine exports are done. Beginning download...")
+grid = grid_for_bounds(registry.bounds("US"), SCALE)
+tiles = plan_tiles(grid, tile_pixel_budget(OUTPUT_DTYPE, TILE_PIXEL_BUDGET),
+                   intersects=ee_intersecting_tiles(us_geom), parts=registry.part_bounds("US"))
+print(f"🧱 {len(tiles)} tile(s) of up to {tile_pixel_budget(OUTPUT_DTYPE, TILE_PIXEL_BUDGET):.1e} pixels per export")
 
 # ---------------------------------------------------------------------
-# Step 4: Authenticate Google Drive
+# Step 2: Authenticate Google Drive
+# (done up front so downloads can start as soon as the first export ends)
 # ---------------------------------------------------------------------
 gauth = GoogleAuth()
 gauth.LocalWebserverAuth()
 drive = GoogleDrive(gauth)
 
+def year_dir(name):
+    # Extract year from filename
+    year_part = [s for s in name.split('_') if s.isdigit()]
+    year = year_part[0] if year_part else 'unknown'
+    return os.path.join(LOCAL_ROOT_DIR, year)
+
+def local_path_for(title):
+    return os.path.join(year_dir(title), "tiles", title)
+
+def mosaic_path_for(file_prefix):
+    return os.path.join(year_dir(file_prefix), f"{file_prefix}.tif")
+
+# Finished mosaics are also appended to the time-series datacube
+cube = Datacube(os.path.join(LOCAL_ROOT_DIR, "datacube.zarr"))
+
+# Optional warp onto an equal-area grid; the warp grid is computed once
+# and reused for every year and metric (in threads: this script has no
+# __main__ guard for worker processes)
+reproject = Reprojector(REPROJECT_CRS, cache_dir=os.path.join(LOCAL_ROOT_DIR, "warp_cache"),
+                        processes=False) if REPROJECT_CRS else None
+
+def finish_mosaic(path):
+    unit = unit_of(os.path.splitext(os.path.basename(path))[0])
+    try:
+        registry.apply_mask("US", path)
+        if reproject is not None:
+            reproject(path)
+        if OUTPUT_DTYPE == 'int16':
+            write_cog(path)
+        state.advance(unit, 'verified', path=verify_output(path))
+        cube.append(f"landsat/{unit.metric.lower()}_annual", unit.period, path)
+        state.advance(unit, 'ingested')
+    except Exception as e:
+        state.fail(unit, e)
+        raise
+
+# Finished exports are recorded here so re-runs skip them or re-attach
+manifest = ExportManifest(os.path.join(LOCAL_ROOT_DIR, MANIFEST_NAME))
+
+# Stage timings go to metrics/run_metrics.jsonl and a Prometheus textfile
+metrics = RunMetrics(os.path.join(LOCAL_ROOT_DIR, "metrics", "run_metrics.jsonl"))
+
+# Each product's tiles are stitched into one GeoTIFF once they have all arrived
+assembler = TileAssembler({product: len(tiles) for product in todo},
+                          mosaic_path_for, manifest=manifest, on_mosaic=finish_mosaic,
+                          overviews=None if OUTPUT_DTYPE == 'int16' else OVERVIEW_LEVELS)
+pipeline = ExportPipeline(DriveDownloader(PyDriveSource(drive), metrics=metrics), DRIVE_FOLDER_NAME,
+                          local_path_for, on_complete=assembler, manifest=manifest,
+                          metrics=metrics,
+                          on_event=lambda label, event: state.advance(unit_of(label), event, part=label))
+
+def watch(job, task, key):
+    if task is None:
+        state.advance(unit_of(job.label), 'downloaded', part=job.label)
+        assembler.add_cached(job.label, manifest.outputs(key))
+    else:
+        state.advance(unit_of(job.label), 'submitted', part=job.label)
+        pipeline.add(task, job.label, job.file_prefix, key)
+
+def replanned(job, children):
+    state.split(unit_of(job.label), job.label, [child.label for child in children])
+    assembler.split(job.label, [child.label for child in children])
+    pipeline.discard(job.label)
+
+def given_up(job, status):
+    state.fail(unit_of(job.label), status.get('error_message', status['state']), part=job.label)
+
+# Bounded number of tasks in flight, newest year first; failed tiles are
+# retried or split into smaller tiles
+scheduler = ExportScheduler(pipeline.monitor, MAX_CONCURRENT_TASKS, manifest=manifest,
+                            on_submit=watch, on_split=replanned, on_failed=given_up)
+
+# ---------------------------------------------------------------------
+# Step 3: Plan Earth Engine exports
 # ---------------------------------------------------------------------
-# Step 5: Download and Delete Files
-# ---------------------------------------------------------------------
-# Find export folder
-folder_list = drive.ListFile({
-    'q': f"title='{DRIVE_FOLDER_NAME}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
-}).GetList()
-if not folder_list:
-    raise Exception(f"Folder '{DRIVE_FOLDER_NAME}' not found in Google Drive.")
-folder_id = folder_list[0]['id']
-
-# Download each .tif and delete
-file_list = drive.ListFile({
-    'q': f"'{folder_id}' in parents and trashed=false"
-}).GetList()
-
-for file in file_list:
-    title = file['title']
-    if title.endswith('.tif'):
-        print(f"⬇️ Downloading: {title}")
-        # Extract year from filename
-        year_part = [s for s in title.split('_') if s.isdigit()]
-        year = year_part[0] if year_part else 'unknown'
-        local_dir = os.path.join(LOCAL_ROOT_DIR, year)
-        os.makedirs(local_dir, exist_ok=True)
-        file_path = os.path.join(local_dir, title)
-        file.GetContentFile(file_path)
-        print(f"🗑️ Deleting from Drive: {title}")
-        file.Delete()
-
-print("🎉 All files downloaded and cleaned up.")
+for year in range(START_YEAR, END_YEAR + 1):
+    year_metrics = [m for m in ['NDVI', 'NDBI'] if f"{m.lower()}_{year}_us" in todo]
+    if not year_metrics:
+        continue
+    print(f"🌎 Planning exports for {year}...")
+
+    # QA_PIXEL bit-3 mask, NDVI = nd(SR_B5, SR_B4) and NDBI = nd(SR_B6, SR_B5),
+    # optimized to carry only those bands through one fused map (see query.py)
+    query = sensor_query('landsat', us_geom, f"{year}-01-01", f"{year}-12-31", ['NDVI', 'NDBI'],
+                         MAX_CLOUD_COVER)
+    composite = query.optimize().build().mean()
+    if OUTPUT_DTYPE == 'int16':
+        composite = to_scaled_int16(composite)
+
+    for metric in year_metrics:
+        file_prefix = f"{metric.lower()}_{year}_us"
+        params = dict(folder=DRIVE_FOLDER_NAME, maxPixels=MAX_PIXELS, **export_options(OUTPUT_DTYPE))
+        jobs = tile_jobs(composite.select(metric), grid, tiles, f"{metric}_{year}_US",
+                         file_prefix, params, priority=year)
+        state.plan(todo[file_prefix], [job.label for job in jobs])
+        for job in jobs:
+            scheduler.add(job)
+
+print("📤 Submitting exports. Files are downloaded as each export finishes...")
+
+# ---------------------------------------------------------------------
+# Step 4: Download, verify and delete each export as it completes
+# ---------------------------------------------------------------------
+results = pipeline.run(wait=scheduler.run)
+metrics.write_prometheus(os.path.join(LOCAL_ROOT_DIR, "metrics", "ndvi_export.prom"))
+metrics.report()
+
+if summarize(results) or assembler.incomplete():
+    print(f"⚠️ Some exports or downloads did not complete; tiles received: {assembler.incomplete()}")
+else:
+    print("🎉 All files downloaded and cleaned up.")
+state.report('landsat', 'US')
@@ -1,8 +1,18 @@
 import ee
 import os
-import time
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
+from cog import SCALE as INDEX_SCALE, export_options, write_cog
+from datacube import Datacube
+from drive_download import DriveDownloader, PyDriveSource
+from export_cache import MANIFEST_NAME, ExportManifest
+from geometry_registry import GeometryRegistry
+from metrics import RunMetrics
+from monthly_store import MonthlyStore, monthly_sum_count, season_months
+from pipeline import ExportPipeline, summarize
+from reproject import Reprojector
+from scheduler import ExportJob, ExportScheduler
+from state_store import STATE_DB_NAME, StateStore, Unit, verify_output
 
 # ---------------------------------------------------------------------
 # Initialize Earth Engine
@@ -18,111 +28,153 @@ DRIVE_FOLDER_NAME = "US_MODIS_NDVI_2025"  # Update automatically if needed
 LOCAL_ROOT_DIR = r"E:\EE_modis_ndvi"
 SCALE = 250
 MAX_PIXELS = 1e13
+SIMPLIFY_TOLERANCE = SCALE  # meters; server-side boundary simplification
+MAX_CONCURRENT_TASKS = 4  # export tasks queued or running at once
+OUTPUT_DTYPE = 'int16'  # int16 monthly stacks and scaled-int16 COG seasons; 'float32' for floats
+REPROJECT_CRS = None  # e.g. 'EPSG:5070' to warp season means onto a CONUS Albers grid before ingest
 
 # ---------------------------------------------------------------------
 # Define US boundary
 # ---------------------------------------------------------------------
-us_geom = ee.FeatureCollection("USDOS/LSIB_SIMPLE/2017") \
-    .filter(ee.Filter.eq("country_na", "United States")) \
-    .geometry()
+# Fetched once and cached locally; the simplified copy is used server-side
+# and season means are clipped locally with a cached raster mask.
+registry = GeometryRegistry(os.path.join(LOCAL_ROOT_DIR, "geometry"))
+us_geom = registry.ee_geometry("US", SIMPLIFY_TOLERANCE)
 
 # ---------------------------------------------------------------------
-# Composite calculation for MODIS NDVI (scaled by 0.0001)
+# Work out what is left to do
+# ---------------------------------------------------------------------
+# Each year's monthly stack is tracked from submission until both season
+# means are in the datacube; finished years are skipped on re-runs.
+state = StateStore(os.path.join(LOCAL_ROOT_DIR, STATE_DB_NAME))
+state.reconcile()
+units = {f"monthly_{year}": Unit('modis', 'US', str(year), 'NDVI')
+         for year in range(START_YEAR, END_YEAR + 1)}
+todo = {label: unit for label, unit in units.items() if not state.is_done(unit)}
+state.report('modis', 'US')
+if not todo:
+    print("✅ Every year is already downloaded and ingested.")
+    raise SystemExit(0)
+
+# ---------------------------------------------------------------------
+# MODIS NDVI collection (scaled by 0.0001 unless kept as stored int16)
 # ---------------------------------------------------------------------
-def get_modis_ndvi(start_date, end_date):
-    col = ee.ImageCollection("MODIS/061/MOD13Q1") \
+def get_modis_collection(start_date, end_date):
+    collection = ee.ImageCollection("MODIS/061/MOD13Q1") \
         .filterDate(start_date, end_date) \
         .filterBounds(us_geom) \
-        .select("NDVI") \
-        .map(lambda img: img.multiply(0.0001).copyProperties(img, img.propertyNames()))  # scale factor
-    return col.mean().clip(us_geom)
+        .select("NDVI")
+    if OUTPUT_DTYPE == 'int16':
+        return collection
+    return collection.map(lambda img: img.multiply(0.0001).copyProperties(img, img.propertyNames()))  # scale factor
 
 # ---------------------------------------------------------------------
-# Create and submit exports for each year
+# Google Drive Auth
+# (done up front so downloads can start as soon as the first export ends)
 # ---------------------------------------------------------------------
-export_tasks = []
+gauth = GoogleAuth()
+gauth.LocalWebserverAuth()
+drive = GoogleDrive(gauth)
+
+# Monthly sum/count stacks land in the store; annual and JJA means are
+# derived from them locally as each year arrives.
+store = MonthlyStore(os.path.join(LOCAL_ROOT_DIR, "monthly"),
+                     sum_scale=INDEX_SCALE if OUTPUT_DTYPE == 'int16' else 1.0)
+
+def local_path_for(title):
+    year = [s for s in title.split('_') if s.isdigit()][0]
+    return store.path("modis", int(year))
+
+# Season means are also appended to the time-series datacube
+cube = Datacube(os.path.join(LOCAL_ROOT_DIR, "datacube.zarr"))
+
+# Optional warp onto an equal-area grid; the warp grid is computed once
+# and reused for every year and season (in threads: this script has no
+# __main__ guard for worker processes)
+reproject = Reprojector(REPROJECT_CRS, cache_dir=os.path.join(LOCAL_ROOT_DIR, "warp_cache"),
+                        processes=False) if REPROJECT_CRS else None
+
+def derive_seasons(label, path):
+    year = int(label.split('_')[-1])
+    unit = units[label]
+    try:
+        state.advance(unit, 'verified', path=verify_output(path))
+        for season, folder in [('annual', f"Annual_{year}"), ('jja', f"JJA_{year}")]:
+            out_path = os.path.join(LOCAL_ROOT_DIR, folder, f"modis_ndvi_{season}_{year}_us.tif")
+            store.season_mean("modis", season_months(year, season), out_path)
+            registry.apply_mask("US", out_path)
+            if reproject is not None:
+                reproject(out_path)
+            if OUTPUT_DTYPE == 'int16':
+                write_cog(out_path)
+            cube.append(f"modis/ndvi_{season}", str(year), out_path)
+            print(f"📆 {season} mean for {year}: {out_path}")
+        state.advance(unit, 'ingested')
+    except Exception as e:
+        state.fail(unit, e)
+        raise
+
+# Finished exports are recorded here so re-runs skip them or re-attach
+manifest = ExportManifest(os.path.join(LOCAL_ROOT_DIR, MANIFEST_NAME))
+
+# Stage timings go to metrics/run_metrics.jsonl and a Prometheus textfile
+metrics = RunMetrics(os.path.join(LOCAL_ROOT_DIR, "metrics", "run_metrics.jsonl"))
+pipeline = ExportPipeline(DriveDownloader(PyDriveSource(drive), metrics=metrics), DRIVE_FOLDER_NAME,
+                          local_path_for, postprocess=derive_seasons, manifest=manifest,
+                          metrics=metrics,
+                          on_event=lambda label, event: state.advance(units[label], event))
+
+def watch(job, task, key):
+    if task is None:
+        # Stack already downloaded by an earlier run; just finish the year
+        state.advance(units[job.label], 'downloaded')
+        try:
+            derive_seasons(job.label, store.path("modis", int(job.label.split('_')[-1])))
+        except Exception as e:
+            print(f"❌ {job.label}: {e}")
+    else:
+        state.advance(units[job.label], 'submitted')
+        pipeline.add(task, job.label, job.file_prefix, key)
+
+def given_up(job, status):
+    state.fail(units[job.label], status.get('error_message', status['state']))
 
+# Newest year first; transient failures are retried with backoff
+scheduler = ExportScheduler(pipeline.monitor, MAX_CONCURRENT_TASKS, manifest=manifest, on_submit=watch,
+                            on_failed=given_up)
+
+# ---------------------------------------------------------------------
+# Plan one monthly sum/count export per year
+# ---------------------------------------------------------------------
 for year in range(START_YEAR, END_YEAR + 1):
-    # Annual NDVI
-    annual = get_modis_ndvi(f"{year}-01-01", f"{year}-12-31")
-    task_annual = ee.batch.Export.image.toDrive(
-        image=annual,
-        description=f"MODIS_NDVI_Annual_{year}",
-        folder=DRIVE_FOLDER_NAME,
-        fileNamePrefix=f"modis_ndvi_annual_{year}_us",
-        region=us_geom,
-        scale=SCALE,
-        maxPixels=MAX_PIXELS
+    if f"monthly_{year}" not in todo:
+        continue
+    state.plan(todo[f"monthly_{year}"])
+    monthly = monthly_sum_count(
+        get_modis_collection(f"{year}-01-01", f"{year + 1}-01-01"), year, dtype=OUTPUT_DTYPE
     )
-    task_annual.start()
-    export_tasks.append((task_annual, f"annual_{year}"))
-
-    # JJA NDVI
-    jja = get_modis_ndvi(f"{year}-06-01", f"{year}-08-31")
-    task_jja = ee.batch.Export.image.toDrive(
-        image=jja,
-        description=f"MODIS_NDVI_JJA_{year}",
+    params = dict(
+        description=f"MODIS_NDVI_Monthly_{year}",
         folder=DRIVE_FOLDER_NAME,
-        fileNamePrefix=f"modis_ndvi_jja_{year}_us",
         region=us_geom,
         scale=SCALE,
-        maxPixels=MAX_PIXELS
+        maxPixels=MAX_PIXELS,
+        **export_options(OUTPUT_DTYPE, nodata=False)  # sums and counts have no nodata
     )
-    task_jja.start()
-    export_tasks.append((task_jja, f"jja_{year}"))
-
-print("📤 Export tasks submitted. Waiting for them to complete...\n")
+    scheduler.add(ExportJob(monthly, f"monthly_{year}", store.file_prefix("modis", year), params,
+                            priority=year))
 
-# ---------------------------------------------------------------------
-# Wait for all tasks to complete
-# ---------------------------------------------------------------------
-while True:
-    all_done = True
-    for task, label in export_tasks:
-        state = task.status()["state"]
-        print(f"{label}: {state}")
-        if state not in ['COMPLETED', 'FAILED', 'CANCELLED']:
-            all_done = False
-    if all_done:
-        print("\n✅ All export tasks finished.")
-        break
-    print("⏳ Waiting 30 seconds...\n")
-    time.sleep(30)
+print("📤 Submitting exports. Files are downloaded as each export finishes...\n")
 
 # ---------------------------------------------------------------------
-# Google Drive Auth
+# Download each export as soon as it completes and derive the seasons
 # ---------------------------------------------------------------------
-gauth = GoogleAuth()
-gauth.LocalWebserverAuth()
-drive = GoogleDrive(gauth)
+results = pipeline.run(wait=scheduler.run)
+metrics.write_prometheus(os.path.join(LOCAL_ROOT_DIR, "metrics", "ndvi_export.prom"))
+metrics.report()
 
-# ---------------------------------------------------------------------
-# Download and delete files
-# ---------------------------------------------------------------------
-folder_list = drive.ListFile({
-    'q': f"title='{DRIVE_FOLDER_NAME}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
-}).GetList()
-if not folder_list:
-    raise Exception(f"Drive folder '{DRIVE_FOLDER_NAME}' not found.")
-folder_id = folder_list[0]['id']
-
-file_list = drive.ListFile({
-    'q': f"'{folder_id}' in parents and trashed=false"
-}).GetList()
-
-for file in file_list:
-    title = file['title']
-    print(f"⬇️ Downloading: {title}")
-    label = "unknown"
-    if "jja" in title:
-        label = f"JJA_{[s for s in title.split('_') if s.isdigit()][0]}"
-    elif "annual" in title:
-        label = f"Annual_{[s for s in title.split('_') if s.isdigit()][0]}"
-    local_dir = os.path.join(LOCAL_ROOT_DIR, label)
-    os.makedirs(local_dir, exist_ok=True)
-    file_path = os.path.join(local_dir, title)
-    file.GetContentFile(file_path)
-    print(f"🗑️ Deleting from Drive: {title}")
-    file.Delete()
-
-print("🎉 All MODIS NDVI exports downloaded and Drive cleaned.")
+if summarize(results):
+    print("⚠️ Some exports or downloads did not complete; see above.")
+else:
+    print("🎉 All MODIS NDVI exports downloaded and Drive cleaned.")
+state.report('modis', 'US')
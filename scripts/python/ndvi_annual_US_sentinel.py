@@ -1,5 +1,14 @@
 import ee
-import time
+import os
+from cog import NODATA, export_options, to_scaled_int16, write_cog
+from direct_fetch import FetchError, choose_transport, ee_url_maker, fetch_tiles, fetch_to_mosaic
+from export_cache import ExportManifest
+from geometry_registry import GeometryRegistry
+from metrics import RunMetrics
+from scheduler import ExportScheduler, tile_jobs
+from sensors import sensor_query
+from task_monitor import TaskMonitor
+from tiling import ee_intersecting_tiles, grid_for_bounds, plan_tiles, tile_pixel_budget
 
 # ---------------------------------------------------------------------
 # Initialize Earth Engine
@@ -14,57 +23,89 @@ STATE_NAME = "Massachusetts"
 DRIVE_FOLDER_NAME = "NDVI_S2_MA_2020"
 SCALE = 10  # Sentinel-2 resolution
 MAX_PIXELS = 1e13
+MANIFEST_PATH = f"{DRIVE_FOLDER_NAME}_manifest.json"  # lets re-runs re-attach to submitted tiles
+METRICS_PATH = f"{DRIVE_FOLDER_NAME}_metrics"  # .jsonl and .prom with per-task queue and run times
+TILE_PIXEL_BUDGET = 1e9  # max pixels per tile export
+MAX_CONCURRENT_TASKS = 4  # export tasks queued or running at once
+GEOMETRY_CACHE_DIR = "geometry_cache"
+SIMPLIFY_TOLERANCE = SCALE  # meters; boundary simplification for server-side filtering and tile selection
+OUTPUT_DTYPE = 'int16'  # scaled-int16 COGs (0.0001 steps); 'float32' for full-precision floats
+TRANSPORT = 'auto'  # 'direct' pixel fetch, 'export' via Drive, or 'auto' by region size
+OUTPUT_DIR = DRIVE_FOLDER_NAME  # local folder for directly fetched mosaics
+FILE_PREFIX = f"ndvi_s2_{STATE_NAME.lower().replace(' ', '_')}_{YEAR}"
 
 # ---------------------------------------------------------------------
 # Define Massachusetts geometry
 # ---------------------------------------------------------------------
-states_fc = ee.FeatureCollection("TIGER/2018/States")
-ma_feature = states_fc.filter(ee.Filter.eq('NAME', STATE_NAME)).first()
-ma_geom = ma_feature.geometry()
-
-# ---------------------------------------------------------------------
-# Function to calculate NDVI
-# ---------------------------------------------------------------------
-def add_ndvi(image):
-    ndvi = image.normalizedDifference(['B8', 'B4']).rename('NDVI')
-    return image.addBands(ndvi)
+# Fetched once and cached locally, so bounds need no getInfo round-trip;
+# outputs are clipped locally with a cached raster mask
+registry = GeometryRegistry(GEOMETRY_CACHE_DIR)
+ma_geom = registry.ee_geometry(STATE_NAME, SIMPLIFY_TOLERANCE)
 
 # ---------------------------------------------------------------------
 # Load Sentinel-2 data and compute NDVI composite
 # ---------------------------------------------------------------------
-s2 = ee.ImageCollection("COPERNICUS/S2_SR_HARMONIZED") \
-    .filterDate(f"{YEAR}-01-01", f"{YEAR}-12-31") \
-    .filterBounds(ma_geom) \
-    .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 20)) \
-    .map(add_ndvi)
+# Scenes under 20% CLOUDY_PIXEL_PERCENTAGE; NDVI = nd(B8, B4) computed on
+# just those two bands (see query.py)
+s2 = sensor_query('sentinel', ma_geom, f"{YEAR}-01-01", f"{YEAR}-12-31", ['NDVI']).optimize().build()
 
-composite = s2.select("NDVI").median().clip(ma_geom)
+composite = s2.median()
+if OUTPUT_DTYPE == 'int16':
+    composite = to_scaled_int16(composite)
 
 # ---------------------------------------------------------------------
-# Export to Google Drive
+# Plan aligned tiles; a state-sized region is fetched directly instead
+# of going through the export queue and Drive
 # ---------------------------------------------------------------------
-task = ee.batch.Export.image.toDrive(
-    image=composite,
-    description=f"NDVI_{STATE_NAME}_{YEAR}",
-    folder=DRIVE_FOLDER_NAME,
-    fileNamePrefix=f"ndvi_s2_{STATE_NAME.lower().replace(' ', '_')}_{YEAR}",
-    region=ma_geom.bounds().getInfo()['coordinates'],
-    scale=SCALE,
-    maxPixels=MAX_PIXELS
-)
+grid = grid_for_bounds(registry.bounds(STATE_NAME), SCALE)
+intersects = ee_intersecting_tiles(ma_geom)
+fetch_plan = fetch_tiles(grid, intersects)
+transport = choose_transport(fetch_plan) if TRANSPORT == 'auto' else TRANSPORT
+metrics = RunMetrics(f"{METRICS_PATH}.jsonl")
 
-print(f"🌱 Submitting export task for {STATE_NAME} ({YEAR})...")
-task.start()
+if transport == 'direct':
+    # -----------------------------------------------------------------
+    # Fetch request-sized tiles in parallel straight into a local mosaic
+    # -----------------------------------------------------------------
+    out_path = os.path.join(OUTPUT_DIR, f"{FILE_PREFIX}.tif")
+    print(f"🌱 Fetching {len(fetch_plan)} tile(s) for {STATE_NAME} ({YEAR}) directly...")
+    nodata = NODATA if OUTPUT_DTYPE == 'int16' else -9999  # masked pixels are filled server-side
+    try:
+        fetch_to_mosaic(ee_url_maker(composite, grid, nodata), grid, fetch_plan, out_path, nodata=nodata,
+                        metrics=metrics)
+    except FetchError as e:
+        # Requests still failing after their retries (e.g. compute limits): export instead
+        print(f"⚠️ Direct fetch failed ({e}); falling back to export")
+        transport = 'export'
+    else:
+        registry.apply_mask(STATE_NAME, out_path)
+        if OUTPUT_DTYPE == 'int16':
+            write_cog(out_path)
+        status = 'COMPLETED'
+        summary = out_path
 
-# ---------------------------------------------------------------------
-# Monitor progress
-# ---------------------------------------------------------------------
-while True:
-    status = task.status()['state']
-    print(f"{STATE_NAME}: {status}")
-    if status in ['COMPLETED', 'FAILED', 'CANCELLED']:
-        break
-    time.sleep(30)
+if transport == 'export':
+    # -----------------------------------------------------------------
+    # Export to Google Drive as aligned tiles: bounded tasks in flight,
+    # failed tiles retried or split
+    # (stitch the downloaded tiles with mosaic.mosaic_tiles, then clip the
+    # mosaic with registry.apply_mask(STATE_NAME, path) as above)
+    # -----------------------------------------------------------------
+    tiles = plan_tiles(grid, tile_pixel_budget(OUTPUT_DTYPE, TILE_PIXEL_BUDGET), intersects=intersects)
+    scheduler = ExportScheduler(TaskMonitor(metrics=metrics), MAX_CONCURRENT_TASKS,
+                                manifest=ExportManifest(MANIFEST_PATH))
+    params = dict(folder=DRIVE_FOLDER_NAME, maxPixels=MAX_PIXELS, **export_options(OUTPUT_DTYPE))
+    for job in tile_jobs(composite, grid, tiles, f"NDVI_{STATE_NAME}_{YEAR}", FILE_PREFIX, params):
+        scheduler.add(job)
+
+    print(f"🌱 Submitting {len(tiles)} tile export(s) for {STATE_NAME} ({YEAR})...")
+    outcome = scheduler.run()
+    done, failed = len(outcome['completed']), len(outcome['failed'])
+    status = 'COMPLETED' if not failed else 'INCOMPLETE'
+    summary = f"{done}/{done + failed} tiles"
+
+metrics.write_prometheus(f"{METRICS_PATH}.prom")
+metrics.report()
 
-print(f"✅ Export task for {STATE_NAME} is {status}.")
+print(f"✅ {transport.capitalize()} run for {STATE_NAME} is {status} ({summary}).")
 
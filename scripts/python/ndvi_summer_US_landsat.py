@@ -1,8 +1,20 @@
 import ee
 import os
-import time
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
+from cog import export_options, to_scaled_int16, write_cog
+from datacube import Datacube
+from drive_download import DriveDownloader, PyDriveSource
+from export_cache import MANIFEST_NAME, ExportManifest
+from geometry_registry import GeometryRegistry
+from metrics import RunMetrics
+from mosaic import OVERVIEW_LEVELS, TileAssembler
+from pipeline import ExportPipeline, summarize
+from reproject import Reprojector
+from scheduler import ExportScheduler, tile_jobs
+from sensors import sensor_query
+from state_store import STATE_DB_NAME, StateStore, Unit, verify_output
+from tiling import ee_intersecting_tiles, grid_for_bounds, plan_tiles, tile_pixel_budget
 
 # ---------------------------------------------------------------------
 # Step 1: Initialize Earth Engine
@@ -18,99 +30,161 @@ DRIVE_FOLDER_NAME = "US_NDVI_JJA"
 LOCAL_ROOT_DIR = r"E:\EE_ndvi_ndbi"
 SCALE = 30
 MAX_PIXELS = 1e13
+TILE_PIXEL_BUDGET = 1e9  # max pixels per tile export
+MAX_CONCURRENT_TASKS = 4  # export tasks queued or running at once
+SIMPLIFY_TOLERANCE = SCALE  # meters; server-side boundary simplification
+OUTPUT_DTYPE = 'int16'  # scaled-int16 COGs (0.0001 steps); 'float32' for full-precision floats
+MAX_CLOUD_COVER = None  # e.g. 80 to drop mostly cloudy scenes (CLOUD_COVER) before any pixel work
+REPROJECT_CRS = None  # e.g. 'EPSG:5070' to warp mosaics onto a CONUS Albers grid before ingest
 
 # ---------------------------------------------------------------------
 # Define U.S. boundary
 # ---------------------------------------------------------------------
-us_geom = ee.FeatureCollection("USDOS/LSIB_SIMPLE/2017") \
-    .filter(ee.Filter.eq("country_na", "United States")) \
-    .geometry()
+# Fetched once and cached locally; the simplified copy is used server-side
+# and composites are clipped after download with a cached raster mask.
+registry = GeometryRegistry(os.path.join(LOCAL_ROOT_DIR, "geometry"))
+us_geom = registry.ee_geometry("US", SIMPLIFY_TOLERANCE)
 
 # ---------------------------------------------------------------------
-# NDVI calculation
+# Work out what is left to do
 # ---------------------------------------------------------------------
-def add_ndvi(image):
-    ndvi = image.normalizedDifference(['SR_B5', 'SR_B4']).rename('NDVI')  # NIR, Red
-    return image.addBands(ndvi)
+# Each year's JJA product is tracked from submission to datacube ingest;
+# finished years are skipped, so extending the years or re-running after
+# a failed login or download only does the missing ones.
+state = StateStore(os.path.join(LOCAL_ROOT_DIR, STATE_DB_NAME))
+state.reconcile()
+units = {f"ndvi_jja_{year}_us": Unit('landsat', 'US', f"{year}-JJA", 'NDVI')
+         for year in range(START_YEAR, END_YEAR + 1)}
+todo = {product: unit for product, unit in units.items() if not state.is_done(unit)}
+state.report('landsat', 'US')
+if not todo:
+    print("✅ Every JJA product is already downloaded and ingested.")
+    raise SystemExit(0)
 
-# ---------------------------------------------------------------------
-# Step 2: Submit NDVI export tasks (June–August)
-# ---------------------------------------------------------------------
-export_tasks = []
-
-for year in range(START_YEAR, END_YEAR + 1):
-    print(f"🌱 Submitting NDVI export for peak season (JJA) {year}...")
-
-    collection = ee.ImageCollection("LANDSAT/LC08/C02/T1_L2") \
-        .filterDate(f"{year}-06-01", f"{year}-08-31") \
-        .filterBounds(us_geom) \
-        .map(lambda img: img.updateMask(img.select("QA_PIXEL").bitwiseAnd(1 << 3).eq(0))) \
-        .map(add_ndvi)
-
-    ndvi_composite = collection.select('NDVI').mean().clip(us_geom)
-
-    task = ee.batch.Export.image.toDrive(
-        image=ndvi_composite,
-        description=f"NDVI_JJA_{year}_US",
-        folder=DRIVE_FOLDER_NAME,
-        fileNamePrefix=f"ndvi_jja_{year}_us",
-        region=us_geom,
-        scale=SCALE,
-        maxPixels=MAX_PIXELS
-    )
-    task.start()
-    export_tasks.append((task, year))
+def unit_of(label):
+    return units[label.split('/')[0]]
 
 # ---------------------------------------------------------------------
-# Step 3: Monitor export progress
+# Plan export tiles (one grid shared by every year)
 # ---------------------------------------------------------------------
-print("\n⏳ Waiting for Earth Engine exports to complete...\n")
-while True:
-    all_done = True
-    for task, year in export_tasks:
-        status = task.status()['state']
-        print(f"NDVI_JJA_{year}: {status}")
-        if status not in ['COMPLETED', 'FAILED', 'CANCELLED']:
-            all_done = False
-    if all_done:
-        print("\n✅ All Earth Engine export tasks finished.")
-        break
-    time.sleep(30)
+grid = grid_for_bounds(registry.bounds("US"), SCALE)
+tiles = plan_tiles(grid, tile_pixel_budget(OUTPUT_DTYPE, TILE_PIXEL_BUDGET),
+                   intersects=ee_intersecting_tiles(us_geom), parts=registry.part_bounds("US"))
+print(f"🧱 {len(tiles)} tile(s) of up to {tile_pixel_budget(OUTPUT_DTYPE, TILE_PIXEL_BUDGET):.1e} pixels per export")
 
 # ---------------------------------------------------------------------
-# Step 4: Authenticate Google Drive
+# Step 2: Authenticate Google Drive
+# (done up front so downloads can start as soon as the first export ends)
 # ---------------------------------------------------------------------
 gauth = GoogleAuth()
 gauth.LocalWebserverAuth()
 drive = GoogleDrive(gauth)
 
+def season_dir(name):
+    # Extract year
+    year_part = [s for s in name.split('_') if s.isdigit()]
+    year = year_part[0] if year_part else 'unknown'
+    return os.path.join(LOCAL_ROOT_DIR, f"NDVI_JJA_{year}")
+
+def local_path_for(title):
+    return os.path.join(season_dir(title), "tiles", title)
+
+def mosaic_path_for(file_prefix):
+    return os.path.join(season_dir(file_prefix), f"{file_prefix}.tif")
+
+# Finished mosaics are also appended to the time-series datacube
+cube = Datacube(os.path.join(LOCAL_ROOT_DIR, "datacube.zarr"))
+
+# Optional warp onto an equal-area grid; the warp grid is computed once
+# and reused for every year (in threads: this script has no __main__
+# guard for worker processes)
+reproject = Reprojector(REPROJECT_CRS, cache_dir=os.path.join(LOCAL_ROOT_DIR, "warp_cache"),
+                        processes=False) if REPROJECT_CRS else None
+
+def finish_mosaic(path):
+    unit = unit_of(os.path.splitext(os.path.basename(path))[0])
+    try:
+        registry.apply_mask("US", path)
+        if reproject is not None:
+            reproject(path)
+        if OUTPUT_DTYPE == 'int16':
+            write_cog(path)
+        state.advance(unit, 'verified', path=verify_output(path))
+        cube.append("landsat/ndvi_jja", unit.period.split('-')[0], path)
+        state.advance(unit, 'ingested')
+    except Exception as e:
+        state.fail(unit, e)
+        raise
+
+# Finished exports are recorded here so re-runs skip them or re-attach
+manifest = ExportManifest(os.path.join(LOCAL_ROOT_DIR, MANIFEST_NAME))
+
+# Stage timings go to metrics/run_metrics.jsonl and a Prometheus textfile
+metrics = RunMetrics(os.path.join(LOCAL_ROOT_DIR, "metrics", "run_metrics.jsonl"))
+
+# Each year's tiles are stitched into one GeoTIFF once they have all arrived
+assembler = TileAssembler({product: len(tiles) for product in todo},
+                          mosaic_path_for, manifest=manifest, on_mosaic=finish_mosaic,
+                          overviews=None if OUTPUT_DTYPE == 'int16' else OVERVIEW_LEVELS)
+pipeline = ExportPipeline(DriveDownloader(PyDriveSource(drive), metrics=metrics), DRIVE_FOLDER_NAME,
+                          local_path_for, on_complete=assembler, manifest=manifest,
+                          metrics=metrics,
+                          on_event=lambda label, event: state.advance(unit_of(label), event, part=label))
+
+def watch(job, task, key):
+    if task is None:
+        state.advance(unit_of(job.label), 'downloaded', part=job.label)
+        assembler.add_cached(job.label, manifest.outputs(key))
+    else:
+        state.advance(unit_of(job.label), 'submitted', part=job.label)
+        pipeline.add(task, job.label, job.file_prefix, key)
+
+def replanned(job, children):
+    state.split(unit_of(job.label), job.label, [child.label for child in children])
+    assembler.split(job.label, [child.label for child in children])
+    pipeline.discard(job.label)
+
+def given_up(job, status):
+    state.fail(unit_of(job.label), status.get('error_message', status['state']), part=job.label)
+
+# Bounded number of tasks in flight, newest year first; failed tiles are
+# retried or split into smaller tiles
+scheduler = ExportScheduler(pipeline.monitor, MAX_CONCURRENT_TASKS, manifest=manifest,
+                            on_submit=watch, on_split=replanned, on_failed=given_up)
+
+# ---------------------------------------------------------------------
+# Step 3: Plan NDVI export tasks (June–August)
 # ---------------------------------------------------------------------
-# Step 5: Download and delete exported files
-# ---------------------------------------------------------------------
-folder_list = drive.ListFile({
-    'q': f"title='{DRIVE_FOLDER_NAME}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
-}).GetList()
-
-if not folder_list:
-    raise Exception(f"Folder '{DRIVE_FOLDER_NAME}' not found in Google Drive.")
-folder_id = folder_list[0]['id']
+for year in range(START_YEAR, END_YEAR + 1):
+    file_prefix = f"ndvi_jja_{year}_us"
+    if file_prefix not in todo:
+        continue
+    print(f"🌱 Planning NDVI export for peak season (JJA) {year}...")
 
-file_list = drive.ListFile({
-    'q': f"'{folder_id}' in parents and trashed=false"
-}).GetList()
+    # QA_PIXEL bit-3 mask and NDVI = nd(SR_B5, SR_B4), optimized to carry only
+    # those bands through one fused map (see query.py)
+    query = sensor_query('landsat', us_geom, f"{year}-06-01", f"{year}-08-31", ['NDVI'], MAX_CLOUD_COVER)
+    ndvi_composite = query.optimize().build().mean()
+    if OUTPUT_DTYPE == 'int16':
+        ndvi_composite = to_scaled_int16(ndvi_composite)
 
-for file in file_list:
-    title = file['title']
-    if title.endswith('.tif'):
-        print(f"⬇️ Downloading: {title}")
-        # Extract year
-        year_part = [s for s in title.split('_') if s.isdigit()]
-        year = year_part[0] if year_part else 'unknown'
-        local_dir = os.path.join(LOCAL_ROOT_DIR, f"NDVI_JJA_{year}")
-        os.makedirs(local_dir, exist_ok=True)
-        file_path = os.path.join(local_dir, title)
-        file.GetContentFile(file_path)
-        print(f"🗑️ Deleting from Drive: {title}")
-        file.Delete()
+    params = dict(folder=DRIVE_FOLDER_NAME, maxPixels=MAX_PIXELS, **export_options(OUTPUT_DTYPE))
+    jobs = tile_jobs(ndvi_composite, grid, tiles, f"NDVI_JJA_{year}_US", file_prefix,
+                     params, priority=year)
+    state.plan(todo[file_prefix], [job.label for job in jobs])
+    for job in jobs:
+        scheduler.add(job)
 
-print("🎉 All NDVI JJA data downloaded and cleaned up from Drive.")
+# ---------------------------------------------------------------------
+# Step 4: Download and delete each export as soon as it completes
+# ---------------------------------------------------------------------
+print("\n⏳ Waiting for Earth Engine exports to complete...\n")
+results = pipeline.run(wait=scheduler.run)
+metrics.write_prometheus(os.path.join(LOCAL_ROOT_DIR, "metrics", "ndvi_export.prom"))
+metrics.report()
+
+if summarize(results) or assembler.incomplete():
+    print(f"⚠️ Some exports or downloads did not complete; tiles received: {assembler.incomplete()}")
+else:
+    print("🎉 All NDVI JJA data downloaded and cleaned up from Drive.")
+state.report('landsat', 'US')
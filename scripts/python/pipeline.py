@@ -0,0 +1,224 @@
+import functools
+import queue
+import threading
+import time
+
+from task_monitor import TaskMonitor
+
+# ---------------------------------------------------------------------
+# Pipelined export -> download -> post-process runner
+#
+# Instead of waiting for every export before touching Drive, each
+# export that completes is queued for download straight away, and each
+# verified download is queued for local post-processing. Stages are
+# joined by bounded queues so a slow stage applies back-pressure rather
+# than piling up work, and total run time approaches the slowest stage
+# rather than the sum of all of them.
+# ---------------------------------------------------------------------
+_STOP = object()
+
+
+class ExportPipeline:
+    """Run the download and post-process stages while exports are still running.
+
+    `local_path_for(title)` chooses where each downloaded file goes and
+    `postprocess(label, path)`, if given, runs on every downloaded file.
+    With an export_cache.ExportManifest, export states and downloaded
+    files are recorded against each task's export key. With a
+    metrics.RunMetrics, Drive listings and post-processing are timed
+    (and the default monitor records export task timings).
+    `on_event(label, event)`, if given, hears 'exported' when a label's
+    export completes and 'downloaded' once all its files are local
+    (e.g. to advance a state_store.StateStore). `on_complete(label, paths)`,
+    if given, runs on a post-process worker once every file of a label
+    has been downloaded and post-processed -- an export can arrive as
+    several files, so this is the hook for work on whole exports (e.g.
+    mosaic.TileAssembler).
+    """
+
+    def __init__(self, downloader, drive_folder, local_path_for, postprocess=None,
+                 monitor=None, manifest=None, queue_size=4, download_workers=4, postprocess_workers=2,
+                 suffix='.tif', listing_retries=5, listing_delay=10, sleep=time.sleep, metrics=None,
+                 on_event=None, on_complete=None):
+        self.downloader = downloader
+        self.drive_folder = drive_folder
+        self.local_path_for = local_path_for
+        self.postprocess = postprocess
+        self.monitor = monitor or TaskMonitor(metrics=metrics)
+        self.manifest = manifest
+        self.download_queue = queue.Queue(maxsize=queue_size)
+        self.postprocess_queue = queue.Queue(maxsize=queue_size)
+        self.download_workers = download_workers
+        self.postprocess_workers = postprocess_workers
+        self.suffix = suffix
+        self.listing_retries = listing_retries
+        self.listing_delay = listing_delay
+        self.sleep = sleep
+        self.metrics = metrics
+        self.on_event = on_event
+        self.on_complete = on_complete
+        self.results = {}   # label -> {'export': state, 'files': [DownloadResult], 'processed': [...], 'pending': n}
+        self._folder_id = None
+        self._listing = None    # last Drive folder listing, shared by every download worker
+        self._lock = threading.Lock()
+
+    def add(self, task, label, file_prefix, key=None):
+        """Watch a started export (task or task id); its Drive files are those whose title starts with `file_prefix`."""
+        self.results[label] = {'export': None, 'files': [], 'processed': [], 'key': key, 'pending': None}
+        self.monitor.add(task, label, on_done=lambda task_id, label, status:
+                         self._export_done(label, file_prefix, status))
+
+    def discard(self, label):
+        """Forget a label whose export was re-planned into others (see scheduler.ExportScheduler)."""
+        self.results.pop(label, None)
+
+    def run(self, wait=None):
+        """Run the stages until `wait()` returns (default: the monitor's wait for all exports)."""
+        stages = [(self._download_worker, self.download_workers),
+                  (self._postprocess_worker, self.postprocess_workers)]
+        threads = {}
+        for target, count in stages:
+            threads[target] = [threading.Thread(target=target, daemon=True) for _ in range(count)]
+            for t in threads[target]:
+                t.start()
+
+        (wait or self.monitor.wait)()
+
+        # Drain each stage in order so nothing is lost on shutdown.
+        for target, count in stages:
+            stage_queue = self.download_queue if target == self._download_worker else self.postprocess_queue
+            for _ in range(count):
+                stage_queue.put(_STOP)
+            for t in threads[target]:
+                t.join()
+        return self.results
+
+    def _export_done(self, label, file_prefix, status):
+        self.results[label]['export'] = status['state']
+        key = self.results[label]['key']
+        if self.manifest is not None and key is not None:
+            self.manifest.record_state(key, status['state'])
+        if status['state'] == 'COMPLETED':
+            if self.on_event is not None:
+                self.on_event(label, 'exported')
+            self.download_queue.put((label, file_prefix))
+        else:
+            print(f"❌ {label}: {status['state']} {status.get('error_message', '')}".rstrip())
+
+    def _matching(self, file_prefix):
+        return [f for f in self._listing or []
+                if f['title'].startswith(file_prefix) and f['title'].endswith(self.suffix)]
+
+    def _exported_files(self, file_prefix):
+        # One cached listing serves every export; the folder is listed again
+        # only when a prefix is missing from it. Drive listings can lag a few
+        # seconds behind task completion, hence the retries.
+        for attempt in range(self.listing_retries):
+            with self._lock:
+                files = self._matching(file_prefix)
+                if not files:
+                    if self._folder_id is None:
+                        self._folder_id = self.downloader.source.find_folder(self.drive_folder)
+                    self._listing = self._list_folder(file_prefix)
+                    files = self._matching(file_prefix)
+            if files:
+                return files
+            self.sleep(self.listing_delay)
+        return []
+
+    def _list_folder(self, label):
+        if self.metrics is None:
+            return self.downloader.source.list_files(self._folder_id)
+        with self.metrics.timer('drive_list', label) as fields:
+            files = self.downloader.source.list_files(self._folder_id)
+            fields['files'] = len(files)
+        return files
+
+    def _download_worker(self):
+        while True:
+            item = self.download_queue.get()
+            if item is _STOP:
+                return
+            label, file_prefix = item
+            try:
+                self._download(label, file_prefix)
+            except Exception as e:
+                # Keep the worker alive: a dead one would leave the bounded queue full.
+                print(f"❌ Download failed for {label}: {e}")
+                self.results[label]['error'] = str(e)
+
+    def _download(self, label, file_prefix):
+        files = self._exported_files(file_prefix)
+        if not files:
+            print(f"⚠️ {label}: export finished but no files found in '{self.drive_folder}'")
+        with self._lock:
+            # Counted down by the post-process workers; see _file_done.
+            self.results[label]['pending'] = len(files)
+        key = self.results[label]['key']
+        # Recorded before the Drive copy is deleted, so a crash cannot lose track of the file.
+        record = None
+        if self.manifest is not None and key is not None:
+            record = functools.partial(self.manifest.record_output, key)
+            # An interrupted run may have downloaded (and deleted) some of the files already.
+            outputs = {o['path'] for o in self.manifest.outputs(key)}
+            outputs |= {self.local_path_for(f['title']) for f in files}
+            self.results[label]['outputs'] = sorted(outputs)
+            if files:
+                self.manifest.record_file_count(key, len(outputs))
+        for file in files:
+            result = self.downloader.download(file, self.local_path_for(file['title']), on_local=record)
+            self.results[label]['files'].append(result)
+            if result.status != 'failed':
+                self.postprocess_queue.put((label, result.path))
+            else:
+                self._file_done(label)
+        downloaded = all(r.status != 'failed' for r in self.results[label]['files'])
+        if files and downloaded and self.on_event is not None:
+            self.on_event(label, 'downloaded')
+
+    def _postprocess_worker(self):
+        while True:
+            item = self.postprocess_queue.get()
+            if item is _STOP:
+                return
+            label, path = item
+            if self.postprocess is not None:
+                try:
+                    if self.metrics is None:
+                        self.postprocess(label, path)
+                    else:
+                        with self.metrics.timer('postprocess', label, path=path):
+                            self.postprocess(label, path)
+                except Exception as e:
+                    print(f"❌ Post-processing failed for {path}: {e}")
+                    self._file_done(label)
+                    continue
+            self.results[label]['processed'].append(path)
+            self._file_done(label)
+
+    def _file_done(self, label):
+        # The last of a label's files to finish (or fail) decides whether the
+        # whole export is complete.
+        r = self.results[label]
+        with self._lock:
+            r['pending'] -= 1
+            last = r['pending'] == 0
+        if not last or self.on_complete is None or len(r['processed']) < len(r['files']):
+            return
+        try:
+            self.on_complete(label, r.get('outputs') or list(r['processed']))
+        except Exception as e:
+            print(f"❌ Completion step failed for {label}: {e}")
+            r['error'] = str(e)
+
+
+def summarize(results):
+    """Print a one-line outcome per label and return the labels that did not fully succeed."""
+    incomplete = []
+    for label, r in results.items():
+        downloaded = sum(1 for f in r['files'] if f.status != 'failed')
+        error = f" ({r['error']})" if r.get('error') else ''
+        print(f"{label}: export {r['export']}, {downloaded}/{len(r['files'])} file(s) downloaded{error}")
+        if r['export'] != 'COMPLETED' or downloaded < len(r['files']) or not r['files'] or error:
+            incomplete.append(label)
+    return incomplete
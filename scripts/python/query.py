@@ -0,0 +1,281 @@
+from collections import namedtuple
+
+# ---------------------------------------------------------------------
+# Collection query builder and optimizer
+#
+# The scripts' collection chains spend server time on work they throw
+# away: the Landsat QA mask and add_indices are mapped over every SR
+# and thermal band and the indices are added onto the full image, all
+# before select(['NDVI', 'NDBI']); Sentinel computes NDVI on full
+# 23-band images. A CollectionQuery records the same chain as plain
+# steps, and optimize() rewrites it before anything is sent:
+#   * filters (date, bounds, metadata such as CLOUD_COVER) move ahead of
+#     every per-pixel map -- none of the maps here change properties;
+#   * band selection is pushed ahead of the maps: only the bands the
+#     output needs (index inputs, QA bands, passed-through bands) are
+#     carried, and indices nobody selects are dropped;
+#   * masks and index calculations are fused into one mapped
+#     expression that returns just the output bands.
+# Both versions can be printed with explain(), which also counts the
+# bands each per-pixel step touches per image -- a rough local proxy
+# for the server work -- so a rewrite can be checked and compared
+# without Earth Engine. build() turns a query into an ee.ImageCollection.
+# ---------------------------------------------------------------------
+Step = namedtuple('Step', ['op', 'args'])
+
+FILTER_OPS = ('filter_date', 'filter_bounds', 'filter_metadata')
+PIXEL_OPS = ('mask_bits', 'index', 'rescale', 'fused')
+METADATA_FILTERS = {'lt': 'lt', 'lte': 'lte', 'gt': 'gt', 'gte': 'gte', 'eq': 'eq', 'neq': 'neq'}
+
+
+class CollectionQuery:
+    """An immutable, inspectable ee.ImageCollection chain.
+
+    `bands` lists the collection's bands (see sensors.SENSORS) so band
+    widths and pushdown can be worked out locally. Every builder method
+    returns a new query.
+    """
+
+    def __init__(self, collection_id, bands, steps=(), original=None):
+        self.collection_id = collection_id
+        self.bands = list(bands)
+        self.steps = tuple(steps)
+        self.original = original
+
+    def _then(self, op, *args):
+        return CollectionQuery(self.collection_id, self.bands, self.steps + (Step(op, args),))
+
+    # -----------------------------------------------------------------
+    # Builder
+    # -----------------------------------------------------------------
+    def filter_date(self, start, end):
+        return self._then('filter_date', start, end)
+
+    def filter_bounds(self, region):
+        return self._then('filter_bounds', region)
+
+    def filter_metadata(self, prop, op, value):
+        """Keep images whose property `prop` compares `op` ('lt', 'lte', ...) to `value`."""
+        if op not in METADATA_FILTERS:
+            raise ValueError(f"Unknown metadata filter '{op}'")
+        return self._then('filter_metadata', prop, op, value)
+
+    def select(self, bands):
+        return self._then('select', tuple(bands))
+
+    def mask_bits(self, qa_band, bits):
+        """Mask pixels where any of `bits` is set in `qa_band` (bitwiseAnd(mask).eq(0))."""
+        return self._then('mask_bits', qa_band, tuple(bits))
+
+    def index(self, name, first, second):
+        """Add normalizedDifference([first, second]) as band `name`."""
+        return self._then('index', name, first, second)
+
+    def rescale(self, name, band, factor):
+        """Add (or replace) band `name` as `band` * `factor` (e.g. MOD13Q1's 0.0001 NDVI scale)."""
+        return self._then('rescale', name, band, factor)
+
+    # -----------------------------------------------------------------
+    # Band bookkeeping
+    # -----------------------------------------------------------------
+    def widths(self):
+        """([(step, bands carried into the step)], output bands)."""
+        bands = list(self.bands)
+        out = []
+        for step in self.steps:
+            out.append((step, list(bands)))
+            bands = _apply_bands(step, bands)
+        return out, bands
+
+    def output_bands(self):
+        return self.widths()[1]
+
+    def band_passes(self):
+        """Bands touched per image by per-pixel steps: the local cost proxy explain() reports."""
+        total = 0
+        for step, bands in self.widths()[0]:
+            if step.op == 'mask_bits':
+                total += len(bands)            # updateMask rewrites every band's mask
+            elif step.op in ('index', 'rescale'):
+                total += len(bands) + 1        # addBands copies the image and adds one band
+            elif step.op == 'fused':
+                total += len(bands) + len(step.args[1])
+        return total
+
+    # -----------------------------------------------------------------
+    # Optimizer
+    # -----------------------------------------------------------------
+    def optimize(self):
+        """Equivalent query with filters first, bands pushed down and pixel steps fused."""
+        if any(s.op == 'fused' for s in self.steps):
+            return self   # already optimized
+        filters = [s for s in self.steps if s.op in FILTER_OPS]
+        pixel = [s for s in self.steps if s.op in PIXEL_OPS]
+        output = self.output_bands()
+
+        # Walk the pixel steps backwards keeping only what the output needs.
+        needed = set(output)
+        kept = []
+        for step in reversed(pixel):
+            if step.op == 'mask_bits':
+                kept.append(step)
+                needed.add(step.args[0])
+            elif step.op in ('index', 'rescale'):
+                name = step.args[0]
+                if name not in needed:
+                    continue
+                kept.append(step)
+                needed.discard(name)
+                needed.update(step.args[1:3] if step.op == 'index' else step.args[1:2])
+        kept.reverse()
+        source = [b for b in self.bands if b in needed]
+
+        steps = list(filters)
+        if source != self.bands:
+            steps.append(Step('select', (tuple(source),)))
+        masks = tuple(s.args for s in kept if s.op == 'mask_bits')
+        derived = tuple((s.op,) + s.args for s in kept if s.op != 'mask_bits')
+        if masks or derived:
+            steps.append(Step('fused', (masks, derived, tuple(output))))
+        elif tuple(output) != tuple(source):
+            steps.append(Step('select', (tuple(output),)))
+        return CollectionQuery(self.collection_id, self.bands, steps, original=self)
+
+    # -----------------------------------------------------------------
+    # Inspection and execution
+    # -----------------------------------------------------------------
+    def explain(self):
+        """Readable plan: one line per step with the bands it carries, and the cost proxy."""
+        lines = [f"ImageCollection('{self.collection_id}')  [{len(self.bands)} bands]"]
+        for i, (step, bands) in enumerate(self.widths()[0], start=1):
+            lines.append(f"  {i}. {_describe(step):<60} {len(bands):>3} bands in")
+        lines.append(f"  -> {', '.join(self.output_bands())}; {self.band_passes()} band passes per image")
+        if self.original is not None:
+            before, after = self.original.band_passes(), self.band_passes()
+            saved = 100.0 * (before - after) / before if before else 0.0
+            lines.append(f"  optimized from {before} band passes ({saved:.0f}% fewer)")
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        """JSON-able form for diffing plans (regions are shown by type only)."""
+        return {'collection': self.collection_id,
+                'steps': [{'op': s.op, 'args': [_plain(a) for a in s.args]} for s in self.steps],
+                'output': self.output_bands(),
+                'band_passes': self.band_passes()}
+
+    def build(self):
+        """The ee.ImageCollection for this query."""
+        import ee
+
+        collection = ee.ImageCollection(self.collection_id)
+        for step in self.steps:
+            collection = _build_step(ee, collection, step)
+        return collection
+
+
+def _apply_bands(step, bands):
+    if step.op == 'select':
+        return list(step.args[0])
+    if step.op in ('index', 'rescale'):
+        return [b for b in bands if b != step.args[0]] + [step.args[0]]
+    if step.op == 'fused':
+        return list(step.args[2])
+    return bands
+
+
+def _describe(step):
+    op, args = step
+    if op == 'filter_date':
+        return f"filterDate {args[0]} .. {args[1]}"
+    if op == 'filter_bounds':
+        return f"filterBounds <{type(args[0]).__name__}>"
+    if op == 'filter_metadata':
+        return f"filter {args[0]} {args[1]} {args[2]}"
+    if op == 'select':
+        return f"select {', '.join(args[0])}"
+    if op == 'mask_bits':
+        return f"map updateMask {args[0]} bits {list(args[1])} clear"
+    if op == 'index':
+        return f"map addBands {args[0]} = nd({args[1]}, {args[2]})"
+    if op == 'rescale':
+        return f"map addBands {args[0]} = {args[1]} * {args[2]}"
+    masks, derived, output = args
+    parts = [f"mask {qa} {list(bits)}" for qa, bits in masks]
+    parts += [f"{d[1]} = nd({d[2]}, {d[3]})" if d[0] == 'index' else f"{d[1]} = {d[2]} * {d[3]}"
+              for d in derived]
+    return f"map fused[{'; '.join(parts)}] -> {', '.join(output)}"
+
+
+def _plain(value):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, (tuple, list)):
+        return [_plain(v) for v in value]
+    return f"<{type(value).__name__}>"
+
+
+def _clear(ee, image, masks):
+    clear = None
+    for qa_band, bits in masks:
+        mask = 0
+        for bit in bits:
+            mask |= 1 << bit
+        ok = image.select(qa_band).bitwiseAnd(mask).eq(0)
+        clear = ok if clear is None else clear.And(ok)
+    return clear
+
+
+def _derived_band(image, d):
+    if d[0] == 'index':
+        return image.normalizedDifference([d[2], d[3]]).rename(d[1])
+    return image.select(d[2]).multiply(d[3]).rename(d[1])
+
+
+def _build_step(ee, collection, step):
+    op, args = step
+    if op == 'filter_date':
+        return collection.filterDate(*args)
+    if op == 'filter_bounds':
+        return collection.filterBounds(args[0])
+    if op == 'filter_metadata':
+        prop, cmp, value = args
+        return collection.filter(getattr(ee.Filter, METADATA_FILTERS[cmp])(prop, value))
+    if op == 'select':
+        return collection.select(list(args[0]))
+    if op == 'mask_bits':
+        return collection.map(lambda img: img.updateMask(_clear(ee, img, [args])))
+    if op in ('index', 'rescale'):
+        return collection.map(lambda img: img.addBands(_derived_band(img, (op,) + args), None, True))
+
+    masks, derived, output = args
+
+    def fused(img):
+        names = [d[1] for d in derived]
+        bands = [_derived_band(img, d) for d in derived] + [img.select(b) for b in output if b not in names]
+        out = ee.Image.cat(bands).select(list(output))
+        if masks:
+            out = out.updateMask(_clear(ee, img, masks))
+        return ee.Image(out.copyProperties(img, ['system:time_start']))
+
+    return collection.map(fused)
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    from sensors import SENSORS, sensor_indices, sensor_query
+
+    parser = argparse.ArgumentParser(description="Show a sensor's collection plan before and after optimization.")
+    parser.add_argument('sensor', choices=sorted(SENSORS))
+    parser.add_argument('--indices', nargs='+', help="default: every index the sensor supports")
+    parser.add_argument('--max-cloud-cover', type=float)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    query = sensor_query(args.sensor, None, '2020-01-01', '2021-01-01',
+                         args.indices or sensor_indices(args.sensor), args.max_cloud_cover)
+    optimized = query.optimize()
+    if args.json:
+        print(json.dumps({'original': query.to_dict(), 'optimized': optimized.to_dict()}, indent=2))
+    else:
+        print("Original:\n" + query.explain() + "\n\nOptimized:\n" + optimized.explain())
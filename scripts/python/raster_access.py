@@ -0,0 +1,361 @@
+import os
+import threading
+from collections import OrderedDict
+
+# ---------------------------------------------------------------------
+# Cached raster access for analysis code
+#
+# Notebooks and plotting code reopen the big GeoTIFFs under
+# LOCAL_ROOT_DIR and decode them in full every time. A RasterReader
+# reads through the file's own internal blocks (256 x 256 for the COGs
+# cog.py writes), so every window read decodes whole blocks once and
+# keeps them in an LRU cache with a byte budget shared by every reader
+# in the process; re-reading a region, or a neighbouring window that
+# shares blocks, costs no decode.
+#
+# Uncompressed files whose blocks are stored back to back (e.g. plain
+# stripped GeoTIFFs) are not decoded at all: memmap() returns a
+# zero-copy NumPy view of the pixels on disk and block reads come from
+# it.
+#
+# histogram() and quantiles() run over a whole raster block by block,
+# reading past the cache so one full scan does not evict the working
+# set. Quantiles are exact: a histogram pass over the expected value
+# range finds the bin holding each requested rank, and a second pass
+# collects only the values in those bins.
+# ---------------------------------------------------------------------
+DEFAULT_CACHE_BYTES = 512 * 2 ** 20
+DEFAULT_BINS = 1000
+INDEX_RANGE = (-1.0, 1.0)
+SCAN_PIXELS = 2 ** 22   # pixels per step when scanning a memory-mapped raster
+
+
+class BlockCache:
+    """Thread-safe LRU of decoded blocks, bounded by total bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        with self._lock:
+            if key in self._blocks:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return self._blocks[key]
+            self.misses += 1
+        block = load()
+        with self._lock:
+            if key not in self._blocks and block.nbytes <= self.max_bytes:
+                self._blocks[key] = block
+                self.bytes += block.nbytes
+                while self.bytes > self.max_bytes:
+                    _, old = self._blocks.popitem(last=False)
+                    self.bytes -= old.nbytes
+        return block
+
+    def peek(self, key):
+        """The cached block for `key`, or None; neither counted nor moved to the front."""
+        with self._lock:
+            return self._blocks.get(key)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {'blocks': len(self._blocks), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+_shared_cache = BlockCache()
+
+
+def shared_cache():
+    return _shared_cache
+
+
+class RasterReader:
+    """Block-cached reads of one band of a raster.
+
+    Values come back as masked arrays with nodata masked and, unless
+    `scaled=False`, the band's scale/offset applied (as cog.read_scaled).
+    Use as a context manager or call close().
+    """
+
+    def __init__(self, path, band=1, cache=None):
+        import rasterio
+
+        self.path = path
+        self.band = band
+        self.cache = cache or _shared_cache
+        self._src = rasterio.open(path)
+        self._lock = threading.Lock()
+        stat = os.stat(path)
+        self._key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, band)
+        self.width, self.height = self._src.width, self._src.height
+        self.dtype = self._src.dtypes[band - 1]
+        self.nodata = self._src.nodata
+        self.scale = self._src.scales[band - 1]
+        self.offset = self._src.offsets[band - 1]
+        self.block_height, self.block_width = self._src.block_shapes[band - 1]
+        self._memmap = _map_pixels(self._src, path, band)
+
+    def close(self):
+        self._src.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def profile(self):
+        return self._src.profile
+
+    def memmap(self):
+        """Zero-copy (height, width) view of the stored pixels, or None if the layout needs decoding."""
+        return self._memmap
+
+    # -----------------------------------------------------------------
+    # Blocks
+    # -----------------------------------------------------------------
+    def block_grid(self):
+        """(block rows, block cols)."""
+        return (-(-self.height // self.block_height), -(-self.width // self.block_width))
+
+    def block_window(self, brow, bcol):
+        from rasterio.windows import Window
+        r, c = brow * self.block_height, bcol * self.block_width
+        return Window(c, r, min(self.block_width, self.width - c), min(self.block_height, self.height - r))
+
+    def raw_block(self, brow, bcol, cached=True):
+        """Stored values of one internal block (cached, or a view into the memmap).
+
+        With `cached=False` a block not already in the cache is read
+        without being added to it.
+        """
+        window = self.block_window(brow, bcol)
+        if self._memmap is not None:
+            r, c = int(window.row_off), int(window.col_off)
+            return self._memmap[r:r + int(window.height), c:c + int(window.width)]
+
+        def load():
+            with self._lock:
+                data = self._src.read(self.band, window=window)
+            data.setflags(write=False)
+            return data
+
+        key = self._key + (brow, bcol)
+        if not cached:
+            block = self.cache.peek(key)
+            return block if block is not None else load()
+        return self.cache.get(key, load)
+
+    def blocks(self):
+        """Yield (window, masked values) covering the band in file order, bypassing the cache.
+
+        Windows are the internal blocks, or SCAN_PIXELS-sized row bands
+        for a memory-mapped raster, whose strips are often only a few rows.
+        """
+        from rasterio.windows import Window
+
+        if self._memmap is not None:
+            step = max(1, SCAN_PIXELS // self.width)
+            for r in range(0, self.height, step):
+                h = min(step, self.height - r)
+                yield Window(0, r, self.width, h), self._decode(self._memmap[r:r + h], True)
+            return
+        rows, cols = self.block_grid()
+        for brow in range(rows):
+            for bcol in range(cols):
+                yield self.block_window(brow, bcol), self._decode(self.raw_block(brow, bcol, cached=False), True)
+
+    # -----------------------------------------------------------------
+    # Windows
+    # -----------------------------------------------------------------
+    def read_raw(self, window=None):
+        """Stored values of `window` (default: the whole band), assembled from cached blocks."""
+        import numpy as np
+
+        r0, c0, h, w = _bounds(window, self.width, self.height)
+        if self._memmap is not None:
+            return self._memmap[r0:r0 + h, c0:c0 + w]
+        out = np.empty((h, w), dtype=self.dtype)
+        for brow in range(r0 // self.block_height, (r0 + h - 1) // self.block_height + 1):
+            for bcol in range(c0 // self.block_width, (c0 + w - 1) // self.block_width + 1):
+                block = self.raw_block(brow, bcol)
+                br, bc = brow * self.block_height, bcol * self.block_width
+                rr0, cc0 = max(r0, br), max(c0, bc)
+                rr1, cc1 = min(r0 + h, br + block.shape[0]), min(c0 + w, bc + block.shape[1])
+                out[rr0 - r0:rr1 - r0, cc0 - c0:cc1 - c0] = block[rr0 - br:rr1 - br, cc0 - bc:cc1 - bc]
+        return out
+
+    def read(self, window=None, scaled=True):
+        """Masked values of `window` (default: the whole band)."""
+        return self._decode(self.read_raw(window), scaled)
+
+    def _decode(self, data, scaled):
+        import numpy as np
+
+        mask = np.zeros(data.shape, dtype=bool)
+        if self.nodata is not None and not np.isnan(self.nodata):
+            mask |= data == self.nodata
+        if np.issubdtype(data.dtype, np.floating):
+            mask |= ~np.isfinite(data)
+        if not scaled:
+            return np.ma.array(data, mask=mask)
+        values = data.astype('float32')
+        if self.scale != 1.0 or self.offset != 0.0:
+            values = values * self.scale + self.offset
+        return np.ma.array(values, mask=mask)
+
+    # -----------------------------------------------------------------
+    # Whole-raster summaries
+    # -----------------------------------------------------------------
+    def histogram(self, bins=DEFAULT_BINS, value_range=INDEX_RANGE):
+        """(counts, edges) of the valid values; values outside `value_range` are clipped into the end bins."""
+        import numpy as np
+
+        lo, hi = value_range if value_range is not None else self.min_max()
+        counts, _, _ = self._scan_histogram(bins, lo, hi)
+        return counts, np.linspace(lo, hi, bins + 1)
+
+    def _scan_histogram(self, bins, lo, hi):
+        # One pass: counts over [lo, hi] plus the actual min and max.
+        import numpy as np
+
+        counts = np.zeros(bins, dtype='int64')
+        vmin, vmax = float('inf'), float('-inf')
+        for _, values in self.blocks():
+            v = values.compressed().astype('float64')
+            if v.size:
+                b = np.clip(((v - lo) * (bins / (hi - lo))).astype('int64'), 0, bins - 1)
+                counts += np.bincount(b, minlength=bins)
+                vmin, vmax = min(vmin, float(v.min())), max(vmax, float(v.max()))
+        return counts, vmin, vmax
+
+    def min_max(self):
+        lo, hi = float('inf'), float('-inf')
+        for _, values in self.blocks():
+            if values.count():
+                lo, hi = min(lo, float(values.min())), max(hi, float(values.max()))
+        if lo > hi:
+            raise ValueError(f"{self.path} has no valid pixels")
+        return (lo, hi) if hi > lo else (lo, lo + 1.0)
+
+    def quantiles(self, qs, bins=DEFAULT_BINS, value_range=INDEX_RANGE):
+        """Exact quantiles (0-100, linear interpolation as numpy's default) of the valid values.
+
+        Two passes: a histogram over `value_range` locates the bin of
+        each rank, then only values falling in those bins are kept and
+        sorted, so memory is about the pixels of a few bins. If values
+        turn out to lie outside `value_range` (or it is None), the
+        histogram is redone once over their actual range.
+        """
+        import numpy as np
+
+        lo, hi = value_range if value_range is not None else (0.0, 1.0)
+        counts, vmin, vmax = self._scan_histogram(bins, lo, hi)
+        if vmin > vmax:
+            raise ValueError(f"{self.path} has no valid pixels")
+        if value_range is None or vmin < lo or vmax > hi:
+            lo, hi = (vmin, vmax) if vmax > vmin else (vmin, vmin + 1.0)
+            counts, _, _ = self._scan_histogram(bins, lo, hi)
+        n = int(counts.sum())
+        cumulative = np.cumsum(counts)
+        positions = [q / 100.0 * (n - 1) for q in qs]
+        ranks = sorted({int(np.floor(p)) for p in positions} | {min(int(np.floor(p)) + 1, n - 1) for p in positions})
+        wanted = {int(np.searchsorted(cumulative, rank, side='right')) for rank in ranks}
+        kept = {b: [] for b in wanted}
+        for _, values in self.blocks():
+            v = values.compressed().astype('float64')
+            if not v.size:
+                continue
+            b = np.clip(((v - lo) * (bins / (hi - lo))).astype('int64'), 0, bins - 1)
+            for bin_ in wanted:
+                kept[bin_].append(v[b == bin_])
+        sorted_bins = {b: np.sort(np.concatenate(parts)) if parts else np.empty(0) for b, parts in kept.items()}
+
+        def value_at(rank):
+            bin_ = int(np.searchsorted(cumulative, rank, side='right'))
+            start = cumulative[bin_ - 1] if bin_ else 0
+            return sorted_bins[bin_][rank - start]
+
+        out = []
+        for p in positions:
+            below = int(np.floor(p))
+            above = min(below + 1, n - 1)
+            out.append(value_at(below) + (value_at(above) - value_at(below)) * (p - below))
+        return out
+
+
+def _bounds(window, width, height):
+    if window is None:
+        return 0, 0, height, width
+    r0, c0 = int(window.row_off), int(window.col_off)
+    h, w = int(window.height), int(window.width)
+    if r0 < 0 or c0 < 0 or r0 + h > height or c0 + w > width:
+        raise ValueError(f"Window {window} is outside the {width}x{height} raster")
+    return r0, c0, h, w
+
+
+def _map_pixels(src, path, band):
+    """np.memmap of one band when it is uncompressed with its blocks stored contiguously, else None."""
+    import numpy as np
+
+    if src.driver != 'GTiff' or src.compression is not None:
+        return None
+    if src.count > 1 and src.interleave is not None and src.interleave.name != 'BAND':
+        return None
+    block_height, block_width = src.block_shapes[band - 1]
+    if block_width != src.width:
+        return None   # tiled: blocks are not rows of the image
+    itemsize = np.dtype(src.dtypes[band - 1]).itemsize
+    strip_bytes = block_height * src.width * itemsize
+    strips = -(-src.height // block_height)
+    try:
+        offsets = [int(src.get_tag_item(f"BLOCK_OFFSET_0_{i}", 'TIFF', bidx=band)) for i in range(strips)]
+    except (TypeError, ValueError):
+        return None
+    if any(b - a != strip_bytes for a, b in zip(offsets, offsets[1:])):
+        return None
+    with open(path, 'rb') as f:
+        order = f.read(2)
+    dtype = np.dtype(src.dtypes[band - 1]).newbyteorder('<' if order == b'II' else '>')
+    return np.memmap(path, dtype=dtype, mode='r', offset=offsets[0], shape=(src.height, src.width))
+
+
+def histogram(path, bins=DEFAULT_BINS, value_range=INDEX_RANGE, band=1):
+    with RasterReader(path, band) as reader:
+        return reader.histogram(bins, value_range)
+
+
+def quantiles(path, qs, band=1, bins=DEFAULT_BINS, value_range=INDEX_RANGE):
+    with RasterReader(path, band) as reader:
+        return reader.quantiles(qs, bins, value_range)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Out-of-core quantiles and histogram of a raster band.")
+    parser.add_argument('raster')
+    parser.add_argument('--band', type=int, default=1)
+    parser.add_argument('--quantiles', nargs='+', type=float, default=[2, 25, 50, 75, 98])
+    parser.add_argument('--bins', type=int, default=20, help="histogram bins to print")
+    args = parser.parse_args()
+
+    with RasterReader(args.raster, args.band) as reader:
+        layout = 'memory-mapped' if reader.memmap() is not None else \
+            f"{reader.block_width}x{reader.block_height} blocks"
+        print(f"{args.raster}: {reader.width}x{reader.height} {reader.dtype}, {layout}")
+        for q, value in zip(args.quantiles, reader.quantiles(args.quantiles)):
+            print(f"  p{q:g}\t{value:.4f}")
+        counts, edges = reader.histogram(args.bins, None)
+        for count, left, right in zip(counts, edges, edges[1:]):
+            print(f"  [{left:8.4f}, {right:8.4f})\t{count}")
@@ -0,0 +1,247 @@
+import hashlib
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from local_composite import block_windows
+from resample import RasterGrid, raster_grid, read_padded
+
+# ---------------------------------------------------------------------
+# Local reprojection onto a common equal-area grid
+#
+# Exports use each script's default CRS (EPSG:4326 grids from
+# tiling.grid_for_bounds), so the sensors' outputs land on different
+# grids and comparing or summing areas needs an equal-area CRS anyway.
+# A Reprojector warps a downloaded raster onto a target grid in that
+# CRS (CONUS Albers by default), snapped to multiples of the target
+# resolution so that e.g. 30 m and 240 m outputs nest (see resample.py).
+#
+# The expensive part -- projecting every target pixel centre back into
+# the source grid -- depends only on the two grids, so it is done once
+# per (source grid, target grid) pair and cached under `cache_dir` as a
+# two-band float32 GeoTIFF of source (col, row) on the target grid.
+# Every year, season and metric exported on the same grid reuses it.
+# Warping is then a lookup: target tiles are spread across a process
+# pool, each reading its slice of the map and the source window it
+# covers, so memory is bounded by the tile size.
+# ---------------------------------------------------------------------
+TARGET_CRS = 'EPSG:5070'    # NAD83 / CONUS Albers equal area
+BLOCK_SIZE = 512            # target pixels per side per warp tile
+RESAMPLING = ('nearest', 'bilinear')
+METERS_PER_DEGREE = 111320.0
+
+
+def _pool(processes, max_workers):
+    # Threads for callers without a __main__ guard (spawned workers would re-run them).
+    return (ProcessPoolExecutor if processes else ThreadPoolExecutor)(max_workers=max_workers)
+
+
+def target_grid(src, crs=TARGET_CRS, res=None):
+    """Grid in `crs` covering the RasterGrid `src`, with its origin snapped to multiples of `res`.
+
+    `res` defaults to the source pixel size in meters.
+    """
+    from affine import Affine
+    from rasterio.crs import CRS
+    from rasterio.transform import array_bounds
+    from rasterio.warp import transform_bounds
+
+    if res is None:
+        res = abs(src.transform.a)
+        if src.crs.is_geographic:
+            res = round(res * METERS_PER_DEGREE, 3)
+    bounds = array_bounds(src.height, src.width, src.transform)
+    west, south, east, north = transform_bounds(src.crs, crs, *bounds, densify_pts=21)
+    x0 = math.floor(west / res) * res
+    y0 = math.ceil(north / res) * res
+    width = int(math.ceil((east - x0) / res))
+    height = int(math.ceil((y0 - south) / res))
+    return RasterGrid(CRS.from_user_input(crs), Affine(res, 0, x0, 0, -res, y0), width, height)
+
+
+class WarpGrid:
+    """Cached source (col, row) of every target pixel centre, for one (source, target) grid pair."""
+
+    def __init__(self, src, dst, cache_dir='warp_cache'):
+        self.src = src
+        self.dst = dst
+        self.cache_dir = cache_dir
+
+    def path(self):
+        key = json.dumps([[str(g.crs), list(g.transform)[:6], g.width, g.height] for g in (self.src, self.dst)])
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, 'warp_grid', f"warp_{digest}.tif")
+
+    def build(self, block_size=BLOCK_SIZE, max_workers=None, processes=True):
+        """Path of the cached map, computing it (in parallel tiles) on first use."""
+        import rasterio
+
+        path = self.path()
+        if os.path.exists(path):
+            return path
+        profile = dict(driver='GTiff', width=self.dst.width, height=self.dst.height, count=2, dtype='float32',
+                       crs=self.dst.crs, transform=self.dst.transform, nodata=float('nan'), tiled=True,
+                       blockxsize=256, blockysize=256, compress='deflate', predictor=3, BIGTIFF='IF_SAFER')
+        print(f"🧭 Computing warp grid {self.src.width}x{self.src.height} -> {self.dst.width}x{self.dst.height}...")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        jobs = [(self.src, self.dst, w) for w in block_windows(self.dst.width, self.dst.height, block_size)]
+        with rasterio.open(path + '.tmp', 'w', **profile) as out:
+            with _pool(processes, max_workers) as pool:
+                for window, coords in pool.map(_warp_grid_block, jobs):
+                    out.write(coords, window=window)
+        os.replace(path + '.tmp', path)
+        return path
+
+
+def _warp_grid_block(args):
+    import numpy as np
+    from rasterio.warp import transform as warp_transform
+
+    src, dst, window = args
+    rows, cols = np.mgrid[int(window.row_off):int(window.row_off + window.height),
+                          int(window.col_off):int(window.col_off + window.width)]
+    xs, ys = dst.transform * (cols.ravel() + 0.5, rows.ravel() + 0.5)
+    if src.crs != dst.crs:
+        xs, ys = warp_transform(dst.crs, src.crs, xs, ys)
+    # Source coordinates in pixel-centre units: (0, 0) is the centre of the top-left pixel.
+    c, r = ~src.transform * (np.asarray(xs), np.asarray(ys))
+    c, r = c - 0.5, r - 0.5
+    outside = (c < -0.5) | (r < -0.5) | (c > src.width - 0.5) | (r > src.height - 0.5) | ~np.isfinite(c)
+    c[outside] = np.nan
+    r[outside] = np.nan
+    return window, np.stack([c, r]).reshape((2,) + rows.shape).astype('float32')
+
+
+def _sample(data, c, r, resampling):
+    """Values of the masked array `data` at fractional pixel positions; masked where nothing valid."""
+    import numpy as np
+
+    h, w = data.shape
+    valid = ~np.ma.getmaskarray(data)
+    values = np.ma.getdata(data).astype('float64')
+    if resampling == 'nearest':
+        ri = np.clip(np.rint(r).astype('int64'), 0, h - 1)
+        ci = np.clip(np.rint(c).astype('int64'), 0, w - 1)
+        return np.ma.array(values[ri, ci], mask=~valid[ri, ci])
+
+    # Bilinear over the valid neighbours, weights renormalized (GDAL does the same at masks).
+    r0, c0 = np.floor(r).astype('int64'), np.floor(c).astype('int64')
+    fr, fc = r - r0, c - c0
+    total = np.zeros(r.shape)
+    weight = np.zeros(r.shape)
+    for dr, dc, wgt in ((0, 0, (1 - fr) * (1 - fc)), (0, 1, (1 - fr) * fc),
+                        (1, 0, fr * (1 - fc)), (1, 1, fr * fc)):
+        ri = np.clip(r0 + dr, 0, h - 1)
+        ci = np.clip(c0 + dc, 0, w - 1)
+        ok = valid[ri, ci] & (wgt > 0)
+        total += np.where(ok, values[ri, ci] * wgt, 0.0)
+        weight += np.where(ok, wgt, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = total / weight
+    return np.ma.array(out, mask=weight <= 1e-9)
+
+
+def _warp_block(args):
+    import numpy as np
+    import rasterio
+    from rasterio.windows import Window
+
+    src_path, map_path, window, resampling = args
+    with rasterio.open(map_path) as m:
+        c, r = m.read(window=window).astype('float64')
+    shape = c.shape
+    inside = np.isfinite(c)
+    if not inside.any():
+        return window, None
+    c, r = c[inside], r[inside]
+    c0, r0 = int(math.floor(c.min())) - 1, int(math.floor(r.min())) - 1
+    c1, r1 = int(math.ceil(c.max())) + 2, int(math.ceil(r.max())) + 2
+    with rasterio.open(src_path) as src:
+        data = read_padded(src, Window(c0, r0, c1 - c0, r1 - r0))
+    values = _sample(data, c - c0, r - r0, resampling)
+    out = np.ma.array(np.zeros(shape), mask=True)
+    out[inside] = values
+    return window, out
+
+
+class Reprojector:
+    """Warp rasters onto an equal-area grid; usable as a post-download step (`reprojector(path)`).
+
+    Every band-1 value is read with its scale/offset (cog.read_scaled)
+    and written back in the source's dtype, scale, offset and nodata, so
+    scaled-int16 exports stay scaled int16.
+    """
+
+    def __init__(self, crs=TARGET_CRS, res=None, cache_dir='warp_cache', resampling='bilinear',
+                 block_size=BLOCK_SIZE, max_workers=None, processes=True):
+        if resampling not in RESAMPLING:
+            raise ValueError(f"Unknown resampling '{resampling}'; expected one of {RESAMPLING}")
+        self.crs = crs
+        self.res = res
+        self.cache_dir = cache_dir
+        self.resampling = resampling
+        self.block_size = block_size
+        self.max_workers = max_workers
+        self.processes = processes
+
+    def grid_for(self, src):
+        return target_grid(src, self.crs, self.res)
+
+    def __call__(self, path, out_path=None):
+        """Warp `path` (in place if `out_path` is None); returns the output path."""
+        import numpy as np
+        import rasterio
+        from cog import NODATA, quantize
+
+        src_grid = raster_grid(path)
+        dst_grid = self.grid_for(src_grid)
+        warp = WarpGrid(src_grid, dst_grid, self.cache_dir)
+        map_path = warp.build(self.block_size, self.max_workers, self.processes)
+
+        out_path = out_path or path
+        with rasterio.open(path) as src:
+            dtype = src.dtypes[0]
+            is_int = np.issubdtype(np.dtype(dtype), np.integer)
+            nodata = src.nodata if src.nodata is not None else (NODATA if is_int else float('nan'))
+            scale, offset = src.scales[0], src.offsets[0]
+            profile = dict(driver='GTiff', width=dst_grid.width, height=dst_grid.height, count=1, dtype=dtype,
+                           crs=dst_grid.crs, transform=dst_grid.transform, nodata=nodata, tiled=True,
+                           blockxsize=256, blockysize=256, compress='deflate',
+                           predictor=2 if is_int else 3, BIGTIFF='IF_SAFER')
+
+        tmp_path = out_path + '.warp.tmp'
+        jobs = [(path, map_path, w, self.resampling)
+                for w in block_windows(dst_grid.width, dst_grid.height, self.block_size)]
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            dst.scales, dst.offsets = [scale], [offset]
+            with _pool(self.processes, self.max_workers) as pool:
+                for window, values in pool.map(_warp_block, jobs):
+                    if values is None:
+                        continue   # left as nodata
+                    if is_int:
+                        data = quantize(values, scale, offset, nodata).astype(dtype)
+                    else:
+                        data = values.filled(nodata).astype(dtype)
+                    dst.write(data, 1, window=window)
+        os.replace(tmp_path, out_path)
+        print(f"🗺️ Reprojected {os.path.basename(path)} to {self.crs} "
+              f"({dst_grid.width}x{dst_grid.height} at {dst_grid.transform.a:g})")
+        return out_path
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Reproject rasters onto a common equal-area grid.")
+    parser.add_argument('rasters', nargs='+')
+    parser.add_argument('--out-dir', help="default: overwrite in place")
+    parser.add_argument('--crs', default=TARGET_CRS)
+    parser.add_argument('--res', type=float, help="target pixel size (default: the source's, in meters)")
+    parser.add_argument('--resampling', choices=RESAMPLING, default='bilinear')
+    parser.add_argument('--cache-dir', default='warp_cache')
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    reprojector = Reprojector(args.crs, args.res, args.cache_dir, args.resampling, max_workers=args.workers)
+    for path in args.rasters:
+        reprojector(path, os.path.join(args.out_dir, os.path.basename(path)) if args.out_dir else None)
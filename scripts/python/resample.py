@@ -0,0 +1,354 @@
+import hashlib
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from local_composite import block_windows
+
+# ---------------------------------------------------------------------
+# Cross-sensor resampling and agreement
+#
+# The same NDVI product comes out at 250 m (MODIS), 30 m (Landsat) and
+# 10-100 m (Sentinel). To compare them the finer raster is averaged
+# onto the coarser grid, one coarse block at a time:
+#   * when the grids nest (same CRS, the coarse pixel an integer number
+#     k of fine pixels, origins k-aligned) a fine window is reshaped to
+#     (rows, k, cols, k) and reduced -- no coordinates are computed;
+#   * otherwise every fine pixel is assigned the coarse pixel holding
+#     its centre, once per grid pair. That index map is a compressed
+#     uint32 GeoTIFF on the fine grid cached under `cache_dir` (like the
+#     zone index in zonal_stats.py), and aggregation is a bincount over
+#     it.
+# A coarse pixel gets a value when at least `min_coverage` of the fine
+# pixels it holds are valid.
+#
+# agreement() streams (fine, coarse) pairs -- one per year or season --
+# block by block across a process pool and accumulates n, sums, squares
+# and cross products, so bias (fine - coarse), RMSE and Pearson r come
+# out per pixel (over time), per zone and overall without holding
+# either raster in memory.
+# ---------------------------------------------------------------------
+BLOCK_SIZE = 256          # coarse pixels per side per block
+MIN_COVERAGE = 0.5
+NODATA = float('nan')
+NEST_TOLERANCE = 1e-6     # relative; how close k and the offsets must be to integers
+AGREEMENT_BANDS = ('bias', 'rmse', 'r', 'n')
+
+RasterGrid = namedtuple('RasterGrid', ['crs', 'transform', 'width', 'height'])
+
+
+def raster_grid(path):
+    import rasterio
+    with rasterio.open(path) as src:
+        return RasterGrid(src.crs, src.transform, src.width, src.height)
+
+
+def nesting(fine, coarse, tolerance=NEST_TOLERANCE):
+    """(k, row offset, col offset) in fine pixels when `coarse` nests on `fine`, else None."""
+    if fine.crs != coarse.crs or fine.transform.b or fine.transform.d or coarse.transform.b or coarse.transform.d:
+        return None
+
+    def whole(value):
+        return round(value) if abs(value - round(value)) <= tolerance * max(1.0, abs(value)) else None
+
+    kx = whole(coarse.transform.a / fine.transform.a)
+    ky = whole(coarse.transform.e / fine.transform.e)
+    col = whole((coarse.transform.c - fine.transform.c) / fine.transform.a)
+    row = whole((coarse.transform.f - fine.transform.f) / fine.transform.e)
+    if None in (kx, ky, col, row) or kx != ky or kx < 1:
+        return None
+    return kx, row, col
+
+
+def read_padded(src, window):
+    """Masked float read of `window`, which may run past the raster's edges."""
+    import numpy as np
+    from rasterio.windows import Window
+    from cog import read_scaled
+
+    r0, c0 = int(window.row_off), int(window.col_off)
+    h, w = int(window.height), int(window.width)
+    out = np.ma.array(np.zeros((h, w), dtype='float32'), mask=True)
+    rr0, cc0 = max(r0, 0), max(c0, 0)
+    rr1, cc1 = min(r0 + h, src.height), min(c0 + w, src.width)
+    if rr1 > rr0 and cc1 > cc0:
+        data = read_scaled(src, window=Window(cc0, rr0, cc1 - cc0, rr1 - rr0))
+        data = np.ma.masked_invalid(data)
+        out[rr0 - r0:rr1 - r0, cc0 - c0:cc1 - c0] = data
+    return out
+
+
+class Resampler:
+    """Average rasters on the `fine` grid onto the `coarse` grid (both RasterGrids)."""
+
+    def __init__(self, fine, coarse, cache_dir='resample_cache', min_coverage=MIN_COVERAGE):
+        self.fine = fine
+        self.coarse = coarse
+        self.cache_dir = cache_dir
+        self.min_coverage = min_coverage
+        self.nest = nesting(fine, coarse)
+
+    @property
+    def method(self):
+        return 'nested' if self.nest else 'index'
+
+    # -----------------------------------------------------------------
+    # Index map (grids that do not nest)
+    # -----------------------------------------------------------------
+    def index_path(self):
+        key = json.dumps([[str(g.crs), list(g.transform)[:6], g.width, g.height] for g in (self.fine, self.coarse)])
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, 'resample_index', f"index_{digest}.tif")
+
+    def index_map(self, block_size=1024):
+        """Path of the fine-grid raster of 1 + flat coarse pixel index (0 = outside), built on first use."""
+        import numpy as np
+        import rasterio
+        from rasterio.warp import transform as warp_transform
+
+        path = self.index_path()
+        if os.path.exists(path):
+            return path
+        fine, coarse = self.fine, self.coarse
+        if coarse.width * coarse.height >= 2 ** 32 - 1:
+            raise ValueError("Coarse grid is too large for a uint32 index map")
+        profile = dict(driver='GTiff', width=fine.width, height=fine.height, count=1, dtype='uint32',
+                       crs=fine.crs, transform=fine.transform, nodata=0, tiled=True, blockxsize=256,
+                       blockysize=256, compress='deflate', predictor=2, BIGTIFF='IF_SAFER')
+        inverse = ~coarse.transform
+        print(f"🧮 Mapping {fine.width}x{fine.height} fine pixels onto the {coarse.width}x{coarse.height} grid...")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with rasterio.open(path + '.tmp', 'w', **profile) as dst:
+            for window in block_windows(fine.width, fine.height, block_size):
+                rows, cols = np.mgrid[int(window.row_off):int(window.row_off + window.height),
+                                      int(window.col_off):int(window.col_off + window.width)]
+                xs, ys = fine.transform * (cols.ravel() + 0.5, rows.ravel() + 0.5)
+                if fine.crs != coarse.crs:
+                    xs, ys = warp_transform(fine.crs, coarse.crs, xs, ys)
+                c, r = inverse * (np.asarray(xs), np.asarray(ys))
+                c, r = np.floor(c).astype('int64'), np.floor(r).astype('int64')
+                inside = (r >= 0) & (r < coarse.height) & (c >= 0) & (c < coarse.width)
+                flat = np.where(inside, r * coarse.width + c + 1, 0).astype('uint32')
+                dst.write(flat.reshape(rows.shape), 1, window=window)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def _fine_window(self, window):
+        """Fine-grid window covering a coarse window, one pixel of margin, clipped to the raster."""
+        import math
+        from rasterio import windows
+        from rasterio.warp import transform_bounds
+
+        bounds = windows.bounds(window, self.coarse.transform)
+        if self.fine.crs != self.coarse.crs:
+            bounds = transform_bounds(self.coarse.crs, self.fine.crs, *bounds, densify_pts=21)
+        w = windows.from_bounds(*bounds, transform=self.fine.transform)
+        r0 = max(int(math.floor(w.row_off)) - 1, 0)
+        c0 = max(int(math.floor(w.col_off)) - 1, 0)
+        r1 = min(int(math.ceil(w.row_off + w.height)) + 1, self.fine.height)
+        c1 = min(int(math.ceil(w.col_off + w.width)) + 1, self.fine.width)
+        return windows.Window(c0, r0, max(c1 - c0, 0), max(r1 - r0, 0))
+
+    # -----------------------------------------------------------------
+    # Aggregation
+    # -----------------------------------------------------------------
+    def aggregate_block(self, src, window, index_src=None):
+        """Mean of the fine raster `src` over each coarse pixel of `window`; masked float32 (rows, cols)."""
+        import numpy as np
+        from rasterio.windows import Window
+
+        h, w = int(window.height), int(window.width)
+        if self.nest:
+            k, row, col = self.nest
+            r0, c0 = row + int(window.row_off) * k, col + int(window.col_off) * k
+            fine = read_padded(src, Window(c0, r0, w * k, h * k))
+            valid = ~np.ma.getmaskarray(fine)
+            total = np.where(valid, fine.data, 0).reshape(h, k, w, k).sum(axis=(1, 3), dtype='float64')
+            count = valid.reshape(h, k, w, k).sum(axis=(1, 3))
+            # Coverage counts only fine pixels inside the raster, as the index map does.
+            rows = np.arange(r0, r0 + h * k)
+            cols = np.arange(c0, c0 + w * k)
+            in_rows = ((rows >= 0) & (rows < self.fine.height)).reshape(h, k).sum(axis=1)
+            in_cols = ((cols >= 0) & (cols < self.fine.width)).reshape(w, k).sum(axis=1)
+            expected = in_rows[:, None] * in_cols[None, :]
+        else:
+            fw = self._fine_window(window)
+            total = np.zeros(h * w)
+            count = np.zeros(h * w, dtype='int64')
+            expected = np.zeros(h * w, dtype='int64')
+            if fw.width and fw.height:
+                flat = index_src.read(1, window=fw).astype('int64') - 1
+                r, c = flat // self.coarse.width - int(window.row_off), flat % self.coarse.width - int(window.col_off)
+                local = np.where((flat >= 0) & (r >= 0) & (r < h) & (c >= 0) & (c < w), r * w + c, -1)
+                fine = read_padded(src, fw)
+                valid = ~np.ma.getmaskarray(fine) & (local >= 0)
+                expected = np.bincount(local[local >= 0], minlength=h * w)
+                count = np.bincount(local[valid], minlength=h * w)
+                total = np.bincount(local[valid], weights=fine.data[valid].astype('float64'), minlength=h * w)
+            total, count, expected = total.reshape(h, w), count.reshape(h, w), expected.reshape(h, w)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = (total / count).astype('float32')
+        keep = (count > 0) & (count >= self.min_coverage * expected)
+        return np.ma.array(mean, mask=~keep)
+
+    def _open_index(self):
+        import rasterio
+        return None if self.nest else rasterio.open(self.index_map())
+
+    def aggregate(self, fine_path, out_path, block_size=BLOCK_SIZE):
+        """Write `fine_path` averaged onto the coarse grid as a float32 GeoTIFF."""
+        import rasterio
+
+        profile = dict(driver='GTiff', width=self.coarse.width, height=self.coarse.height, count=1,
+                       dtype='float32', crs=self.coarse.crs, transform=self.coarse.transform, nodata=NODATA,
+                       tiled=True, blockxsize=256, blockysize=256, compress='deflate', predictor=3)
+        os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+        index_src = self._open_index()
+        try:
+            with rasterio.open(fine_path) as src, rasterio.open(out_path, 'w', **profile) as dst:
+                for window in block_windows(self.coarse.width, self.coarse.height, block_size):
+                    dst.write(self.aggregate_block(src, window, index_src).filled(NODATA), 1, window=window)
+        finally:
+            if index_src is not None:
+                index_src.close()
+        print(f"🔁 {os.path.basename(fine_path)} -> {out_path} ({self.method})")
+        return out_path
+
+
+# ---------------------------------------------------------------------
+# Agreement
+# ---------------------------------------------------------------------
+SUMS = ('n', 'sx', 'sy', 'sxx', 'syy', 'sxy', 'sdd')   # x = coarse, y = fine aggregated
+
+
+def _agreement_block_job(args):
+    import numpy as np
+    import rasterio
+
+    resampler, pairs, window = args
+    h, w = int(window.height), int(window.width)
+    acc = np.zeros((len(SUMS), h, w))
+    index_src = resampler._open_index()
+    try:
+        for fine_path, coarse_path in pairs:
+            with rasterio.open(fine_path) as fsrc, rasterio.open(coarse_path) as csrc:
+                y = resampler.aggregate_block(fsrc, window, index_src)
+                x = read_padded(csrc, window)
+            ok = ~(np.ma.getmaskarray(x) | np.ma.getmaskarray(y))
+            xv = np.where(ok, x.data, 0).astype('float64')
+            yv = np.where(ok, y.data, 0).astype('float64')
+            acc += np.stack([ok, xv, yv, xv * xv, yv * yv, xv * yv, (yv - xv) ** 2])
+    finally:
+        if index_src is not None:
+            index_src.close()
+    return window, acc
+
+
+def agreement_stats(acc):
+    """{'n', 'bias', 'rmse', 'r'} from accumulated SUMS (arrays or scalars along axis 0)."""
+    import numpy as np
+
+    n, sx, sy, sxx, syy, sxy, sdd = acc
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bias = (sy - sx) / n
+        rmse = np.sqrt(sdd / n)
+        r = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx * sx) * (n * syy - sy * sy))
+    return {'n': n, 'bias': bias, 'rmse': rmse, 'r': r}
+
+
+def agreement(pairs, cache_dir='resample_cache', out_path=None, zones=None, min_coverage=MIN_COVERAGE,
+              block_size=BLOCK_SIZE, max_workers=None):
+    """Bias (fine - coarse), RMSE and r between fine rasters averaged onto coarse ones.
+
+    `pairs` is [(fine path, coarse path)], e.g. one per year; every fine
+    raster shares a grid and so does every coarse one. Returns
+    {'overall': stats, 'zones': {zone id: stats}}; with `out_path` the
+    per-pixel stats over all pairs are also written there (bands
+    AGREEMENT_BANDS). `zones` is a zonal_stats.ZoneIndex.
+    """
+    import numpy as np
+    import rasterio
+
+    fine, coarse = raster_grid(pairs[0][0]), raster_grid(pairs[0][1])
+    for fine_path, coarse_path in pairs[1:]:
+        if raster_grid(fine_path) != fine or raster_grid(coarse_path) != coarse:
+            raise ValueError(f"({fine_path}, {coarse_path}) is not on the grids of the first pair")
+    resampler = Resampler(fine, coarse, cache_dir, min_coverage)
+    if not resampler.nest:
+        resampler.index_map()   # build once here, not in every worker
+
+    overall = np.zeros(len(SUMS))
+    zone_ids, zone_acc, zone_src = None, None, None
+    if zones is not None:
+        zone_ids = [zone_id for zone_id, _ in zones.zones()]
+        zone_acc = np.zeros((len(SUMS), len(zone_ids) + 1))
+        zone_src = rasterio.open(zones.grid_index(coarse.crs, coarse.transform, (coarse.height, coarse.width)))
+    dst = None
+    if out_path is not None:
+        os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+        dst = rasterio.open(out_path, 'w', driver='GTiff', width=coarse.width, height=coarse.height,
+                            count=len(AGREEMENT_BANDS), dtype='float32', crs=coarse.crs,
+                            transform=coarse.transform, nodata=NODATA, tiled=True, blockxsize=256,
+                            blockysize=256, compress='deflate', predictor=3)
+        for band, name in enumerate(AGREEMENT_BANDS, start=1):
+            dst.set_band_description(band, name)
+
+    print(f"🔍 Comparing {len(pairs)} pair(s) on the {coarse.width}x{coarse.height} grid ({resampler.method})...")
+    jobs = [(resampler, list(pairs), w) for w in block_windows(coarse.width, coarse.height, block_size)]
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            for window, acc in pool.map(_agreement_block_job, jobs):
+                overall += acc.reshape(len(SUMS), -1).sum(axis=1)
+                if zone_src is not None:
+                    z = zone_src.read(1, window=window).ravel().astype('int64')
+                    for i, values in enumerate(acc.reshape(len(SUMS), -1)):
+                        zone_acc[i] += np.bincount(z, weights=values, minlength=len(zone_ids) + 1)
+                if dst is not None:
+                    stats = agreement_stats(acc)
+                    dst.write(np.stack([stats[b] for b in AGREEMENT_BANDS]).astype('float32'), window=window)
+    finally:
+        if dst is not None:
+            dst.close()
+        if zone_src is not None:
+            zone_src.close()
+
+    def plain(stats):
+        return {k: (None if not np.isfinite(v) else (int(v) if k == 'n' else float(v))) for k, v in stats.items()}
+
+    result = {'overall': plain(agreement_stats(overall)), 'zones': {}}
+    if zone_acc is not None:
+        by_zone = agreement_stats(zone_acc)
+        result['zones'] = {zone_id: plain({k: v[i] for k, v in by_zone.items()})
+                           for i, zone_id in enumerate(zone_ids, start=1)}
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Average fine rasters onto a coarse grid and compare them.")
+    parser.add_argument('pairs', nargs='+', help="fine=coarse raster pairs, e.g. one per year")
+    parser.add_argument('--cache-dir', default='resample_cache')
+    parser.add_argument('--out', help="per-pixel agreement GeoTIFF")
+    parser.add_argument('--aggregate', metavar='DIR', help="also write each fine raster on the coarse grid here")
+    parser.add_argument('--zones', help="states, counties, tracts or a GeoJSON path (see zonal_stats.py)")
+    parser.add_argument('--zone-csv', help="per-zone agreement CSV")
+    parser.add_argument('--min-coverage', type=float, default=MIN_COVERAGE)
+    args = parser.parse_args()
+
+    pairs = [tuple(p.split('=', 1)) for p in args.pairs]
+    if args.aggregate:
+        resampler = Resampler(raster_grid(pairs[0][0]), raster_grid(pairs[0][1]), args.cache_dir,
+                              args.min_coverage)
+        for fine_path, _ in pairs:
+            resampler.aggregate(fine_path, os.path.join(args.aggregate, os.path.basename(fine_path)))
+    zones = None
+    if args.zones:
+        from zonal_stats import ZoneIndex
+        zones = ZoneIndex(args.zones, args.cache_dir)
+    result = agreement(pairs, args.cache_dir, args.out, zones, args.min_coverage)
+    overall = result['overall']
+    print(f"📊 n={overall['n']} bias={overall['bias']} rmse={overall['rmse']} r={overall['r']}")
+    if args.zone_csv:
+        from zonal_stats import write_csv
+        write_csv({'agreement': result['zones']}, args.zone_csv)
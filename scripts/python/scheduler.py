@@ -0,0 +1,269 @@
+import heapq
+import itertools
+import re
+import time
+
+from export_cache import start_export
+from task_monitor import TaskMonitor
+from tiling import region_maker, split_tile, tile_export_params, tile_prefix
+
+# ---------------------------------------------------------------------
+# Quota-aware export scheduler
+#
+# The scripts used to start every export at once and drop any task that
+# FAILED. The scheduler keeps at most `max_in_flight` tasks queued or
+# running (counting other READY/RUNNING tasks the project already has),
+# submits the highest-priority job first (e.g. newest year), and sorts
+# failures into three kinds:
+#   * transient (internal errors, quota) -- resubmitted with
+#     exponential backoff, up to `max_retries` times;
+#   * resource (memory limit, timeout, too many pixels) -- re-planned:
+#     a tiled job is split into quarter tiles on the same grid, and an
+#     untiled job with `allow_coarsen` is retried at twice the scale;
+#   * anything else -- reported as failed.
+# A submission refused because the task queue is full does not use up a
+# retry: the job goes back on the queue and the in-flight limit drops to
+# what the server is actually accepting.
+# ---------------------------------------------------------------------
+MAX_IN_FLIGHT = 4
+MAX_RETRIES = 4
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 1800
+MIN_TILE_PIXELS = 256 * 256 * 4
+ACTIVE_STATES = ('READY', 'RUNNING')
+
+TRANSIENT_ERRORS = re.compile(
+    r"internal error|service unavailable|too many tasks|quota|rate limit|deadline|try again|backend",
+    re.IGNORECASE)
+QUEUE_FULL = re.compile(r"too many tasks|queue is full", re.IGNORECASE)
+RESOURCE_ERRORS = re.compile(
+    r"memory limit|out of memory|timed out|too many pixels|maxpixels|computation too large",
+    re.IGNORECASE)
+
+
+def classify_error(message):
+    """'transient', 'resource' or 'permanent' for a task error message."""
+    message = message or ''
+    if RESOURCE_ERRORS.search(message):
+        return 'resource'
+    if TRANSIENT_ERRORS.search(message):
+        return 'transient'
+    return 'permanent'
+
+
+class ExportJob:
+    """One export to schedule.
+
+    `params` are the Export.image.toDrive arguments other than the region
+    of a tiled job: with `grid` and `tile` (from tiling.plan_tiles) the
+    region, crs and crsTransform are filled in at submission, which is
+    what lets the job be split.
+    """
+
+    def __init__(self, image, label, file_prefix, params, priority=0, grid=None, tile=None,
+                 allow_coarsen=False):
+        self.image = image
+        self.label = label
+        self.file_prefix = file_prefix
+        self.params = dict(params, fileNamePrefix=file_prefix)
+        self.priority = priority
+        self.grid = grid
+        self.tile = tile
+        self.allow_coarsen = allow_coarsen
+        self.attempts = 0
+        self.not_before = 0.0
+        self.task_id = None
+        self.key = None
+
+    def __repr__(self):
+        return f"ExportJob({self.label!r}, priority={self.priority}, attempts={self.attempts})"
+
+
+class ExportScheduler:
+    """Submit ExportJobs under a concurrency limit, retrying and re-planning failures.
+
+    `on_submit(job, task, key)` is called for every submission (task is
+    None when the export cache already holds the outputs); tasks not
+    watched by then are added to `monitor`. `on_split(job, children)`
+    is called when a job is re-planned into smaller ones, and
+    `on_failed(job, status)` when a job is given up on. `export`,
+    `task_state` and `manifest` are as for export_cache.start_export.
+    """
+
+    def __init__(self, monitor=None, max_in_flight=MAX_IN_FLIGHT, max_retries=MAX_RETRIES,
+                 retry_delay=RETRY_DELAY, max_retry_delay=MAX_RETRY_DELAY, manifest=None,
+                 export=None, task_state=None, on_submit=None, on_split=None, on_failed=None,
+                 min_tile_pixels=MIN_TILE_PIXELS, clock=time.time, sleep=time.sleep):
+        self.monitor = monitor or TaskMonitor()
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.manifest = manifest
+        self.export = export
+        self.task_state = task_state
+        self.on_submit = on_submit
+        self.on_split = on_split
+        self.on_failed = on_failed
+        self.min_tile_pixels = min_tile_pixels
+        self.clock = clock
+        self.sleep = sleep
+        self.queue = []       # heap of (-priority, seq, job)
+        self.in_flight = {}   # task_id -> job
+        self.completed = []
+        self.failed = []
+        self.counts = {'submitted': 0, 'retried': 0, 'split': 0, 'coarsened': 0}
+        self._seq = itertools.count()
+        self._limit = max_in_flight
+
+    def add(self, job):
+        heapq.heappush(self.queue, (-job.priority, next(self._seq), job))
+        return job
+
+    # -----------------------------------------------------------------
+    # Main loop
+    # -----------------------------------------------------------------
+    def run(self):
+        """Submit and watch jobs until every one has completed or been given up on."""
+        while self.queue or self.in_flight:
+            self._submit_ready()
+            if self.in_flight or self.queue:
+                # Also refreshes the listing used to count free slots.
+                for task_id, label, status in self.monitor.poll():
+                    job = self.in_flight.pop(task_id, None)
+                    if job is not None:
+                        self._finished(job, status)
+            if self.queue or self.in_flight:
+                self.sleep(self._next_delay())
+        print(f"📋 Scheduler: {len(self.completed)} completed, {len(self.failed)} failed "
+              f"({self.counts['retried']} retries, {self.counts['split']} splits, "
+              f"{self.counts['coarsened']} coarsened)")
+        return {'completed': self.completed, 'failed': self.failed}
+
+    def _active(self):
+        listing = self.monitor.last_listing
+        active = sum(1 for s in listing.values() if s.get('state') in ACTIVE_STATES)
+        # Freshly submitted tasks may not be listed yet.
+        return max(active, len(self.in_flight))
+
+    def _free_slots(self):
+        return self._limit - self._active()
+
+    def _submit_ready(self):
+        now = self.clock()
+        deferred = []
+        while self.queue and self._free_slots() > 0:
+            item = heapq.heappop(self.queue)
+            job = item[2]
+            if job.not_before > now:
+                deferred.append(item)
+                continue
+            self._submit(job)
+        for item in deferred:
+            heapq.heappush(self.queue, item)
+
+    def _next_delay(self):
+        now = self.clock()
+        backing_off = [item[2].not_before for item in self.queue if item[2].not_before > now]
+        if backing_off:
+            return min(self.monitor.delay, min(backing_off) - now)
+        return self.monitor.delay
+
+    def _submit(self, job):
+        export, make_region = region_maker(self.export, job.grid) if job.grid else (self.export, None)
+        params = dict(job.params)
+        if job.tile is not None:
+            params.update(tile_export_params(job.grid, job.tile, make_region))
+        job.attempts += 1
+        try:
+            task, job.key = start_export(job.image, manifest=self.manifest, export=export,
+                                         task_state=self.task_state, **params)
+        except Exception as e:
+            if QUEUE_FULL.search(str(e)):
+                job.attempts -= 1
+                job.not_before = self.clock() + self.retry_delay
+                self._limit = max(1, self._active())
+                print(f"🚦 Task queue full; holding at {self._limit} task(s) in flight")
+                self.add(job)
+            elif classify_error(str(e)) == 'permanent':
+                self._give_up(job, {'state': 'FAILED', 'error_message': str(e)})
+            else:
+                self._retry(job, str(e))
+            return
+        self.counts['submitted'] += 1
+        if self.on_submit is not None:
+            self.on_submit(job, task, job.key)
+        if task is None:
+            self.completed.append(job)
+            return
+        job.task_id = task if isinstance(task, str) else task.id
+        if job.task_id not in self.monitor.pending:
+            self.monitor.add(job.task_id, job.label)
+        self.in_flight[job.task_id] = job
+
+    # -----------------------------------------------------------------
+    # Outcomes
+    # -----------------------------------------------------------------
+    def _finished(self, job, status):
+        state = status['state']
+        if state == 'COMPLETED':
+            self.completed.append(job)
+            return
+        message = status.get('error_message', state)
+        kind = classify_error(message) if state == 'FAILED' else 'permanent'
+        if kind == 'transient':
+            self._retry(job, message)
+        elif kind == 'resource' and self._replan(job, message):
+            return
+        else:
+            self._give_up(job, status)
+
+    def _retry(self, job, message):
+        if job.attempts > self.max_retries:
+            self._give_up(job, {'state': 'FAILED', 'error_message': message})
+            return
+        delay = min(self.retry_delay * 2 ** (job.attempts - 1), self.max_retry_delay)
+        job.not_before = self.clock() + delay
+        self.counts['retried'] += 1
+        print(f"🔁 {job.label}: {message} -- retrying in {delay:.0f} s (attempt {job.attempts + 1})")
+        self.add(job)
+
+    def _replan(self, job, message):
+        if job.tile is not None:
+            children = split_tile(job.grid, job.tile)
+            if len(children) > 1 and job.tile.width * job.tile.height > self.min_tile_pixels:
+                print(f"✂️ {job.label}: {message} -- splitting into {len(children)} tiles")
+                jobs = [ExportJob(job.image, f"{job.label}_{i}", f"{job.file_prefix}_{i}",
+                                  dict(job.params, description=f"{job.params.get('description', job.label)}_{i}"),
+                                  job.priority, job.grid, tile, job.allow_coarsen)
+                        for i, tile in enumerate(children, start=1)]
+                self.counts['split'] += 1
+                if self.on_split is not None:
+                    self.on_split(job, jobs)
+                for child in jobs:
+                    self.add(child)
+                return True
+        elif job.allow_coarsen and 'scale' in job.params:
+            scale = job.params['scale'] * 2
+            print(f"🔍 {job.label}: {message} -- retrying at {scale} m")
+            job.params = dict(job.params, scale=scale)
+            self.counts['coarsened'] += 1
+            self.add(job)
+            return True
+        return False
+
+    def _give_up(self, job, status):
+        print(f"❌ {job.label}: giving up after {job.attempts} attempt(s): "
+              f"{status.get('error_message', status['state'])}")
+        self.failed.append((job, status))
+        if self.on_failed is not None:
+            self.on_failed(job, status)
+
+
+def tile_jobs(image, grid, tiles, description, file_prefix, params, priority=0, label=None):
+    """ExportJobs for tiled exports, labelled and prefixed like tiling.export_tiles."""
+    label = label or file_prefix
+    return [ExportJob(image, f"{label}/tile{tile.id:04d}", tile_prefix(file_prefix, tile),
+                      dict(params, description=f"{description}_tile{tile.id:04d}"),
+                      priority, grid, tile)
+            for tile in tiles]
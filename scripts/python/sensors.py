@@ -0,0 +1,133 @@
+from monthly_store import SEASONS
+from query import CollectionQuery
+
+# ---------------------------------------------------------------------
+# Earth Engine sensor backends
+#
+# The export scripts differ mainly in which collection they read, how
+# they mask clouds and which bands feed each index. Those differences
+# live here as one spec per sensor, so ndvi.py can build any sensor's
+# composite for any year and season from the same code. The math
+# matches the scripts: normalizedDifference on the stored bands, the
+# QA_PIXEL bit-3 mask for Landsat, the CLOUDY_PIXEL_PERCENTAGE < 20
+# scene filter and a median for Sentinel-2, and MOD13Q1's own NDVI
+# band scaled by 0.0001. Chains are built as query.CollectionQuery
+# plans and optimized before use, so only the bands an index needs are
+# carried through the per-pixel work. `cloud_cover` names the scene
+# metadata a max_cloud_cover prefilter uses.
+#
+# Seasons run from the 1st of their first month to the 1st of the
+# month after their last (see monthly_store.py), so they include their
+# last calendar day.
+# ---------------------------------------------------------------------
+INDICES = {
+    'NDVI': ('nir', 'red'),
+    'NDBI': ('swir', 'nir'),
+}
+SENSORS = {
+    'modis': {
+        'label': 'MODIS MOD13Q1',
+        'collection': 'MODIS/061/MOD13Q1',
+        'all_bands': ['NDVI', 'EVI', 'DetailedQA', 'sur_refl_b01', 'sur_refl_b02', 'sur_refl_b03',
+                      'sur_refl_b07', 'ViewZenith', 'SolarZenith', 'RelativeAzimuth', 'DayOfYear',
+                      'SummaryQA'],
+        'cloud_cover': None,
+        'scale': 250,
+        'bands': {},
+        'precomputed': {'NDVI': ('NDVI', 0.0001)},   # index: (band, scale factor)
+        'qa_band': None,
+        'cloud_bit': None,
+        'scene_filter': None,
+        'reducer': 'mean',
+    },
+    'landsat': {
+        'label': 'Landsat 8 Collection 2 Level 2',
+        'collection': 'LANDSAT/LC08/C02/T1_L2',
+        'all_bands': ['SR_B1', 'SR_B2', 'SR_B3', 'SR_B4', 'SR_B5', 'SR_B6', 'SR_B7', 'SR_QA_AEROSOL',
+                      'ST_B10', 'ST_ATRAN', 'ST_CDIST', 'ST_DRAD', 'ST_EMIS', 'ST_EMSD', 'ST_QA',
+                      'ST_TRAD', 'ST_URAD', 'QA_PIXEL', 'QA_RADSAT'],
+        'cloud_cover': 'CLOUD_COVER',
+        'scale': 30,
+        'bands': {'red': 'SR_B4', 'nir': 'SR_B5', 'swir': 'SR_B6'},
+        'precomputed': {},
+        'qa_band': 'QA_PIXEL',
+        'cloud_bit': 3,
+        'scene_filter': None,
+        'reducer': 'mean',
+    },
+    'sentinel': {
+        'label': 'Sentinel-2 SR (harmonized)',
+        'collection': 'COPERNICUS/S2_SR_HARMONIZED',
+        'all_bands': ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B8A', 'B9', 'B11', 'B12',
+                      'AOT', 'WVP', 'SCL', 'TCI_R', 'TCI_G', 'TCI_B', 'MSK_CLDPRB', 'MSK_SNWPRB',
+                      'QA10', 'QA20', 'QA60'],
+        'cloud_cover': 'CLOUDY_PIXEL_PERCENTAGE',
+        'scale': 10,
+        'bands': {'red': 'B4', 'nir': 'B8', 'swir': 'B11'},
+        'precomputed': {},
+        'qa_band': None,
+        'cloud_bit': None,
+        'scene_filter': ('CLOUDY_PIXEL_PERCENTAGE', 20),   # keep scenes below this
+        'reducer': 'median',
+    },
+}
+
+
+def sensor_indices(sensor):
+    """Indices a sensor can produce."""
+    spec = SENSORS[sensor]
+    return tuple(name for name, roles in INDICES.items()
+                 if name in spec['precomputed'] or all(r in spec['bands'] for r in roles))
+
+
+def season_dates(year, season):
+    """('YYYY-MM-01', 'YYYY-MM-01') date range of a named season, end exclusive."""
+    months = SEASONS[season]
+    end_year, end_month = (year + 1, 1) if months[-1] == 12 else (year, months[-1] + 1)
+    return f"{year}-{months[0]:02d}-01", f"{end_year}-{end_month:02d}-01"
+
+
+def sensor_query(sensor, region, start, end, indices=('NDVI',), max_cloud_cover=None):
+    """The scripts' chain for one sensor as an unoptimized query.CollectionQuery.
+
+    It is written the way the scripts wrote it -- mask and indices
+    mapped over full images, select at the end -- so explain() on it and
+    on its optimize() shows what the rewrite saves. `max_cloud_cover`
+    adds a scene-metadata prefilter (it drops scenes, so it changes the
+    composite; off by default).
+    """
+    spec = SENSORS[sensor]
+    missing = set(indices) - set(sensor_indices(sensor))
+    if missing:
+        raise ValueError(f"{sensor} cannot produce {sorted(missing)}")
+    query = CollectionQuery(spec['collection'], spec['all_bands']).filter_date(start, end)
+    if region is not None:
+        query = query.filter_bounds(region)
+    if spec['scene_filter'] is not None:
+        query = query.filter_metadata(spec['scene_filter'][0], 'lt', spec['scene_filter'][1])
+    if max_cloud_cover is not None:
+        if spec['cloud_cover'] is None:
+            raise ValueError(f"{sensor} has no scene cloud-cover property")
+        query = query.filter_metadata(spec['cloud_cover'], 'lte', max_cloud_cover)
+    if spec['qa_band'] is not None:
+        query = query.mask_bits(spec['qa_band'], [spec['cloud_bit']])
+    for name in indices:
+        if name in spec['precomputed']:
+            band, factor = spec['precomputed'][name]
+            query = query.rescale(name, band, factor)
+        else:
+            first, second = INDICES[name]
+            query = query.index(name, spec['bands'][first], spec['bands'][second])
+    return query.select(indices)
+
+
+def index_collection(sensor, region, start, end, indices=('NDVI',), max_cloud_cover=None):
+    """ee.ImageCollection of the requested indices (in index units) for one sensor, optimized."""
+    return sensor_query(sensor, region, start, end, indices, max_cloud_cover).optimize().build()
+
+
+def composite(sensor, region, year, season='annual', indices=('NDVI',), max_cloud_cover=None):
+    """Per-pixel mean (or median, for Sentinel-2) of the indices over one season."""
+    start, end = season_dates(year, season)
+    collection = index_collection(sensor, region, start, end, indices, max_cloud_cover)
+    return collection.median() if SENSORS[sensor]['reducer'] == 'median' else collection.mean()
@@ -0,0 +1,205 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# ---------------------------------------------------------------------
+# Persistent per-unit run state
+#
+# The scripts loop over every year on every run, so a failed Drive login
+# or download halfway through means starting over. The state store is a
+# small SQLite file that tracks each unit of work -- a (sensor, region,
+# period, metric) product -- through
+#     planned -> submitted -> exported -> downloaded -> verified -> ingested
+# A unit made of several parts (export tiles) is at the stage of its
+# least advanced part. Stages only move forward, so recording an event
+# twice is harmless, and a run (or an extended year range) only does
+# the units that are not yet ingested. The export manifest
+# (export_cache.py) still decides, per task, whether to skip, re-attach
+# or resubmit; the store answers "which products are done" without
+# building any Earth Engine graph or logging in to Drive.
+# ---------------------------------------------------------------------
+STATE_DB_NAME = "run_state.sqlite"
+STAGES = ('planned', 'submitted', 'exported', 'downloaded', 'verified', 'ingested')
+WHOLE_UNIT = ''   # part name of a unit that is not split into parts
+
+Unit = namedtuple('Unit', ['sensor', 'region', 'period', 'metric'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    sensor TEXT, region TEXT, period TEXT, metric TEXT,
+    path TEXT, error TEXT, updated_at REAL,
+    PRIMARY KEY (sensor, region, period, metric));
+CREATE TABLE IF NOT EXISTS parts (
+    sensor TEXT, region TEXT, period TEXT, metric TEXT, part TEXT,
+    stage INTEGER, updated_at REAL,
+    PRIMARY KEY (sensor, region, period, metric, part));
+CREATE TABLE IF NOT EXISTS events (
+    ts REAL, sensor TEXT, region TEXT, period TEXT, metric TEXT, part TEXT,
+    stage TEXT, detail TEXT);
+"""
+
+
+def _stage(name):
+    if name not in STAGES:
+        raise ValueError(f"Unknown stage '{name}'; expected one of {STAGES}")
+    return STAGES.index(name)
+
+
+class StateStore:
+    """SQLite-backed stage tracking for run units (safe to share between pipeline threads)."""
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._db.close()
+
+    def _event(self, unit, part, stage, detail=None):
+        self._db.execute("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (self.clock(), *unit, part, stage, detail))
+
+    # -----------------------------------------------------------------
+    # Recording
+    # -----------------------------------------------------------------
+    def plan(self, unit, parts=(WHOLE_UNIT,)):
+        """Register a unit and its parts; parts already known keep their stage."""
+        now = self.clock()
+        with self._lock, self._db:
+            self._db.execute("INSERT OR IGNORE INTO units VALUES (?, ?, ?, ?, NULL, NULL, ?)", (*unit, now))
+            self._db.executemany("INSERT OR IGNORE INTO parts VALUES (?, ?, ?, ?, ?, 0, ?)",
+                                 [(*unit, part, now) for part in parts])
+
+    def advance(self, unit, stage, part=None, path=None, detail=None):
+        """Move one part (or, with part=None, every part) of `unit` up to `stage`; never backwards."""
+        level = _stage(stage)
+        now = self.clock()
+        with self._lock, self._db:
+            self._db.execute("INSERT OR IGNORE INTO units VALUES (?, ?, ?, ?, NULL, NULL, ?)", (*unit, now))
+            if part is None:
+                self._db.execute("INSERT INTO parts SELECT ?, ?, ?, ?, ?, 0, ? WHERE NOT EXISTS "
+                                 "(SELECT 1 FROM parts WHERE sensor = ? AND region = ? AND period = ? "
+                                 "AND metric = ?)", (*unit, WHOLE_UNIT, now, *unit))
+                self._db.execute("UPDATE parts SET stage = ?, updated_at = ? WHERE sensor = ? AND region = ? "
+                                 "AND period = ? AND metric = ? AND stage < ?", (level, now, *unit, level))
+            else:
+                self._db.execute("INSERT OR IGNORE INTO parts VALUES (?, ?, ?, ?, ?, 0, ?)", (*unit, part, now))
+                self._db.execute("UPDATE parts SET stage = ?, updated_at = ? WHERE sensor = ? AND region = ? "
+                                 "AND period = ? AND metric = ? AND part = ? AND stage < ?",
+                                 (level, now, *unit, part, level))
+            self._db.execute("UPDATE units SET updated_at = ?, error = NULL, path = COALESCE(?, path) "
+                             "WHERE sensor = ? AND region = ? AND period = ? AND metric = ?",
+                             (now, path, *unit))
+            self._event(unit, part, stage, detail)
+
+    def split(self, unit, part, new_parts):
+        """Replace `part` with `new_parts` at its current stage (a re-planned export tile)."""
+        now = self.clock()
+        with self._lock, self._db:
+            row = self._db.execute("SELECT stage FROM parts WHERE sensor = ? AND region = ? AND period = ? "
+                                   "AND metric = ? AND part = ?", (*unit, part)).fetchone()
+            level = row[0] if row else 0
+            self._db.execute("DELETE FROM parts WHERE sensor = ? AND region = ? AND period = ? "
+                             "AND metric = ? AND part = ?", (*unit, part))
+            self._db.executemany("INSERT OR REPLACE INTO parts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 [(*unit, p, level, now) for p in new_parts])
+            self._event(unit, part, 'split', ', '.join(new_parts))
+
+    def fail(self, unit, error, part=None):
+        """Note an error against a unit; its stage is kept so a re-run picks it up again."""
+        with self._lock, self._db:
+            self._db.execute("UPDATE units SET error = ?, updated_at = ? WHERE sensor = ? AND region = ? "
+                             "AND period = ? AND metric = ?", (str(error), self.clock(), *unit))
+            self._event(unit, part, 'failed', str(error))
+
+    def reset(self, unit, stage='planned', detail=None):
+        """Move every part of `unit` back to `stage` (e.g. its output went missing)."""
+        level = _stage(stage)
+        with self._lock, self._db:
+            self._db.execute("UPDATE parts SET stage = ?, updated_at = ? WHERE sensor = ? AND region = ? "
+                             "AND period = ? AND metric = ? AND stage > ?", (level, self.clock(), *unit, level))
+            self._event(unit, None, f"reset:{stage}", detail)
+
+    # -----------------------------------------------------------------
+    # Queries
+    # -----------------------------------------------------------------
+    def stage(self, unit):
+        """Stage name of a unit (its least advanced part), or None if it was never planned."""
+        with self._lock:
+            row = self._db.execute("SELECT MIN(stage), COUNT(*) FROM parts WHERE sensor = ? AND region = ? "
+                                   "AND period = ? AND metric = ?", tuple(unit)).fetchone()
+        return STAGES[row[0]] if row[1] else None
+
+    def is_done(self, unit, stage='ingested'):
+        current = self.stage(unit)
+        return current is not None and _stage(current) >= _stage(stage)
+
+    def pending(self, units, stage='ingested'):
+        """The units not yet at `stage`, in the order given."""
+        return [u for u in units if not self.is_done(u, stage)]
+
+    def units(self, sensor=None, region=None):
+        """[(unit, stage, parts, path, error)] for every recorded unit, optionally filtered."""
+        sql = ("SELECT u.sensor, u.region, u.period, u.metric, MIN(p.stage), COUNT(p.part), u.path, u.error "
+               "FROM units u LEFT JOIN parts p USING (sensor, region, period, metric) "
+               "WHERE (? IS NULL OR u.sensor = ?) AND (? IS NULL OR u.region = ?) "
+               "GROUP BY u.sensor, u.region, u.period, u.metric ORDER BY u.sensor, u.region, u.period, u.metric")
+        with self._lock:
+            rows = self._db.execute(sql, (sensor, sensor, region, region)).fetchall()
+        return [(Unit(*r[:4]), STAGES[r[4]] if r[5] else None, r[5], r[6], r[7]) for r in rows]
+
+    def reconcile(self, stage='verified'):
+        """Reset units recorded at or past `stage` whose output file is gone; returns them."""
+        missing = [unit for unit, current, _, path, _ in self.units()
+                   if current is not None and _stage(current) >= _stage(stage) and path and not os.path.exists(path)]
+        for unit in missing:
+            print(f"⚠️ {'/'.join(unit)}: {stage} output is missing; will be redone")
+            self.reset(unit, 'planned', 'output missing')
+        return missing
+
+    def report(self, sensor=None, region=None):
+        """Print each unit's stage and a per-stage count; read-only, so safe to run any time."""
+        rows = self.units(sensor, region)
+        counts = {s: 0 for s in STAGES}
+        for unit, current, parts, path, error in rows:
+            if current is not None:
+                counts[current] += 1
+            note = f" ⚠️ {error}" if error else ''
+            tiles = f" ({parts} parts)" if parts > 1 else ''
+            print(f"  {'/'.join(unit):<40} {current or '-':<10}{tiles}{note}")
+        print("📊 " + ", ".join(f"{s}: {n}" for s, n in counts.items() if n) if rows else "📊 No units recorded")
+        return counts
+
+
+def verify_output(path, width=None, height=None):
+    """Raise ValueError unless `path` is a readable raster of the expected size."""
+    import rasterio
+    from rasterio.windows import Window
+
+    with rasterio.open(path) as src:
+        if width is not None and (src.width, src.height) != (width, height):
+            raise ValueError(f"{path} is {src.width}x{src.height}, expected {width}x{height}")
+        # Decode the last block so a truncated file fails here, not at ingest.
+        block_height, block_width = src.block_shapes[0]
+        row = (src.height - 1) // block_height * block_height
+        col = (src.width - 1) // block_width * block_width
+        src.read(1, window=Window(col, row, src.width - col, src.height - row))
+    return path
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Show the stage of every unit in a run state store.")
+    parser.add_argument('path', nargs='?', default=STATE_DB_NAME)
+    parser.add_argument('--sensor')
+    parser.add_argument('--region')
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        raise SystemExit(f"No state store at {args.path}")
+    StateStore(args.path).report(args.sensor, args.region)
@@ -0,0 +1,99 @@
+import time
+
+# ---------------------------------------------------------------------
+# Export task monitor
+#
+# Replaces the per-script `while True` loops that call task.status()
+# once per task and then sleep a fixed 30 seconds. All task states are
+# fetched with one batched listing call per poll, the poll interval
+# backs off while nothing changes, and a callback fires for each task
+# as soon as it reaches a terminal state.
+# ---------------------------------------------------------------------
+TERMINAL_STATES = ('COMPLETED', 'FAILED', 'CANCELLED')
+
+
+def list_ee_tasks():
+    """Return {task_id: status dict} for all recent Earth Engine tasks in one call."""
+    import ee
+    return {t['id']: t for t in ee.data.getTaskList()}
+
+
+class TaskMonitor:
+    """Watch a set of export tasks and report each one as soon as it finishes.
+
+    `list_tasks` is any callable returning {task_id: status dict}; it
+    defaults to Earth Engine's task list and can be pointed at
+    fake_services.FakeTaskService for offline runs. With a
+    metrics.RunMetrics, each finished task's queue wait, run time and
+    compute usage are recorded.
+    """
+
+    def __init__(self, list_tasks=None, initial_delay=5, max_delay=120,
+                 backoff=2.0, sleep=time.sleep, verbose=True, metrics=None):
+        self.list_tasks = list_tasks or list_ee_tasks
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.sleep = sleep
+        self.verbose = verbose
+        self.metrics = metrics
+        self.delay = initial_delay
+        self.poll_count = 0
+        self.pending = {}   # task_id -> (label, callback)
+        self.states = {}    # task_id -> last seen state
+        self.results = {}   # task_id -> final status dict
+        self.last_listing = {}
+
+    def add(self, task, label=None, on_done=None):
+        """Start watching `task` (an ee.batch.Task or a task id string)."""
+        task_id = task if isinstance(task, str) else task.id
+        self.pending[task_id] = (label or task_id, on_done)
+        self.states[task_id] = 'SUBMITTED'
+        # A new task is something to look at soon, so reset the backoff.
+        self.delay = self.initial_delay
+        return task_id
+
+    def poll(self):
+        """Fetch all task states once; return [(task_id, label, status)] that just finished."""
+        self.poll_count += 1
+        listing = self.last_listing = self.list_tasks()
+        finished = []
+        changed = False
+        for task_id, (label, on_done) in list(self.pending.items()):
+            status = listing.get(task_id)
+            if status is None:
+                # Not listed yet -- submitted tasks can take a moment to appear.
+                continue
+            state = status['state']
+            if state != self.states[task_id]:
+                changed = True
+                self.states[task_id] = state
+                if self.verbose:
+                    print(f"{label}: {state}")
+            if state in TERMINAL_STATES:
+                del self.pending[task_id]
+                self.results[task_id] = status
+                finished.append((task_id, label, status))
+                if self.metrics is not None:
+                    self.metrics.task(label, status)
+                if on_done is not None:
+                    on_done(task_id, label, status)
+        if changed:
+            self.delay = self.initial_delay
+        else:
+            self.delay = min(self.delay * self.backoff, self.max_delay)
+        return finished
+
+    def wait(self, timeout=None):
+        """Poll until every watched task is terminal; return {task_id: final status}."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending:
+            self.poll()
+            if not self.pending:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"{len(self.pending)} export task(s) still running.")
+            if self.verbose:
+                print(f"⏳ {len(self.pending)} task(s) running, next check in {self.delay:.0f} s...")
+            self.sleep(self.delay)
+        return self.results
@@ -0,0 +1,249 @@
+import math
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from export_cache import start_export
+
+# ---------------------------------------------------------------------
+# Tiled export planning
+#
+# A single CONUS export at 30 m (or a state at 10 m) is one huge task
+# that queues behind everything else and fails all at once. The
+# planner lays a pixel-aligned grid over the region, cuts it into tiles
+# sized to a pixel budget, drops tiles that miss the boundary, and
+# submits one export per tile. Every tile shares the same crsTransform,
+# so the downloaded pieces line up exactly for mosaic.py.
+#
+# Given the boundary's polygon boxes, each part (the lower 48, Alaska,
+# Hawaii, ...) is tiled on its own instead of the whole bounding grid;
+# geometry_registry moves the western Aleutians west of -180 so the US
+# grid is one stretch rather than the whole globe.
+#
+# Every tile pays a fixed task overhead and queue wait, so the budget
+# is kept large: at 1e9 pixels the US at 30 m is 42 tiles (CONUS 21),
+# each at most 2 GB as int16, the scripts' default. tile_pixel_budget
+# lowers it so a float32 tile stays within MAX_TILE_BYTES, well under
+# the 4 GB classic-TIFF limit (one Drive file per tile). In
+# benchmark.py the int16 default beats the legacy single export
+# (Landsat annual 9.4 h vs 10.5 h, JJA 2.4 h vs 3.0 h); 7.5e8 only
+# matched it and 2.5e8 was slower (18.1 h and 7.6 h).
+# ---------------------------------------------------------------------
+METERS_PER_DEGREE = 111320.0
+TILE_PIXEL_BUDGET = 1e9
+MAX_TILE_BYTES = 3e9
+DTYPE_BYTES = {'int16': 2, 'float32': 4}
+BLOCK_SIZE = 256
+
+# A north-up raster grid: origin (x0, y0) is the top-left corner.
+Grid = namedtuple('Grid', ['crs', 'x0', 'y0', 'res', 'width', 'height'])
+Tile = namedtuple('Tile', ['id', 'col_off', 'row_off', 'width', 'height', 'bounds'])
+
+
+def grid_for_bounds(bounds, scale, crs='EPSG:4326'):
+    """Snap (west, south, east, north) to a grid of `scale`-meter pixels.
+
+    Geographic grids use a fixed degrees-per-pixel equal to `scale` at the
+    equator, which is what Earth Engine does for a scale-only export.
+    """
+    west, south, east, north = bounds
+    res = scale / METERS_PER_DEGREE if crs == 'EPSG:4326' else float(scale)
+    x0 = math.floor(west / res) * res
+    y0 = math.ceil(north / res) * res
+    width = int(math.ceil((east - x0) / res))
+    height = int(math.ceil((y0 - south) / res))
+    return Grid(crs, x0, y0, res, width, height)
+
+
+def crs_transform(grid):
+    return [grid.res, 0, grid.x0, 0, -grid.res, grid.y0]
+
+
+def tile_bounds(grid, col_off, row_off, width, height):
+    west = grid.x0 + col_off * grid.res
+    north = grid.y0 - row_off * grid.res
+    return (west, north - height * grid.res, west + width * grid.res, north)
+
+
+def tile_pixel_budget(dtype, pixel_budget=TILE_PIXEL_BUDGET):
+    """`pixel_budget`, lowered so a single-band tile of `dtype` is at most MAX_TILE_BYTES."""
+    return min(pixel_budget, MAX_TILE_BYTES / DTYPE_BYTES[dtype])
+
+
+def part_windows(grid, parts):
+    """(col0, row0, col1, row1) pixel windows of `grid` covering each part box, merged where they overlap.
+
+    Window edges are snapped outward to BLOCK_SIZE so tiles cut from
+    them still fall on block boundaries of the mosaic.
+    """
+    def snap(value, up):
+        return (math.ceil if up else math.floor)(value / BLOCK_SIZE) * BLOCK_SIZE
+
+    found = []
+    for west, south, east, north in parts:
+        col0 = max(0, snap((west - grid.x0) / grid.res, False))
+        row0 = max(0, snap((grid.y0 - north) / grid.res, False))
+        col1 = min(grid.width, snap((east - grid.x0) / grid.res, True))
+        row1 = min(grid.height, snap((grid.y0 - south) / grid.res, True))
+        if col1 > col0 and row1 > row0:
+            found.append((col0, row0, col1, row1))
+    merged = []
+    while found:
+        window = found.pop()
+        for other in found:
+            if window[0] < other[2] and other[0] < window[2] and window[1] < other[3] and other[1] < window[3]:
+                found.remove(other)
+                found.append((min(window[0], other[0]), min(window[1], other[1]),
+                              max(window[2], other[2]), max(window[3], other[3])))
+                break
+        else:
+            merged.append(window)
+    return sorted(merged, key=lambda w: (w[1], w[0]))
+
+
+def plan_tiles(grid, pixel_budget=TILE_PIXEL_BUDGET, intersects=None, parts=None):
+    """Split `grid` into square tiles of at most `pixel_budget` pixels.
+
+    Tile sides are a multiple of BLOCK_SIZE so tile edges fall on block
+    boundaries of the mosaic. With `parts` (the boundary's polygon
+    boxes, e.g. GeometryRegistry.part_bounds) each part is tiled on its
+    own, so no tile spans the ocean between, say, Hawaii and Alaska.
+    `intersects(tiles)` may return the ids of tiles that touch the
+    region; the rest are dropped.
+    """
+    side = max(BLOCK_SIZE, int(math.sqrt(pixel_budget)) // BLOCK_SIZE * BLOCK_SIZE)
+    areas = [(0, 0, grid.width, grid.height)] if parts is None else part_windows(grid, parts)
+    tiles = []
+    for col0, row0, col1, row1 in areas:
+        for row_off in range(row0, row1, side):
+            for col_off in range(col0, col1, side):
+                width = min(side, col1 - col_off)
+                height = min(side, row1 - row_off)
+                tiles.append(Tile(len(tiles), col_off, row_off, width, height,
+                                  tile_bounds(grid, col_off, row_off, width, height)))
+    if intersects is not None:
+        keep = set(intersects(tiles))
+        tiles = [t for t in tiles if t.id in keep]
+    return tiles
+
+
+def whole_grid_tile(grid):
+    """All of `grid` as one tile, for an untiled export."""
+    return Tile(0, 0, 0, grid.width, grid.height, tile_bounds(grid, 0, 0, grid.width, grid.height))
+
+
+# ---------------------------------------------------------------------
+# Earth Engine helpers
+# ---------------------------------------------------------------------
+def ee_bounds(geometry):
+    """(west, south, east, north) of an ee.Geometry, in one round-trip."""
+    ring = geometry.bounds().getInfo()['coordinates'][0]
+    xs = [p[0] for p in ring]
+    ys = [p[1] for p in ring]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def ee_intersecting_tiles(geometry):
+    """Build an `intersects` callback that asks Earth Engine which tiles touch `geometry`."""
+    import ee
+
+    def rectangle(bounds):
+        # Tiles west of -180 (see geometry_registry.unwrap_boxes) are tested where the boundary has them.
+        west, south, east, north = bounds
+        if east <= -180:
+            return ee.Geometry.Rectangle([west + 360, south, east + 360, north], None, False)
+        if west < -180:
+            return ee.Geometry.MultiPolygon([
+                [[[west + 360, south], [180, south], [180, north], [west + 360, north]]],
+                [[[-180, south], [east, south], [east, north], [-180, north]]]], None, False)
+        return ee.Geometry.Rectangle(list(bounds), None, False)
+
+    def intersects(tiles):
+        fc = ee.FeatureCollection([
+            ee.Feature(rectangle(t.bounds), {'tile_id': t.id})
+            for t in tiles
+        ])
+        return fc.filterBounds(geometry).aggregate_array('tile_id').getInfo()
+
+    return intersects
+
+
+def bbox_intersecting_tiles(boxes):
+    """Build an `intersects` callback from (west, south, east, north) boxes, offline.
+
+    Keeps tiles that overlap any box, so it may keep a few tiles that
+    only touch a polygon's bounding box (ee_intersecting_tiles is exact).
+    """
+    def intersects(tiles):
+        return [t.id for t in tiles
+                if any(t.bounds[0] < b[2] and t.bounds[2] > b[0] and t.bounds[1] < b[3] and t.bounds[3] > b[1]
+                       for b in boxes)]
+
+    return intersects
+
+
+def tile_prefix(file_prefix, tile):
+    return f"{file_prefix}_tile{tile.id:04d}"
+
+
+def split_tile(grid, tile, parts=2):
+    """Cut `tile` into up to parts x parts sub-tiles with sides on block boundaries.
+
+    Sub-tiles keep the parent's id; a side already at BLOCK_SIZE is not cut.
+    """
+    def cuts(offset, length):
+        step = max(BLOCK_SIZE, math.ceil(length / parts / BLOCK_SIZE) * BLOCK_SIZE)
+        return [(o, min(step, offset + length - o)) for o in range(offset, offset + length, step)]
+
+    return [Tile(tile.id, col_off, row_off, width, height,
+                 tile_bounds(grid, col_off, row_off, width, height))
+            for row_off, height in cuts(tile.row_off, tile.height)
+            for col_off, width in cuts(tile.col_off, tile.width)]
+
+
+def region_maker(export, grid):
+    """(export function, bounds -> region) for Earth Engine, or for a fake export taking plain bounds."""
+    if export is None:
+        import ee
+        return ee.batch.Export.image.toDrive, \
+            lambda bounds: ee.Geometry.Rectangle(list(bounds), grid.crs, False)
+    return export, list
+
+
+def tile_export_params(grid, tile, make_region):
+    """The region/crs/crsTransform export arguments that pin a tile to the shared grid."""
+    return dict(region=make_region(tile.bounds), crs=grid.crs, crsTransform=crs_transform(grid))
+
+
+def export_tiles(image, grid, tiles, folder, description, file_prefix,
+                 max_pixels=1e13, export=None, max_workers=8, manifest=None, task_state=None,
+                 **export_params):
+    """Submit one Drive export per tile concurrently; return [(task, tile, tile_file_prefix, key)].
+
+    `export` defaults to ee.batch.Export.image.toDrive and can be swapped
+    for fake_services.FakeTaskService.export_image_to_drive, in which case
+    regions are passed as plain bounds lists. With an ExportManifest,
+    `task` follows export_cache.start_export: None for tiles already on
+    disk and a task id for tiles still running from an earlier run.
+    Any other keyword arguments (e.g. cog.export_options()) are passed
+    to every export.
+    """
+    export, make_region = region_maker(export, grid)
+
+    def submit(tile):
+        prefix = tile_prefix(file_prefix, tile)
+        task, key = start_export(
+            image,
+            manifest=manifest,
+            export=export,
+            task_state=task_state,
+            description=f"{description}_tile{tile.id:04d}",
+            folder=folder,
+            fileNamePrefix=prefix,
+            maxPixels=max_pixels,
+            **tile_export_params(grid, tile, make_region),
+            **export_params
+        )
+        return task, tile, prefix, key
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(submit, tiles))
@@ -0,0 +1,232 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from local_composite import block_windows
+
+# ---------------------------------------------------------------------
+# Per-pixel trend statistics across years
+#
+# The paper's trend maps need, for every pixel, the OLS slope, the
+# Theil-Sen slope and Mann-Kendall significance of NDVI over the years.
+# CONUS at 30 m is ~10^10 pixels, so the per-year rasters (or a datacube
+# product) are streamed in spatial blocks: each block is read as a
+# (years, pixels) stack and every statistic is computed vectorized
+# across the time axis for all pixels at once.
+#   * OLS uses each pixel's own valid years (missing years are dropped,
+#     not filled).
+#   * Theil-Sen is the median of all pairwise slopes; the T(T-1)/2
+#     pairs are formed in one batch per block with triu indices, so
+#     memory is pairs x block pixels.
+#   * Mann-Kendall S comes from the signs of the same pairwise
+#     differences; its variance carries the usual tie correction (ties
+#     are common in quantized int16 rasters), and Z uses the continuity
+#     correction. p is two-sided.
+# Blocks are spread across a process pool and written to one tiled
+# float32 GeoTIFF with a band per statistic, so memory is bounded by
+# BLOCK_SIZE and the number of years, never by the grid.
+# ---------------------------------------------------------------------
+BLOCK_SIZE = 256
+MIN_YEARS = 3          # pixels with fewer valid years get NODATA
+NODATA = float('nan')
+TREND_BANDS = ('ols_slope', 'ols_intercept', 'theil_sen_slope', 'mk_s', 'mk_tau', 'mk_z', 'mk_p', 'n_years')
+
+
+def year_of(label):
+    """Numeric year of a time label such as "2021" or "2021-JJA"."""
+    return float(str(label).split('-')[0])
+
+
+def ols(x, y, valid):
+    """(slope, intercept) per pixel of y (T, N) on x (T,), using only `valid` years."""
+    import numpy as np
+
+    w = valid.astype('float64')
+    n = w.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xm = (w * x[:, None]).sum(axis=0) / n
+        ym = np.where(valid, y, 0.0).sum(axis=0) / n
+        dx = (x[:, None] - xm) * w
+        sxx = (dx * dx).sum(axis=0)
+        sxy = (dx * np.where(valid, y - ym, 0.0)).sum(axis=0)
+        slope = sxy / sxx
+    return slope, ym - slope * xm
+
+
+def _pairs(t):
+    import numpy as np
+    return np.triu_indices(t, 1)
+
+
+def theil_sen(x, y, valid):
+    """Median pairwise slope per pixel; pairs with a missing year are ignored."""
+    import warnings
+    import numpy as np
+
+    i, j = _pairs(len(x))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = (y[j] - y[i]) / (x[j] - x[i])[:, None]
+    slopes[~(valid[i] & valid[j])] = np.nan
+    with warnings.catch_warnings():
+        # Pixels with no valid pair are all-NaN columns.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(slopes, axis=0)
+
+
+def mann_kendall(y, valid):
+    """(S, tau, Z, two-sided p) per pixel, in time order, with the tie-corrected variance."""
+    import numpy as np
+
+    t = y.shape[0]
+    i, j = _pairs(t)
+    both = valid[i] & valid[j]
+    diff = np.where(both, y[j] - y[i], 0.0)
+    s = np.sign(diff).sum(axis=0)
+
+    # c[k] = how many valid values equal y[k], itself included; a tie
+    # group of size g then adds g(g-1)(2g+5) over its members.
+    tied = (both & (diff == 0)).astype('float64')
+    incidence = np.zeros((t, len(i)))
+    incidence[i, np.arange(len(i))] = 1
+    incidence[j, np.arange(len(j))] = 1
+    c = 1.0 + incidence @ tied
+    ties = np.where(valid, (c - 1) * (2 * c + 5), 0.0).sum(axis=0)
+
+    n = valid.sum(axis=0).astype('float64')
+    var = (n * (n - 1) * (2 * n + 5) - ties) / 18.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(var > 0, (s - np.sign(s)) / np.sqrt(var), 0.0)
+        tau = s / (n * (n - 1) / 2.0)
+    # math.erfc keeps numpy the only dependency; otypes gives a float64 array, not objects.
+    p = np.vectorize(math.erfc, otypes=['float64'])(np.abs(z) / math.sqrt(2.0))
+    return s, tau, z, p
+
+
+def trend_stack(x, stack, min_years=MIN_YEARS):
+    """Every statistic in TREND_BANDS for a masked (T, rows, cols) stack; returns (bands, rows, cols)."""
+    import numpy as np
+
+    x = np.asarray(x, dtype='float64')
+    shape = stack.shape[1:]
+    y = np.ma.getdata(stack).reshape(len(x), -1).astype('float64')
+    valid = ~np.ma.getmaskarray(stack).reshape(len(x), -1) & np.isfinite(y)
+    y = np.where(valid, y, np.nan)
+
+    slope, intercept = ols(x, y, valid)
+    sen = theil_sen(x, y, valid)
+    s, tau, z, p = mann_kendall(y, valid)
+    n = valid.sum(axis=0)
+
+    out = np.stack([slope, intercept, sen, s, tau, z, p, n]).astype('float32')
+    out[:-1, n < min_years] = NODATA
+    return out.reshape((len(TREND_BANDS),) + shape)
+
+
+# ---------------------------------------------------------------------
+# Block readers (module level so they pickle into the process pool)
+# ---------------------------------------------------------------------
+def _read_rasters(paths, window):
+    import numpy as np
+    import rasterio
+    from cog import read_scaled
+
+    layers = []
+    for path in paths:
+        with rasterio.open(path) as src:
+            layers.append(read_scaled(src, window=window))
+    return np.ma.stack(layers)
+
+
+def _read_cube(root, product, times, window):
+    from datacube import Datacube
+    return Datacube(root).slab(product, window, times)[1]
+
+
+def _trend_block_job(args):
+    reader, reader_args, window, x, min_years = args
+    stack = reader(*reader_args, window)
+    return window, trend_stack(x, stack, min_years)
+
+
+def _write_trends(reader, reader_args, x, profile, out_path, min_years, block_size, max_workers):
+    import rasterio
+
+    if len(x) < 2:
+        raise ValueError(f"Need at least two years for a trend, got {len(x)}")
+    profile = dict(profile, driver='GTiff', count=len(TREND_BANDS), dtype='float32', nodata=NODATA,
+                   tiled=True, blockxsize=256, blockysize=256, compress='deflate', predictor=3,
+                   BIGTIFF='IF_SAFER')
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    jobs = [(reader, reader_args, w, list(x), min_years)
+            for w in block_windows(profile['width'], profile['height'], block_size)]
+    with rasterio.open(out_path, 'w', **profile) as dst:
+        for band, name in enumerate(TREND_BANDS, start=1):
+            dst.set_band_description(band, name)
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            for window, stats in pool.map(_trend_block_job, jobs):
+                dst.write(stats, window=window)
+    print(f"📈 Trends over {len(x)} years ({min(x):.0f}-{max(x):.0f}) written to {out_path}")
+    return out_path
+
+
+def raster_trends(paths, years, out_path, min_years=MIN_YEARS, block_size=BLOCK_SIZE, max_workers=None):
+    """Trend statistics over per-year rasters on one grid; `years[i]` labels `paths[i]`.
+
+    Inputs may come in any order: Theil-Sen and Mann-Kendall depend on
+    time order, so they are sorted by year first. Scaled int16 COGs are
+    read as index values (see cog.read_scaled), so slopes are in index
+    units per year.
+    """
+    import rasterio
+
+    order = sorted(range(len(paths)), key=lambda k: year_of(years[k]))
+    paths, years = [paths[k] for k in order], [years[k] for k in order]
+
+    with rasterio.open(paths[0]) as ref:
+        profile = dict(crs=ref.crs, transform=ref.transform, width=ref.width, height=ref.height)
+        for path in paths[1:]:
+            with rasterio.open(path) as src:
+                if (src.crs, src.transform, src.width, src.height) != (ref.crs, ref.transform,
+                                                                       ref.width, ref.height):
+                    raise ValueError(f"{path} is not on the grid of {paths[0]}")
+    return _write_trends(_read_rasters, (list(paths),), [year_of(y) for y in years], profile, out_path,
+                         min_years, block_size, max_workers)
+
+
+def cube_trends(root, product, out_path, times=None, min_years=MIN_YEARS, block_size=BLOCK_SIZE,
+                max_workers=None):
+    """Trend statistics over a datacube product's time steps (all of them, or `times`)."""
+    from affine import Affine
+    from rasterio.crs import CRS
+    from datacube import Datacube
+
+    cube = Datacube(root)
+    arr = cube.array(product)
+    times = sorted(cube.times(product) if times is None else times, key=year_of)
+    profile = dict(crs=CRS.from_wkt(arr.attrs['crs']), transform=Affine(*arr.attrs['transform']),
+                   width=arr.shape[2], height=arr.shape[1])
+    return _write_trends(_read_cube, (root, product, times), [year_of(t) for t in times], profile, out_path,
+                         min_years, block_size, max_workers)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Per-pixel OLS, Theil-Sen and Mann-Kendall trends.")
+    parser.add_argument('out_path')
+    parser.add_argument('rasters', nargs='*', help="per-year rasters; the year is taken from each file name")
+    parser.add_argument('--cube', help="datacube root to read instead of rasters")
+    parser.add_argument('--product', help="datacube product, e.g. landsat/ndvi_annual")
+    parser.add_argument('--min-years', type=int, default=MIN_YEARS)
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    if args.cube:
+        if not args.product:
+            parser.error("--cube needs --product")
+        cube_trends(args.cube, args.product, args.out_path, min_years=args.min_years,
+                    block_size=args.block_size, max_workers=args.workers)
+    else:
+        years = [[s for s in os.path.basename(p).replace('.', '_').split('_') if s.isdigit()][0]
+                 for p in args.rasters]
+        raster_trends(args.rasters, years, args.out_path, args.min_years, args.block_size, args.workers)
@@ -0,0 +1,263 @@
+import csv
+import hashlib
+import json
+import os
+
+# ---------------------------------------------------------------------
+# Vectorized zonal statistics
+#
+# Summarizing a CONUS raster by state, county or tract one polygon at a
+# time re-reads and re-masks the raster per polygon. Here the zone layer
+# is rasterized once per output grid into a zone-id index (a tiled,
+# compressed GeoTIFF cached on disk), and each raster is then read once,
+# block by block: per-zone count, sum and sum of squares come from
+# np.bincount over the zone ids, and percentiles from per-zone
+# histograms over [-1, 1]. The index is reused for every year, season
+# and sensor that shares the grid.
+#
+# Percentiles are the centre of the histogram bin holding the ranked
+# value, so they are within one bin width (2 / bins) of the exact value.
+# ---------------------------------------------------------------------
+ZONE_LAYERS = {
+    # layer: (TIGER asset, id property, name property)
+    'states': ('TIGER/2018/States', 'GEOID', 'NAME'),
+    'counties': ('TIGER/2018/Counties', 'GEOID', 'NAME'),
+    'tracts': ('TIGER/2020/TRACT', 'GEOID', 'NAME'),
+}
+PERCENTILES = (10, 25, 50, 75, 90)
+DEFAULT_BINS = 1000
+BLOCK_SIZE = 2048
+PAGE_SIZE = 5000   # getInfo returns at most 5000 features per call
+
+
+def _fetch_zones(layer, tolerance):
+    import ee
+
+    asset, id_prop, name_prop = ZONE_LAYERS[layer]
+    fc = ee.FeatureCollection(asset).select([id_prop, name_prop])
+    if tolerance:
+        fc = fc.map(lambda f: f.simplify(maxError=tolerance))
+    count = fc.size().getInfo()
+    features = []
+    for offset in range(0, count, PAGE_SIZE):
+        page = ee.FeatureCollection(fc.toList(PAGE_SIZE, offset)).getInfo()
+        features += [{'type': 'Feature', 'geometry': f['geometry'],
+                      'properties': {'id': f['properties'][id_prop], 'name': f['properties'].get(name_prop)}}
+                     for f in page['features']]
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def _load_geojson(path, id_field, name_field=None):
+    with open(path) as f:
+        data = json.load(f)
+    return {'type': 'FeatureCollection',
+            'features': [{'type': 'Feature', 'geometry': f['geometry'],
+                          'properties': {'id': f['properties'][id_field],
+                                         'name': f['properties'].get(name_field) if name_field else None}}
+                         for f in data['features']]}
+
+
+class ZoneIndex:
+    """A zone layer and its rasterized zone-id indexes, cached under `cache_dir`.
+
+    `layer` is a key of ZONE_LAYERS (fetched from Earth Engine once) or
+    a path to a GeoJSON file whose features carry `id_field`. Zone
+    numbers in the index are 1-based positions in `zones`; 0 is outside
+    every zone. Zones are assumed not to overlap (later features win).
+    """
+
+    def __init__(self, layer, cache_dir, tolerance=None, fetch=None, id_field='id', name_field='name'):
+        self.layer = layer
+        self.cache_dir = cache_dir
+        self.tolerance = tolerance
+        self.fetch = fetch or _fetch_zones
+        self.id_field = id_field
+        self.name_field = name_field
+        self._features = None
+
+    @property
+    def name(self):
+        base = os.path.splitext(os.path.basename(self.layer))[0].lower()
+        return f"{base}_simplify{int(self.tolerance)}m" if self.tolerance else base
+
+    def features(self):
+        if self._features is None:
+            if os.path.exists(self.layer):
+                self._features = _load_geojson(self.layer, self.id_field, self.name_field)['features']
+            else:
+                path = os.path.join(self.cache_dir, f"{self.name}.geojson")
+                if not os.path.exists(path):
+                    print(f"🗺️ Fetching zone layer '{self.layer}' (tolerance {self.tolerance} m)...")
+                    data = self.fetch(self.layer, self.tolerance)
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    with open(path + '.tmp', 'w') as f:
+                        json.dump(data, f)
+                    os.replace(path + '.tmp', path)
+                with open(path) as f:
+                    self._features = json.load(f)['features']
+        return self._features
+
+    def zones(self):
+        """[(zone id, zone name)] in index order."""
+        return [(f['properties']['id'], f['properties'].get('name')) for f in self.features()]
+
+    # -----------------------------------------------------------------
+    # Rasterized index
+    # -----------------------------------------------------------------
+    def _source_key(self):
+        # A GeoJSON file is identified by its path, size and mtime, so an
+        # edited file or another file of the same name gets its own index.
+        if os.path.exists(self.layer):
+            stat = os.stat(self.layer)
+            return [self.name, os.path.abspath(self.layer), stat.st_size, stat.st_mtime_ns, self.id_field]
+        return [self.name]
+
+    def index_path(self, crs, transform, shape):
+        key = json.dumps([self._source_key(), str(crs), list(transform)[:6], list(shape)])
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, 'zone_index', f"{self.name}_{digest}.tif")
+
+    def grid_index(self, crs, transform, shape, block_size=BLOCK_SIZE):
+        """Path of the zone-id raster for a grid, rasterizing it on first use."""
+        import rasterio
+        from rasterio import features, windows
+        from rasterio.warp import transform_geom
+        from local_composite import block_windows
+
+        path = self.index_path(crs, transform, shape)
+        if os.path.exists(path):
+            return path
+
+        geoms = [f['geometry'] for f in self.features()]
+        if str(crs) not in ('EPSG:4326', 'OGC:CRS84'):
+            geoms = [transform_geom('EPSG:4326', crs, g) for g in geoms]
+        boxes = [features.bounds(g) for g in geoms]
+        dtype = 'uint16' if len(geoms) < 2 ** 16 else 'uint32'
+        height, width = shape
+        profile = dict(driver='GTiff', width=width, height=height, count=1, dtype=dtype, crs=crs,
+                       transform=transform, nodata=0, tiled=True, blockxsize=256, blockysize=256,
+                       compress='deflate', predictor=2, BIGTIFF='IF_SAFER')
+        print(f"🧮 Rasterizing {len(geoms)} '{self.name}' zones onto a {width}x{height} grid...")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with rasterio.open(path + '.tmp', 'w', **profile) as dst:
+            for window in block_windows(width, height, block_size):
+                west, south, east, north = windows.bounds(window, transform)
+                # Only burn the zones whose bounding box reaches this block.
+                shapes = [(g, i + 1) for i, (g, b) in enumerate(zip(geoms, boxes))
+                          if b[0] <= east and b[2] >= west and b[1] <= north and b[3] >= south]
+                if not shapes:
+                    continue
+                zone = features.rasterize(shapes, out_shape=(int(window.height), int(window.width)),
+                                          transform=windows.transform(window, transform),
+                                          fill=0, dtype=dtype)
+                dst.write(zone, 1, window=window)
+        os.replace(path + '.tmp', path)
+        return path
+
+    # -----------------------------------------------------------------
+    # Statistics
+    # -----------------------------------------------------------------
+    def stats(self, raster_path, percentiles=PERCENTILES, bins=DEFAULT_BINS, band=1, block_size=BLOCK_SIZE):
+        """{zone id: {'name', 'count', 'mean', 'std', 'p<q>'...}} for one raster band.
+
+        Values are read with the raster's scale/offset applied and nodata
+        masked. Zones without valid pixels get count 0 and None stats.
+        Histograms take zones x bins x 4 bytes; lower `bins` (or pass no
+        percentiles) for tract-sized layers.
+        """
+        import numpy as np
+        import rasterio
+        from local_composite import block_windows
+
+        zones = self.zones()
+        n = len(zones) + 1
+        count = np.zeros(n, dtype='int64')
+        total = np.zeros(n, dtype='float64')
+        total_sq = np.zeros(n, dtype='float64')
+        hist = np.zeros((n, bins), dtype='uint32') if percentiles else None
+
+        with rasterio.open(raster_path) as src:
+            index_path = self.grid_index(src.crs, src.transform, (src.height, src.width))
+            scale, offset = src.scales[band - 1], src.offsets[band - 1]
+            with rasterio.open(index_path) as zsrc:
+                for window in block_windows(src.width, src.height, block_size):
+                    zone = zsrc.read(1, window=window)
+                    if not zone.any():
+                        continue
+                    data = src.read(band, window=window, masked=True)
+                    valid = (zone > 0) & ~np.ma.getmaskarray(data)
+                    if np.issubdtype(data.dtype, np.floating):
+                        valid &= np.isfinite(data.data)
+                    z = zone[valid].astype('int64')
+                    v = data.data[valid].astype('float64') * scale + offset
+                    count += np.bincount(z, minlength=n)
+                    total += np.bincount(z, weights=v, minlength=n)
+                    total_sq += np.bincount(z, weights=v * v, minlength=n)
+                    if hist is not None and z.size:
+                        b = np.clip(((v + 1.0) * (bins / 2.0)).astype('int64'), 0, bins - 1)
+                        # Histogram only the zones present in this block.
+                        present, local = np.unique(z, return_inverse=True)
+                        counts = np.bincount(local * bins + b, minlength=len(present) * bins)
+                        hist[present] += counts.reshape(len(present), bins).astype('uint32')
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+            std = np.sqrt(np.maximum(total_sq / count - mean * mean, 0))
+        qs = _histogram_percentiles(hist, count, percentiles, bins) if hist is not None else {}
+        results = {}
+        for i, (zone_id, name) in enumerate(zones, start=1):
+            row = {'name': name, 'count': int(count[i]),
+                   'mean': float(mean[i]) if count[i] else None,
+                   'std': float(std[i]) if count[i] else None}
+            for q, values in qs.items():
+                row[f"p{q}"] = float(values[i]) if count[i] else None
+            results[zone_id] = row
+        return results
+
+    def stats_many(self, rasters, **kwargs):
+        """Run stats over {label: raster path}; returns {label: stats}, reusing the cached indexes."""
+        return {label: self.stats(path, **kwargs) for label, path in rasters.items()}
+
+
+def _histogram_percentiles(hist, count, percentiles, bins):
+    import numpy as np
+
+    cumulative = np.cumsum(hist, axis=1, dtype='int64')
+    width = 2.0 / bins
+    out = {}
+    for q in percentiles:
+        rank = np.floor(q / 100.0 * np.maximum(count - 1, 0)).astype('int64')
+        b = np.argmax(cumulative > rank[:, None], axis=1)
+        out[q] = -1.0 + width * (b + 0.5)
+    return out
+
+
+def write_csv(results, path):
+    """Write stats_many output as one row per (label, zone)."""
+    rows = [dict(label=label, zone=zone_id, **row)
+            for label, by_zone in results.items() for zone_id, row in by_zone.items()]
+    fields = ['label', 'zone'] + [k for k in (rows[0] if rows else {}) if k not in ('label', 'zone')]
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    return path
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Zonal NDVI statistics for one or more rasters.")
+    parser.add_argument('layer', help="states, counties, tracts or a GeoJSON path")
+    parser.add_argument('out_csv')
+    parser.add_argument('rasters', nargs='+', help="label=path or path (label = file name)")
+    parser.add_argument('--cache-dir', default='zone_cache')
+    parser.add_argument('--tolerance', type=float, help="zone simplification in meters")
+    parser.add_argument('--bins', type=int, default=DEFAULT_BINS)
+    parser.add_argument('--id-field', default='id', help="zone id property of a GeoJSON layer")
+    args = parser.parse_args()
+
+    rasters = dict(r.split('=', 1) if '=' in r else (os.path.basename(r), r) for r in args.rasters)
+    index = ZoneIndex(args.layer, args.cache_dir, args.tolerance, id_field=args.id_field)
+    write_csv(index.stats_many(rasters, bins=args.bins), args.out_csv)
+    print(f"✅ Zonal statistics for {len(rasters)} raster(s) written to {args.out_csv}")